@@ -5,9 +5,9 @@ import os
 import json
 import signal
 import logging
+import lxml.etree
 import subprocess
 import atomicwrites
-from mc_util import McUtil
 
 
 class Advertiser:
@@ -24,17 +24,63 @@ class Advertiser:
         self._cfgFile = os.path.join(self._tmpDir, "ftpd.cfg")
         self._logFile = os.path.join(param["log-directory"], "ftpd.log")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
+        # optional settings in /etc/mirrors/advertiser-ftp.conf
+        self._workers = param["config"].get("workers", 1)                                     # number of ftpd worker processes
+        self._maxConnections = param["config"].get("max-connections", 512)                    # per worker process
+        self._maxConnectionsPerIp = param["config"].get("max-connections-per-ip", 0)          # per worker process, 0 means no limit
+        if not isinstance(self._workers, int) or self._workers <= 0:
+            raise Exception("invalid \"workers\" in advertiser-ftp.conf")
+        if not isinstance(self._maxConnections, int) or self._maxConnections <= 0:
+            raise Exception("invalid \"max-connections\" in advertiser-ftp.conf")
+        if not isinstance(self._maxConnectionsPerIp, int) or self._maxConnectionsPerIp < 0:
+            raise Exception("invalid \"max-connections-per-ip\" in advertiser-ftp.conf")
+        self._transferCfg = {
+            "useSendfile": param["config"].get("use-sendfile", True),
+            "dataBufferSize": param["config"].get("data-buffer-size", 65536),               # bytes
+            "socketSendBufferSize": param["config"].get("socket-send-buffer-size", 0),      # bytes, 0 means system default
+            "socketRecvBufferSize": param["config"].get("socket-recv-buffer-size", 0),      # bytes, 0 means system default
+            "maxBandwidth": param["config"].get("max-bandwidth", 0),                        # bytes per second, 0 means no limit
+        }
+        if not isinstance(self._transferCfg["useSendfile"], bool):
+            raise Exception("invalid \"use-sendfile\" in advertiser-ftp.conf")
+        if not isinstance(self._transferCfg["dataBufferSize"], int) or self._transferCfg["dataBufferSize"] <= 0:
+            raise Exception("invalid \"data-buffer-size\" in advertiser-ftp.conf")
+        for key in ["socket-send-buffer-size", "socket-recv-buffer-size", "max-bandwidth"]:
+            value = param["config"].get(key, 0)
+            if not isinstance(value, int) or value < 0:
+                raise Exception("invalid \"%s\" in advertiser-ftp.conf" % (key))
+
+        # per mirror site bandwidth limits in advertiser config xml
+        self._siteBandwidthDict = dict()            # dict<mirror-site-id,(max-bandwidth,max-bandwidth-per-connection)>
+        for msId, msParam in self._mirrorSiteDict.items():
+            xmlElem = lxml.etree.fromstring(msParam["config-xml"])
+            value = []
+            for tag in ["max-bandwidth", "max-bandwidth-per-connection"]:
+                tl = xmlElem.xpath(".//%s" % (tag))
+                if len(tl) > 0:
+                    if tl[0].text is None or not tl[0].text.strip().isdigit():
+                        raise Exception("mirror site %s: invalid <%s> for ftp advertiser" % (msId, tag))
+                    value.append(int(tl[0].text))
+                else:
+                    value.append(0)
+            if value != [0, 0]:
+                self._siteBandwidthDict[msId] = tuple(value)
+
+        self._sock = None
         self._port = None
         self._proc = None
         self._advertisedMirrorSiteIdList = []
         try:
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._sock = self._portAllocator.allocateListenSocket("advertiser-ftp", self._listenIp)
+            self._port = self._sock.getsockname()[1]
             self._generateCfgFile()
-            self._proc = subprocess.Popen([self._execFile, self._cfgFile], cwd=self._tmpDir)
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
-            logging.info("Advertiser (ftp) started, listening on port %d." % (self._port))
+            # SIGUSR1 is blocked until the child process has installed its handler, so that an early reload request is kept pending instead of killing it
+            self._proc = subprocess.Popen([self._execFile, self._cfgFile], pass_fds=[self._sock.fileno()], cwd=self._tmpDir,
+                                          preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1]))
+            logging.info("Advertiser (ftp) started, listening on port %d with %d worker(s)." % (self._port, self._workers))
         except Exception:
             self.dispose()
             raise
@@ -44,7 +90,11 @@ class Advertiser:
             self._proc.terminate()
             self._proc.wait()
             self._proc = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
 
     def get_access_info(self, mirror_site_id):
@@ -66,6 +116,12 @@ class Advertiser:
         dataObj["logFile"] = self._logFile
         dataObj["ip"] = self._listenIp
         dataObj["port"] = self._port
+        dataObj["listenFd"] = self._sock.fileno()
+        dataObj["workers"] = self._workers
+        dataObj["maxConnections"] = self._maxConnections
+        dataObj["maxConnectionsPerIp"] = self._maxConnectionsPerIp
+        dataObj.update(self._transferCfg)
+        dataObj["siteBandwidth"] = {x: self._siteBandwidthDict[x] for x in self._advertisedMirrorSiteIdList if x in self._siteBandwidthDict}
         dataObj["dirmap"] = {x: self._mirrorSiteDict[x]["storage-param"]["file"]["data-directory"] for x in self._advertisedMirrorSiteIdList}
 
         # write file
@@ -3,14 +3,17 @@
 
 import os
 import sys
+import time
 import json
 import signal
+import socket
 import logging
 import logging.handlers
 import pyftpdlib.servers
 import pyftpdlib.handlers
 import pyftpdlib.authorizers
 import pyftpdlib.filesystems
+from collections import OrderedDict
 
 
 class VirtualFS(pyftpdlib.filesystems.AbstractedFS):
@@ -37,7 +40,11 @@ class VirtualFS(pyftpdlib.filesystems.AbstractedFS):
     # --- Wrapper methods around open() and tempfile.mkstemp
 
     def open(self, filename, mode):
-        return super().open(self._path2rpath(filename), mode)
+        if mode == "rb":
+            # no python-side buffering, the data channel sends the file by sendfile() on its file descriptor
+            return open(self._path2rpath(filename), mode, buffering=0)
+        else:
+            return super().open(self._path2rpath(filename), mode)
 
     def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
         raise NotImplementedError()
@@ -55,13 +62,27 @@ class VirtualFS(pyftpdlib.filesystems.AbstractedFS):
         raise NotImplementedError()
 
     def listdir(self, path):
+        # list directory and fill stat cache in one scan, the subsequent lstat() and stat() calls
+        # made by pyftpdlib for each entry when formatting LIST/MLSD output are served from the cache
+        global statCache
         if self._isVirtualRootDir(path):
             return self._listVirtualRootDir()
-        else:
-            return super().listdir(self._path2rpath(path))
+
+        rpath = self._path2rpath(path)
+        ret = []
+        with os.scandir(rpath) as it:
+            for entry in it:
+                ret.append(entry.name)
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                statCache.putDirEntry(entry.path, st, entry.is_symlink())
+        return ret
 
     def listdirinfo(self, path):
-        raise NotImplementedError()
+        # AbstractedFS.listdirinfo() calls os.listdir() on the virtual path directly
+        return self.listdir(path)
 
     def rmdir(self, path):
         raise NotImplementedError()
@@ -76,22 +97,37 @@ class VirtualFS(pyftpdlib.filesystems.AbstractedFS):
         raise NotImplementedError()
 
     def stat(self, path):
+        global statCache
         if self._isVirtualRootDir(path):
             return os.stat("/")                     # FIXME
         else:
-            return super().stat(self._path2rpath(path))
+            rpath = self._path2rpath(path)
+            ret = statCache.get(rpath, True)
+            if ret is None:
+                ret = super().stat(rpath)
+                statCache.put(rpath, True, ret)
+            return ret
 
     def utime(self, path, timeval):
         raise NotImplementedError()
 
     def lstat(self, path):
+        global statCache
         if self._isVirtualRootDir(path):
             return os.lstat("/")                    # FIXME
         else:
-            return super().lstat(self._path2rpath(path))
+            rpath = self._path2rpath(path)
+            ret = statCache.get(rpath, False)
+            if ret is None:
+                ret = super().lstat(rpath)
+                statCache.put(rpath, False, ret)
+            return ret
 
     def readlink(self, path):
-        raise NotImplementedError()
+        if self._isVirtualRootDir(path) or self._isVirtualSiteDir(path):
+            raise OSError("Invalid argument: '%s'" % (path))
+        else:
+            return super().readlink(self._path2rpath(path))
 
     # --- Wrapper methods around os.path.* calls
 
@@ -161,40 +197,125 @@ class VirtualFS(pyftpdlib.filesystems.AbstractedFS):
 
     def _listVirtualRootDir(self):
         global cfg
-        return sorted(cfg["dirmap"].keys())
+        return cfg["dirmap"].siteNameList
 
     def _path2rpath(self, path):
         global cfg
         assert os.path.isabs(path) and not self._isVirtualRootDir(path)
-        for prefix, realPath in cfg["dirmap"].items():
-            if path == "/" + prefix:
-                return realPath
-            if path.startswith("/" + prefix + "/"):
-                return path.replace("/" + prefix, realPath, 1)
-        raise FileNotFoundError("No such file or directory: '%s'" % (path))
+        ret = cfg["dirmap"].path2rpath(path)
+        if ret is None:
+            raise FileNotFoundError("No such file or directory: '%s'" % (path))
+        return ret
 
     def _rpath2path(self, rpath):
         global cfg
-        for prefix, realPath in cfg["dirmap"].items():
-            if rpath == realPath:
-                return "/" + prefix
-            if rpath.startswith(realPath + "/"):
-                return rpath.replace(realPath, "/" + prefix, 1)
-        assert False
+        ret = cfg["dirmap"].rpath2path(rpath)
+        assert ret is not None
+        return ret
 
     def _rpathInRange(self, rpath):
         global cfg
-        for prefix, realPath in cfg["dirmap"].items():
-            if rpath == realPath:
-                return True
-            if rpath.startswith(realPath + "/"):
-                return True
-        return False
+        return cfg["dirmap"].rpath2path(rpath) is not None
+
+
+class StatCache:
+
+    """
+    Bounded stat result cache keyed by real path, entries expire after TTL seconds.
+    Mirror site content changes only when updating, so a short staleness is acceptable.
+    """
+
+    TTL = 10
+    MAX_SIZE = 200000
+
+    def __init__(self):
+        self._cacheDict = OrderedDict()            # OrderedDict<real-path,(expire-time,lstat-result,stat-result)>, insertion order
+
+    def get(self, rpath, followSymlinks):
+        item = self._cacheDict.get(rpath)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._cacheDict[rpath]
+            return None
+        return item[2] if followSymlinks else item[1]
+
+    def put(self, rpath, followSymlinks, st):
+        item = self._cacheDict.get(rpath)
+        if item is None or item[0] < time.monotonic():
+            item = (None, None, None)
+        if followSymlinks:
+            self._put(rpath, item[1], st)
+        else:
+            self._put(rpath, st, item[2])
+
+    def putDirEntry(self, rpath, st, bSymlink):
+        # st is the lstat result, it is also the stat result if the entry is not a symlink
+        self._put(rpath, st, (None if bSymlink else st))
+
+    def _put(self, rpath, lst, st):
+        if rpath in self._cacheDict:
+            del self._cacheDict[rpath]
+        self._cacheDict[rpath] = (time.monotonic() + self.TTL, lst, st)
+
+        # the oldest entries are at the beginning, expired entries are dropped when they are read or when the cache is full
+        if len(self._cacheDict) > self.MAX_SIZE:
+            self._cacheDict.popitem(last=False)
+
+
+class DirMap:
+
+    """
+    Mapping between virtual site directories and real directories, it is immutable.
+    Virtual paths are resolved by a dict lookup of the site name, real paths are resolved by walking a
+    trie of path components, so both lookups take O(depth) time regardless of the number of sites.
+    """
+
+    def __init__(self, dirmap):
+        self.siteDict = dict(dirmap)                # dict<site-name,real-path>
+        self.siteNameList = sorted(dirmap.keys())
+        self.trie = dict()                          # nested dict<path-component,node>, node[None] is the site name whose real path ends at this node
+
+        for key, value in dirmap.items():
+            if not os.path.isabs(value) or value.endswith("/"):
+                raise Exception("value of \"%s\" in \"dirmap\" is invalid" % (key))
+            node = self.trie
+            for c in value.split("/")[1:]:
+                if None in node:
+                    raise Exception("values in \"dirmap\" are overlay")
+                node = node.setdefault(c, dict())
+            if len(node) > 0:
+                raise Exception("values in \"dirmap\" are overlay")
+            node[None] = key
+
+    def path2rpath(self, path):
+        # returns None if path is not in any virtual site directory
+        i = path.find("/", 1)
+        if i < 0:
+            return self.siteDict.get(path[1:])
+        else:
+            realPath = self.siteDict.get(path[1:i])
+            if realPath is None:
+                return None
+            return realPath + path[i:]
+
+    def rpath2path(self, rpath):
+        # returns None if rpath is not in any real directory
+        node = self.trie
+        tl = rpath.split("/")
+        for i in range(1, len(tl)):
+            node = node.get(tl[i])
+            if node is None:
+                return None
+            if None in node:
+                return "/".join(["", node[None]] + tl[i + 1:])
+        return None
 
 
 def refreshCfgFromCfgFile():
     global cfgFile
     global cfg
+    global bandwidthLimiter
 
     with open(cfgFile, "r") as f:
         buf = f.read()
@@ -210,15 +331,7 @@ def refreshCfgFromCfgFile():
             raise Exception("no \"port\" in config file")
         if "dirmap" not in dataObj:
             raise Exception("no \"dirmap\" in config file")
-        for key, value in dataObj["dirmap"].items():
-            if not os.path.isabs(value) or value.endswith("/"):
-                raise Exception("value of \"%s\" in \"dirmap\" is invalid" % (key))
-        if True:
-            tl = list(dataObj["dirmap"].values())
-            for i in range(0, len(tl)):
-                for j in range(0, len(tl)):
-                    if i != j and (tl[i] == tl[j] or tl[i].startswith(tl[j] + "/") or tl[j].startswith(tl[i] + "/")):
-                        raise Exception("values in \"dirmap\" are overlay")
+        dirMap = DirMap(dataObj["dirmap"])                          # values are checked here
 
         if "logFile" not in cfg:
             cfg["logFile"] = dataObj["logFile"]                     # cfg["logFile"] is not changable
@@ -226,35 +339,324 @@ def refreshCfgFromCfgFile():
             cfg["ip"] = dataObj["ip"]                               # cfg["ip"] is not changable
         if "port" not in cfg:
             cfg["port"] = dataObj["port"]                           # cfg["port"] is not changable
-        cfg["dirmap"] = dataObj["dirmap"]
+        if "listenFd" not in cfg:
+            cfg["listenFd"] = dataObj.get("listenFd")               # cfg["listenFd"] is not changable, listening socket inherited from the daemon
+        if "workers" not in cfg:
+            cfg["workers"] = dataObj.get("workers", 1)              # cfg["workers"] is not changable
+        if "maxConnections" not in cfg:
+            cfg["maxConnections"] = dataObj.get("maxConnections", 512)              # cfg["maxConnections"] is not changable
+        if "maxConnectionsPerIp" not in cfg:
+            cfg["maxConnectionsPerIp"] = dataObj.get("maxConnectionsPerIp", 0)      # cfg["maxConnectionsPerIp"] is not changable
+        if "useSendfile" not in cfg:
+            cfg["useSendfile"] = dataObj.get("useSendfile", True)                  # cfg["useSendfile"] is not changable
+        if "dataBufferSize" not in cfg:
+            cfg["dataBufferSize"] = dataObj.get("dataBufferSize", 65536)           # cfg["dataBufferSize"] is not changable
+        if "socketSendBufferSize" not in cfg:
+            cfg["socketSendBufferSize"] = dataObj.get("socketSendBufferSize", 0)   # cfg["socketSendBufferSize"] is not changable
+        if "socketRecvBufferSize" not in cfg:
+            cfg["socketRecvBufferSize"] = dataObj.get("socketRecvBufferSize", 0)   # cfg["socketRecvBufferSize"] is not changable
+        bandwidthLimiter.refresh(dataObj.get("maxBandwidth", 0), {k: tuple(v) for k, v in dataObj.get("siteBandwidth", dict()).items()}, cfg["workers"])
+        cfg["dirmap"] = dirMap                                      # replace the whole object, it is used by the handlers
+
+
+class TokenBucket:
+
+    BURST_TIME = 0.2                    # seconds, bursts of up to this much time worth of traffic are allowed
+
+    def __init__(self, rate):
+        self.rate = rate                # bytes per second
+        self.tokens = rate * self.BURST_TIME
+        self.lastTime = time.monotonic()
+
+    def setRate(self, rate):
+        self.getAvailable()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * self.BURST_TIME)
+
+    def getAvailable(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate * self.BURST_TIME, self.tokens + (now - self.lastTime) * self.rate)
+        self.lastTime = now
+        return int(self.tokens)
+
+    def getDelay(self, size):
+        # returns seconds until size bytes are available
+        return max(0, (size - self.tokens) / self.rate)
+
+    def consume(self, size):
+        self.tokens -= size
+
+
+class BandwidthLimiter:
 
+    """
+    Token buckets for the server, for each site (shared by all the connections of the site) and for
+    each connection. Rates in config are the totals of all the worker processes, so each worker gets
+    its share of them.
+    """
 
-def runServer():
+    def __init__(self):
+        self.serverBucket = None                    # None means no limit
+        self.siteBucketDict = dict()                # dict<site-name,TokenBucket>
+        self.siteLimitDict = dict()                 # dict<site-name,(max-bandwidth,max-bandwidth-per-connection)>
+
+    def refresh(self, maxBandwidth, siteLimitDict, workers):
+        self.serverBucket = self._refreshBucket(self.serverBucket, maxBandwidth // workers)
+        for site, (siteMax, connMax) in siteLimitDict.items():
+            self.siteBucketDict[site] = self._refreshBucket(self.siteBucketDict.get(site), siteMax // workers)
+        for site in list(self.siteBucketDict.keys()):
+            if site not in siteLimitDict or self.siteBucketDict[site] is None:
+                del self.siteBucketDict[site]
+        self.siteLimitDict = siteLimitDict
+
+    def getBucketList(self, site):
+        # returns the buckets for a new transfer of the site, empty list means no limit
+        ret = []
+        if self.serverBucket is not None:
+            ret.append(self.serverBucket)
+        if site in self.siteBucketDict:
+            ret.append(self.siteBucketDict[site])
+        if site in self.siteLimitDict and self.siteLimitDict[site][1] > 0:
+            ret.append(TokenBucket(self.siteLimitDict[site][1]))
+        return ret
+
+    @staticmethod
+    def _refreshBucket(bucket, rate):
+        if rate <= 0:
+            return None
+        if bucket is None:
+            return TokenBucket(rate)
+        bucket.setRate(rate)
+        return bucket
+
+
+class DTPHandler(pyftpdlib.handlers.DTPHandler):
+
+    """
+    Data channel with socket buffer sizes set and bandwidth throttled by token buckets.
+    Unlike pyftpdlib.handlers.ThrottledDTPHandler, throttling does not disable sendfile(), the byte
+    count of each sendfile() call is limited instead.
+    """
+
+    socket_send_buffer_size = 0         # 0 means system default
+    socket_recv_buffer_size = 0
+
+    MIN_CHUNK_TIME = 0.05               # when throttled, wait until at least this much time worth of data can be sent
+
+    def __init__(self, sock, cmd_channel):
+        super().__init__(sock, cmd_channel)
+        if self.socket_send_buffer_size > 0:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_send_buffer_size)
+        if self.socket_recv_buffer_size > 0:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_recv_buffer_size)
+        self._bucketList = []
+        self._throttler = None
+
+    def push_with_producer(self, producer):
+        global cfg
+        global bandwidthLimiter
+
+        if self.file_obj is not None:
+            path = cfg["dirmap"].rpath2path(self.file_obj.name)
+            if path is not None:
+                self._bucketList = bandwidthLimiter.getBucketList(path.split("/")[1])
+        super().push_with_producer(producer)
+
+    def initiate_sendfile(self):
+        if len(self._bucketList) == 0:
+            super().initiate_sendfile()
+            return
+
+        size = self._getQuota()
+        if size == 0:
+            return
+        bufSize = self.ac_out_buffer_size
+        sent = self.tot_bytes_sent
+        self.ac_out_buffer_size = size
+        try:
+            super().initiate_sendfile()
+        finally:
+            self.ac_out_buffer_size = bufSize
+            self._consume(self.tot_bytes_sent - sent)
+
+    def send(self, data):
+        if len(self._bucketList) == 0:
+            return super().send(data)
+
+        size = self._getQuota()
+        if size == 0:
+            return 0
+        ret = super().send(data[:size])
+        self._consume(ret)
+        return ret
+
+    def close(self):
+        if self._throttler is not None:
+            self._throttler.cancel()
+            self._throttler = None
+        super().close()
+
+    def _getQuota(self):
+        # returns the number of bytes can be sent now, returns 0 and sleeps the channel if throttled
+        ret = min([self.ac_out_buffer_size] + [x.getAvailable() for x in self._bucketList])
+        minSize = max(1, min([self.ac_out_buffer_size] + [int(x.rate * self.MIN_CHUNK_TIME) for x in self._bucketList]))
+        if ret >= minSize:
+            return ret
+
+        self.del_channel()
+        self._throttler = self.ioloop.call_later(max([x.getDelay(minSize) for x in self._bucketList]), self._unthrottle, _errback=self.handle_error)
+        return 0
+
+    def _unthrottle(self):
+        self._throttler = None
+        self.add_channel(events=self.ioloop.WRITE)
+
+    def _consume(self, size):
+        for bucket in self._bucketList:
+            bucket.consume(size)
+
+
+class WorkerPool:
+
+    """
+    Pre-forked worker processes sharing one listening socket, each worker runs its own FTPServer and
+    ioloop, the kernel distributes incoming connections among them.
+    The parent process re-reads the config file on SIGUSR1 and forwards the signal to all the workers,
+    restarts the workers which exit unexpectedly, and terminates all the workers on SIGTERM.
+    """
+
+    RESTART_INTERVAL = 1            # seconds
+
+    def __init__(self, workerNum, workerFunc):
+        self.workerNum = workerNum
+        self.workerFunc = workerFunc            # workerFunc(worker-index, listening-socket)
+        self.pidDict = dict()                   # dict<pid,worker-index>
+        self.bStop = False
+
+    def run(self, sock):
+        signal.signal(signal.SIGUSR1, self._sigHandlerUSR1)
+        signal.signal(signal.SIGTERM, self._sigHandlerTERM)
+        signal.signal(signal.SIGINT, self._sigHandlerTERM)
+
+        for i in range(0, self.workerNum):
+            self._startWorker(i, sock)
+
+        while len(self.pidDict) > 0:
+            pid, status = os.wait()
+            idx = self.pidDict.pop(pid, None)
+            if idx is None or self.bStop:
+                continue
+            logging.error("Worker %d exited unexpectedly with status %d, restarting." % (idx, status))
+            time.sleep(self.RESTART_INTERVAL)
+            if not self.bStop:
+                self._startWorker(idx, sock)
+
+    def _startWorker(self, idx, sock):
+        # block signals until the worker has its own signal handlers
+        sigList = [signal.SIGUSR1, signal.SIGTERM, signal.SIGINT]
+        signal.pthread_sigmask(signal.SIG_BLOCK, sigList)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                ret = 1
+                try:
+                    signal.signal(signal.SIGUSR1, sigHandler)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    signal.pthread_sigmask(signal.SIG_UNBLOCK, sigList)
+                    self.workerFunc(idx, sock)
+                    ret = 0
+                except BaseException:
+                    logging.exception("Worker %d failed." % (idx))
+                finally:
+                    os._exit(ret)
+            self.pidDict[pid] = idx
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, sigList)
+
+    def _sigHandlerUSR1(self, signum, frame):
+        # check the config file before the workers load it, an invalid config file must not kill the pool
+        if not sigHandler(signum, frame):
+            return
+        for pid in self.pidDict:
+            os.kill(pid, signal.SIGUSR1)
+
+    def _sigHandlerTERM(self, signum, frame):
+        self.bStop = True
+        for pid in self.pidDict:
+            os.kill(pid, signal.SIGTERM)
+
+
+def runWorker(idx, sock):
     global cfg
 
+    if idx is None:
+        logFile = cfg["logFile"]
+    else:
+        root, ext = os.path.splitext(cfg["logFile"])
+        logFile = "%s-%d%s" % (root, idx, ext)                      # RotatingFileHandler can't be shared by processes
     log = logging.getLogger("pyftpdlib")
     log.propagate = False
     log.setLevel(logging.INFO)
-    log.addHandler(logging.handlers.RotatingFileHandler(cfg["logFile"], 10 * 1024 * 1024, 2))
+    log.addHandler(logging.handlers.RotatingFileHandler(logFile, 10 * 1024 * 1024, 2))
 
     authorizer = pyftpdlib.authorizers.DummyAuthorizer()
     authorizer.add_anonymous("/")
 
+    dtpHandler = DTPHandler
+    dtpHandler.ac_in_buffer_size = cfg["dataBufferSize"]
+    dtpHandler.ac_out_buffer_size = cfg["dataBufferSize"]           # also the byte count of each sendfile() call
+    dtpHandler.socket_send_buffer_size = cfg["socketSendBufferSize"]
+    dtpHandler.socket_recv_buffer_size = cfg["socketRecvBufferSize"]
+
     handler = pyftpdlib.handlers.FTPHandler
     handler.authorizer = authorizer
     handler.abstracted_fs = VirtualFS
-
-    server = pyftpdlib.servers.FTPServer((cfg["ip"], cfg["port"]), handler)
+    handler.dtp_handler = dtpHandler
+    handler.use_sendfile = cfg["useSendfile"] and hasattr(os, "sendfile")       # sendfile() is not used in ASCII mode
+
+    if sock is None:
+        server = pyftpdlib.servers.FTPServer((cfg["ip"], cfg["port"]), handler)
+    else:
+        server = pyftpdlib.servers.FTPServer(sock, handler)         # the ioloop is created here, after fork
+    server.max_cons = cfg["maxConnections"]                         # limits are per worker
+    server.max_cons_per_ip = cfg["maxConnectionsPerIp"]
     server.serve_forever()
 
 
+def runServer():
+    global cfg
+
+    if cfg["listenFd"] is not None:
+        sock = socket.socket(fileno=cfg["listenFd"])
+    elif cfg["workers"] > 1:
+        family = socket.AF_INET6 if ":" in cfg["ip"] else socket.AF_INET
+        sock = socket.create_server((cfg["ip"], cfg["port"]), family=family, backlog=100)
+    else:
+        sock = None
+
+    if cfg["workers"] <= 1:
+        runWorker(None, sock)
+    else:
+        WorkerPool(cfg["workers"], runWorker).run(sock)
+
+
 def sigHandler(signum, frame):
-    refreshCfgFromCfgFile()
+    # the previous config is kept if the config file is invalid, refreshCfgFromCfgFile() checks everything before changing cfg
+    try:
+        refreshCfgFromCfgFile()
+        return True
+    except Exception:
+        logging.exception("Failed to reload config file \"%s\", keep using the previous config." % (cfgFile))
+        return False
 
 
 if __name__ == "__main__":
     cfgFile = sys.argv[1]
     cfg = dict()
+    statCache = StatCache()
+    bandwidthLimiter = BandwidthLimiter()
     refreshCfgFromCfgFile()
     signal.signal(signal.SIGUSR1, sigHandler)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])     # blocked by the daemon until the handler is installed
     runServer()
@@ -19,13 +19,14 @@ class Advertiser:
         self._tmpDir = param["temp-directory"]
         self._virtRootDir = os.path.join(self._tmpDir, "vroot")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
         self._port = None
         self._proc = None
         try:
             McUtil.ensureDir(self._virtRootDir)
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._port = self._portAllocator.allocatePort("advertiser-git")
             self._proc = subprocess.Popen([
                 "/usr/libexec/git-core/git-daemon",
                 "--export-all",
@@ -33,8 +34,8 @@ class Advertiser:
                 "--port=%d" % (self._port),
                 "--base-path=%s" % (self._virtRootDir),
             ], cwd=self._tmpDir)
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
-            logging.info("Advertiser (git) started, listening on port %d." % (self._port))
+            readyTime = McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+            logging.info("Advertiser (git) started, listening on port %d, ready in %.2f seconds." % (self._port, readyTime))
         except Exception:
             self.dispose()
             raise
@@ -45,6 +46,7 @@ class Advertiser:
             self._proc.wait()
             self._proc = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
         McUtil.forceDelete(self._virtRootDir)
 
@@ -2,11 +2,11 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import json
 import signal
 import logging
 import subprocess
 import atomicwrites
-from mc_util import McUtil
 
 
 class Advertiser:
@@ -18,25 +18,26 @@ class Advertiser:
         }
 
     def __init__(self, param):
+        self._execFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "httpd.py")
         self._tmpDir = param["temp-directory"]
-        self._logDir = param["log-directory"]
-        self._virtRootDir = os.path.join(self._tmpDir, "vroot")
-        self._cfgFn = os.path.join(self._tmpDir, "httpd.conf")
-        self._pidFile = os.path.join(self._tmpDir, "httpd.pid")
-        self._errorLogFile = os.path.join(self._logDir, "error.log")
-        self._accessLogFile = os.path.join(self._logDir, "access.log")
+        self._cfgFile = os.path.join(self._tmpDir, "httpd.cfg")
+        self._logFile = os.path.join(param["log-directory"], "access.log")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
+        self._sock = None
         self._port = None
         self._proc = None
         self._advertisedMirrorSiteIdList = []
+        self._generationDict = dict()             # dict<mirror-site-id,int>, increased after a mirror site is updated
         try:
-            self._port = McUtil.getFreeSocketPort("tcp")
-            self._generateVirtualRootDir()
-            self._generateCfgFn()
-            self._proc = subprocess.Popen(["/usr/sbin/apache2", "-f", self._cfgFn, "-DFOREGROUND"], cwd=self._virtRootDir)
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+            self._sock = self._portAllocator.allocateListenSocket("advertiser-httpdir", self._listenIp)
+            self._port = self._sock.getsockname()[1]
+            self._generateCfgFile()
+            # SIGUSR1 is blocked until the child process has installed its handler, so that an early reload request is kept pending instead of killing it
+            self._proc = subprocess.Popen([self._execFile, self._cfgFile], pass_fds=[self._sock.fileno()], cwd=self._tmpDir,
+                                          preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1]))
             logging.info("Advertiser (httpdir) started, listening on port %d." % (self._port))
         except Exception:
             self.dispose()
@@ -47,9 +48,12 @@ class Advertiser:
             self._proc.terminate()
             self._proc.wait()
             self._proc = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
-        McUtil.forceDelete(self._virtRootDir)
 
     def get_access_info(self, mirror_site_id):
         assert mirror_site_id in self._mirrorSiteDict
@@ -61,47 +65,26 @@ class Advertiser:
     def advertise_mirror_site(self, mirror_site_id):
         assert mirror_site_id in self._mirrorSiteDict
         self._advertisedMirrorSiteIdList.append(mirror_site_id)
-        self._generateVirtualRootDir()
-        self._generateCfgFn()
+        self._generateCfgFile()
         os.kill(self._proc.pid, signal.SIGUSR1)
 
-    def _generateVirtualRootDir(self):
-        McUtil.ensureDir(self._virtRootDir)
-
-        # create new directories
-        for msId in self._advertisedMirrorSiteIdList:
-            realPath = self._mirrorSiteDict[msId]["storage-param"]["file"]["data-directory"]
-            dn = os.path.join(self._virtRootDir, msId)
-            if not os.path.exists(dn):
-                os.symlink(realPath, dn)
-
-    def _generateCfgFn(self):
-        modulesDir = "/usr/lib64/apache2/modules"
-        buf = ""
-
-        # modules
-        buf += "LoadModule log_config_module      %s/mod_log_config.so\n" % (modulesDir)
-        buf += "LoadModule unixd_module           %s/mod_unixd.so\n" % (modulesDir)
-        buf += "LoadModule alias_module           %s/mod_alias.so\n" % (modulesDir)
-        buf += "LoadModule authz_core_module      %s/mod_authz_core.so\n" % (modulesDir)            # it's strange why we need this module and Require directive when we have no auth at all
-        buf += "LoadModule autoindex_module       %s/mod_autoindex.so\n" % (modulesDir)
-        # add mod_log_rotate
-        buf += "\n"
+    def mirror_site_updated(self, mirror_site_id):
+        # let httpd regenerate the directory listings of this mirror site in background
+        assert mirror_site_id in self._advertisedMirrorSiteIdList
+        self._generationDict[mirror_site_id] = self._generationDict.get(mirror_site_id, 0) + 1
+        self._generateCfgFile()
+        os.kill(self._proc.pid, signal.SIGUSR1)
 
-        # global settings
-        buf += 'PidFile "%s"\n' % (self._pidFile)
-        buf += 'ErrorLog "%s"\n' % (self._errorLogFile)
-        buf += r'LogFormat "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"" common' + "\n"
-        buf += 'CustomLog "%s" common\n' % (self._accessLogFile)
-        buf += "\n"
-        buf += "Listen %d http\n" % (self._port)
-        buf += "ServerName none\n"                              # dummy value
-        buf += "\n"
-        buf += 'DocumentRoot "%s"\n' % (self._virtRootDir)
-        buf += '<Directory "%s">\n' % (self._virtRootDir)
-        buf += '  Require all granted\n'
-        buf += '</Directory>\n'
+    def _generateCfgFile(self):
+        # generate file content
+        dataObj = dict()
+        dataObj["logFile"] = self._logFile
+        dataObj["ip"] = self._listenIp
+        dataObj["port"] = self._port
+        dataObj["listenFd"] = self._sock.fileno()
+        dataObj["dirmap"] = {x: self._mirrorSiteDict[x]["storage-param"]["file"]["data-directory"] for x in self._advertisedMirrorSiteIdList}
+        dataObj["generation"] = self._generationDict
 
-        # write file atomically
-        with atomicwrites.atomic_write(self._cfgFn, overwrite=True) as f:
-            f.write(buf)
+        # write file
+        with atomicwrites.atomic_write(self._cfgFile, overwrite=True) as f:
+            json.dump(dataObj, f)
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import html
+import json
+import signal
+import socket
+import asyncio
+import logging
+import logging.handlers
+import inotify_simple
+import urllib.parse
+import aiohttp.web
+from datetime import datetime
+from collections import OrderedDict
+
+
+class DirListing:
+
+    def __init__(self, urlPath):
+        self.urlPath = urlPath
+        self.wd = None                  # inotify watch descriptor, None if the directory is not watched
+        self.mtime = None               # mtime of the directory when rendered, checked if the directory is not watched
+        self.version = 0                # increased when invalidated, so that an outdated background rendering is discarded
+        self.html = None                # None if invalidated
+        self.json = None
+        self.future = None              # rendering in worker thread, shared by concurrent requests
+
+    @property
+    def size(self):
+        # memory accounted for this listing, in bytes
+        ret = DirListingCache.ITEM_OVERHEAD
+        if self.html is not None:
+            ret += len(self.html) + len(self.json)
+        return ret
+
+
+class DirListingCache:
+
+    """
+    Pre-rendered HTML and JSON directory listings, keyed by real path.
+    The directory of a listing is watched by inotify, a listing is invalidated when an entry of the
+    directory changes, and it is rendered again on next request or by regenerate(). If the directory
+    can't be watched (inotify watch limit reached), the modification time is checked on every request.
+    Listings are rendered in worker threads so that the event loop is not blocked by large directories,
+    the cache is bounded by the total size of the rendered listings.
+    """
+
+    MAX_BYTES = 64 * 1024 * 1024
+    ITEM_OVERHEAD = 1024                # bytes, accounted for each listing besides the rendered content
+    WATCH_FLAGS = inotify_simple.flags.CREATE | inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MOVED_TO | inotify_simple.flags.ATTRIB | inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.DELETE_SELF | inotify_simple.flags.MOVE_SELF
+
+    def __init__(self):
+        self._cacheDict = OrderedDict()            # OrderedDict<real-path,DirListing>, LRU order
+        self._wdDict = dict()                      # dict<watch-descriptor,real-path>
+        self._totalBytes = 0
+        self._inotify = None
+
+    def start(self, loop):
+        self._inotify = inotify_simple.INotify()
+        loop.add_reader(self._inotify.fileno(), self._onInotify)
+
+    async def getHtml(self, realPath, urlPath):
+        return (await self._get(realPath, urlPath))[1]
+
+    async def getJson(self, realPath, urlPath):
+        return (await self._get(realPath, urlPath))[2]
+
+    def clear(self):
+        for realPath in list(self._cacheDict.keys()):
+            self._remove(realPath)
+
+    async def regenerate(self, dirPath):
+        # render invalidated listings of the directories in dirPath
+        for realPath, item in list(self._cacheDict.items()):
+            if item.html is not None:
+                continue
+            if realPath != dirPath and not realPath.startswith(dirPath + "/"):
+                continue
+            try:
+                await asyncio.shield(self._getRenderFuture(realPath, item))
+            except OSError:
+                continue
+
+    async def _get(self, realPath, urlPath):
+        # returns (mtime,html,json)
+        item = self._cacheDict.get(realPath)
+        if item is None:
+            item = DirListing(urlPath)
+            self._cacheDict[realPath] = item
+            self._totalBytes += item.size
+            try:
+                item.wd = self._inotify.add_watch(realPath, self.WATCH_FLAGS)
+                self._wdDict[item.wd] = realPath
+            except OSError:
+                pass
+            self._shrink(realPath)
+        else:
+            self._cacheDict.move_to_end(realPath)
+            if item.wd is None and item.html is not None and item.mtime != os.stat(realPath).st_mtime_ns:
+                self._invalidate(item)
+
+        if item.html is not None:
+            return (item.mtime, item.html, item.json)
+        return await asyncio.shield(self._getRenderFuture(realPath, item))
+
+    def _getRenderFuture(self, realPath, item):
+        if item.future is None:
+            item.future = asyncio.ensure_future(self._renderItem(realPath, item))
+        return item.future
+
+    async def _renderItem(self, realPath, item):
+        version = item.version
+        try:
+            ret = await asyncio.get_running_loop().run_in_executor(None, self._render, realPath, item.urlPath)
+        finally:
+            item.future = None
+
+        # the result is still returned to the waiting requests if the listing is removed or invalidated meanwhile
+        if self._cacheDict.get(realPath) is item and item.version == version:
+            self._totalBytes -= item.size
+            item.mtime, item.html, item.json = ret
+            self._totalBytes += item.size
+            self._shrink(realPath)
+        return ret
+
+    def _shrink(self, currentRealPath):
+        # remove least recently used listings, except the current one
+        while self._totalBytes > self.MAX_BYTES and len(self._cacheDict) > 1:
+            realPath = next(iter(self._cacheDict))
+            if realPath == currentRealPath:
+                self._cacheDict.move_to_end(realPath)
+                continue
+            self._remove(realPath)
+
+    def _remove(self, realPath):
+        item = self._cacheDict.pop(realPath)
+        self._totalBytes -= item.size
+        if item.wd is not None:
+            del self._wdDict[item.wd]
+            try:
+                self._inotify.rm_watch(item.wd)
+            except OSError:
+                pass                # watch is removed automatically when the directory is deleted
+
+    def _invalidate(self, item):
+        self._totalBytes -= item.size
+        item.version += 1
+        item.html = None
+        item.json = None
+        self._totalBytes += item.size
+
+    def _onInotify(self):
+        for event in self._inotify.read(timeout=0):
+            if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                for item in self._cacheDict.values():
+                    self._invalidate(item)
+                continue
+            realPath = self._wdDict.get(event.wd)
+            if realPath is None:
+                continue
+            if event.mask & inotify_simple.flags.IGNORED:
+                del self._wdDict[event.wd]
+                self._cacheDict[realPath].wd = None
+                self._remove(realPath)
+                continue
+            self._invalidate(self._cacheDict[realPath])
+
+    @classmethod
+    def _render(cls, realPath, urlPath):
+        mtime = os.stat(realPath).st_mtime_ns
+        entryList = cls._listDir(realPath)
+        return (mtime, cls.render(urlPath, entryList), cls.renderJson(entryList))
+
+    @staticmethod
+    def _listDir(realPath):
+        # returns list<(name,is-dir,size,mtime)>
+        ret = []
+        with os.scandir(realPath) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue            # broken symlink
+                bDir = entry.is_dir()
+                ret.append((entry.name, bDir, (0 if bDir else st.st_size), st.st_mtime))
+        ret.sort(key=lambda x: (not x[1], x[0]))
+        return ret
+
+    @staticmethod
+    def renderJson(entryList):
+        ret = []
+        for name, bDir, size, mtime in entryList:
+            ret.append({
+                "name": name,
+                "type": "directory" if bDir else "file",
+                "size": size,
+                "mtime": int(mtime),
+            })
+        return json.dumps(ret).encode("utf-8")
+
+    @staticmethod
+    def render(urlPath, entryList):
+        title = html.escape("Index of " + urlPath)
+        buf = ""
+        buf += "<!DOCTYPE html>\n"
+        buf += "<html>\n"
+        buf += "<head><meta charset=\"utf-8\"><title>%s</title></head>\n" % (title)
+        buf += "<body>\n"
+        buf += "<h1>%s</h1>\n" % (title)
+        buf += "<table>\n"
+        buf += "<tr><th>Name</th><th>Last modified</th><th>Size</th></tr>\n"
+        if urlPath != "/":
+            buf += "<tr><td><a href=\"../\">../</a></td><td></td><td></td></tr>\n"
+        for name, bDir, size, mtime in entryList:
+            if bDir:
+                name += "/"
+            mtimeStr = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M") if mtime > 0 else ""
+            sizeStr = "-" if bDir else str(size)
+            buf += "<tr><td><a href=\"%s\">%s</a></td><td>%s</td><td>%s</td></tr>\n" % (urllib.parse.quote(name), html.escape(name), mtimeStr, sizeStr)
+        buf += "</table>\n"
+        buf += "</body>\n"
+        buf += "</html>\n"
+        return buf.encode("utf-8")
+
+
+async def requestHandler(request):
+    global cfg
+    global dirListingCache
+
+    # normalize path, reject paths going out of the virtual root directory
+    path = request.path
+    tl = [x for x in path.split("/") if x not in ["", "."]]
+    if ".." in tl:
+        raise aiohttp.web.HTTPForbidden()
+
+    # virtual root directory
+    if len(tl) == 0:
+        entryList = [(x, True, 0, 0) for x in sorted(cfg["dirmap"].keys())]
+        if request.query.get("format") == "json":
+            return aiohttp.web.Response(body=DirListingCache.renderJson(entryList), content_type="application/json")
+        return aiohttp.web.Response(body=DirListingCache.render("/", entryList), content_type="text/html")
+
+    # virtual site directory and files in it
+    if tl[0] not in cfg["dirmap"]:
+        raise aiohttp.web.HTTPNotFound()
+    siteRealPath = cfg["dirmap"][tl[0]]
+    realPath = os.path.realpath(os.path.join(siteRealPath, *tl[1:]))
+    if realPath != siteRealPath and not realPath.startswith(siteRealPath + "/"):
+        raise aiohttp.web.HTTPForbidden()
+
+    if os.path.isdir(realPath):
+        if not path.endswith("/"):
+            raise aiohttp.web.HTTPMovedPermanently(path + "/")
+        try:
+            if request.query.get("format") == "json":
+                return aiohttp.web.Response(body=await dirListingCache.getJson(realPath, path), content_type="application/json")
+            return aiohttp.web.Response(body=await dirListingCache.getHtml(realPath, path), content_type="text/html")
+        except OSError:
+            raise aiohttp.web.HTTPForbidden()
+
+    if os.path.isfile(realPath):
+        # FileResponse uses sendfile, and deals with Range, If-Modified-Since, If-None-Match
+        return aiohttp.web.FileResponse(realPath)
+
+    raise aiohttp.web.HTTPNotFound()
+
+
+def refreshCfgFromCfgFile():
+    global cfgFile
+    global cfg
+    global dirListingCache
+
+    with open(cfgFile, "r") as f:
+        buf = f.read()
+        if buf == "":
+            raise Exception("no content in config file")
+        dataObj = json.loads(buf)
+
+        if "logFile" not in dataObj:
+            raise Exception("no \"logFile\" in config file")
+        if "ip" not in dataObj:
+            raise Exception("no \"ip\" in config file")
+        if "port" not in dataObj:
+            raise Exception("no \"port\" in config file")
+        if "dirmap" not in dataObj:
+            raise Exception("no \"dirmap\" in config file")
+        for key, value in dataObj["dirmap"].items():
+            if not os.path.isabs(value) or value.endswith("/"):
+                raise Exception("value of \"%s\" in \"dirmap\" is invalid" % (key))
+
+        if "logFile" not in cfg:
+            cfg["logFile"] = dataObj["logFile"]                     # cfg["logFile"] is not changable
+        if "ip" not in cfg:
+            cfg["ip"] = dataObj["ip"]                               # cfg["ip"] is not changable
+        if "port" not in cfg:
+            cfg["port"] = dataObj["port"]                           # cfg["port"] is not changable
+        if "listenFd" not in cfg:
+            cfg["listenFd"] = dataObj.get("listenFd")               # cfg["listenFd"] is not changable, listening socket inherited from the daemon
+        if "dirmap" in cfg:
+            # sites are only added, listings of the removed sites are not reachable anymore
+            for key, value in cfg["dirmap"].items():
+                if dataObj["dirmap"].get(key) is None or os.path.realpath(dataObj["dirmap"][key]) != value:
+                    dirListingCache.clear()
+                    break
+        cfg["dirmap"] = {k: os.path.realpath(v) for k, v in dataObj["dirmap"].items()}
+
+        # generation of a site is increased after the site is updated, regenerate its invalidated listings
+        generationDict = dataObj.get("generation", dict())
+        if "generation" in cfg:
+            for key, value in generationDict.items():
+                if key in cfg["dirmap"] and cfg["generation"].get(key) != value:
+                    asyncio.ensure_future(dirListingCache.regenerate(cfg["dirmap"][key]))
+        cfg["generation"] = generationDict
+
+
+def runServer():
+    global cfg
+
+    log = logging.getLogger("aiohttp.access")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.handlers.RotatingFileHandler(cfg["logFile"], 10 * 1024 * 1024, 2))
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/{path:.*}", requestHandler, allow_head=True)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGUSR1, refreshCfgFromCfgFile)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])     # blocked by the daemon until the handler is installed
+    dirListingCache.start(loop)
+    if cfg["listenFd"] is not None:
+        aiohttp.web.run_app(app, sock=socket.socket(fileno=cfg["listenFd"]), access_log=log, print=None, handle_signals=False, loop=loop)
+    else:
+        aiohttp.web.run_app(app, host=cfg["ip"], port=cfg["port"], access_log=log, print=None, handle_signals=False, loop=loop)
+
+
+if __name__ == "__main__":
+    cfgFile = sys.argv[1]
+    cfg = dict()
+    dirListingCache = DirListingCache()
+    refreshCfgFromCfgFile()
+    runServer()
@@ -2,13 +2,36 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import json
+import uuid
+import fcntl
+import signal
+import struct
+import asyncio
 import logging
+import lxml.etree
 import subprocess
+import atomicwrites
 from mc_util import McUtil
+from gi.repository import GLib
 
 
 class Advertiser:
 
+    """
+    kiwix-serve does not support reloading library.xml, so the public port is owned by relay.py, which
+    forwards connections to the current kiwix-serve. When a mirror site is advertised, a new kiwix-serve
+    is started on a fresh port, the relay is switched to it, and the old kiwix-serve is stopped after
+    the connections to it are closed. The relay counts the connections of each kiwix-serve, and reports
+    "idle PORT" lines on its stdout when an old kiwix-serve has no connection anymore.
+    A new kiwix-serve is waited for on the asyncio event loop, the traffic keeps going to the current
+    kiwix-serve until the new one is ready.
+    """
+
+    DRAIN_TIMEOUT = 300                 # seconds
+
+    ZIM_MAGIC_NUMBER = 72173914
+
     @staticmethod
     def get_properties():
         return {
@@ -16,31 +39,72 @@ class Advertiser:
         }
 
     def __init__(self, param):
+        self._relayExecFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "relay.py")
         self._tmpDir = param["temp-directory"]
         self._libraryFile = os.path.join(self._tmpDir, "library.xml")
+        self._relayCfgFile = os.path.join(self._tmpDir, "relay.cfg")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
+        self._sock = None
         self._port = None
-        self._proc = None
+        self._relayProc = None
+        self._backendPort = None
+        self._backendProc = None
+        self._oldBackendDict = dict()               # dict<port,(proc,timeout-source-id)>, draining kiwix-serve processes
+        self._newBackendDict = dict()               # dict<port,proc>, starting kiwix-serve processes
+        self._backendSeq = 0                        # sequence number of the last started kiwix-serve
+        self._switchedBackendSeq = 0                # sequence number of the kiwix-serve which the relay forwards to
+        self._relayWatch = None
+        self._relayBuf = b""
+        self._bookCache = dict()                    # dict<zim-file,(mtime,book-attributes)>
         self._advertisedMirrorSiteIdList = []
         try:
             self._generateLibraryXml()
-            self._port = McUtil.getFreeSocketPort("tcp")
-            self._proc = self._startProc()
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+            self._backendPort, self._backendProc = self._startBackend()
+            self._sock = self._portAllocator.allocateListenSocket("advertiser-kiwix", self._listenIp)
+            self._port = self._sock.getsockname()[1]
+            self._generateRelayCfgFile()
+            # SIGUSR1 is blocked until the child process has installed its handler, so that an early reload request is kept pending instead of killing it
+            self._relayProc = subprocess.Popen([self._relayExecFile, self._relayCfgFile], pass_fds=[self._sock.fileno()],
+                                               stdout=subprocess.PIPE, bufsize=0, cwd=self._tmpDir,
+                                               preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1]))
+            fcntl.fcntl(self._relayProc.stdout, fcntl.F_SETFL, fcntl.fcntl(self._relayProc.stdout, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._relayWatch = GLib.io_add_watch(self._relayProc.stdout, GLib.IO_IN | GLib.IO_HUP, self._relayStdoutCallback)
             logging.info("Advertiser (kiwix) started, listening on port %d." % (self._port))
         except Exception:
             self.dispose()
             raise
 
     def dispose(self):
-        if self._proc is not None:
-            self._proc.terminate()
-            self._proc.wait()
-            self._proc = None
+        if self._relayWatch is not None:
+            GLib.source_remove(self._relayWatch)
+            self._relayWatch = None
+        if self._relayProc is not None:
+            self._relayProc.terminate()
+            self._relayProc.wait()
+            self._relayProc.stdout.close()
+            self._relayProc = None
+        for port in list(self._oldBackendDict.keys()):
+            self._stopOldBackend(port)
+        for port, proc in list(self._newBackendDict.items()):
+            del self._newBackendDict[port]
+            self._stopBackend(port, proc)
+        if self._backendProc is not None:
+            self._backendProc.terminate()
+            self._backendProc.wait()
+            self._backendProc = None
+        if self._backendPort is not None:
+            self._portAllocator.releasePort(self._backendPort)
+            self._backendPort = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
+        McUtil.forceDelete(self._relayCfgFile)
         McUtil.forceDelete(self._libraryFile)
 
     def get_access_info(self, mirror_site_id):
@@ -54,35 +118,158 @@ class Advertiser:
         assert mirror_site_id in self._mirrorSiteDict
         self._advertisedMirrorSiteIdList.append(mirror_site_id)
 
-        # restart kiwix-serve
-        # ugly, kiwix-serve does not support reload library.xml by signal
-        self._proc.terminate()
-        self._proc.wait()
+        # start a new kiwix-serve, traffic is switched to it when it is ready
         self._generateLibraryXml()
-        self._proc = self._startProc()
-        McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+        self._backendSeq += 1
+        port, proc = self._spawnBackend()
+        self._newBackendDict[port] = proc
+        asyncio.ensure_future(self._switchBackend(self._backendSeq, port, proc))
+
+    def _startBackend(self):
+        # called in __init__(), before the main loop runs, so it waits in a blocking way
+        port, proc = self._spawnBackend()
+        try:
+            readyTime = McUtil.waitSocketPortForProc("tcp", "127.0.0.1", port, proc)
+            logging.debug("Advertiser (kiwix): kiwix-serve on port %d ready in %.2f seconds." % (port, readyTime))
+        except Exception:
+            self._stopBackend(port, proc)
+            raise
+        return (port, proc)
+
+    def _spawnBackend(self):
+        port = self._portAllocator.allocatePort(None)           # backend ports are transient
+        try:
+            proc = subprocess.Popen([
+                "/usr/bin/kiwix-serve",
+                "--library",
+                "--address=127.0.0.1",
+                "--port=%d" % (port),
+                self._libraryFile,
+            ], stderr=subprocess.STDOUT, cwd=self._tmpDir)
+        except Exception:
+            self._portAllocator.releasePort(port)
+            raise
+        return (port, proc)
+
+    def _stopBackend(self, port, proc):
+        proc.terminate()
+        proc.wait()
+        self._portAllocator.releasePort(port)
+
+    async def _switchBackend(self, seq, port, proc):
+        try:
+            readyTime = await McUtil.waitSocketPortForProcAsync("tcp", "127.0.0.1", port, proc)
+        except Exception as e:
+            if port in self._newBackendDict:
+                del self._newBackendDict[port]
+                logging.error("Advertiser (kiwix): kiwix-serve on port %d failed to start, %s." % (port, e))
+                self._stopBackend(port, proc)
+            return
+        if port not in self._newBackendDict:
+            return                                              # disposed
+        del self._newBackendDict[port]
+        logging.debug("Advertiser (kiwix): kiwix-serve on port %d ready in %.2f seconds." % (port, readyTime))
+
+        if seq < self._switchedBackendSeq:
+            # a kiwix-serve started later (with a newer library) is already in use
+            self._stopBackend(port, proc)
+            return
+
+        # the old kiwix-serve is stopped when the relay reports it idle, or after DRAIN_TIMEOUT
+        timeoutId = GLib.timeout_add_seconds(self.DRAIN_TIMEOUT, self._drainTimeoutCallback, self._backendPort)
+        self._oldBackendDict[self._backendPort] = (self._backendProc, timeoutId)
+        self._backendPort, self._backendProc = port, proc
+        self._switchedBackendSeq = seq
+        self._generateRelayCfgFile()
+        os.kill(self._relayProc.pid, signal.SIGUSR1)
+
+    def _relayStdoutCallback(self, source, cb_condition):
+        buf = source.read()
+        if buf is None:
+            return True
+        if buf == b"":
+            # relay exited
+            self._relayWatch = None
+            return False
+
+        self._relayBuf += buf
+        lineList = self._relayBuf.split(b"\n")
+        self._relayBuf = lineList.pop()
+        for line in lineList:
+            if line.startswith(b"idle "):
+                port = int(line[len(b"idle "):])
+                if port in self._oldBackendDict:
+                    self._stopOldBackend(port)
+        return True
+
+    def _drainTimeoutCallback(self, port):
+        if port in self._oldBackendDict:
+            proc, timeoutId = self._oldBackendDict[port]
+            self._oldBackendDict[port] = (proc, None)           # this source is removed by returning False
+            self._stopOldBackend(port)
+        return False
+
+    def _stopOldBackend(self, port):
+        proc, timeoutId = self._oldBackendDict.pop(port)
+        if timeoutId is not None:
+            GLib.source_remove(timeoutId)
+        self._stopBackend(port, proc)
+
+    def _generateRelayCfgFile(self):
+        # generate file content
+        dataObj = dict()
+        dataObj["ip"] = self._listenIp
+        dataObj["port"] = self._port
+        dataObj["listenFd"] = self._sock.fileno()
+        dataObj["backendPort"] = self._backendPort
+
+        # write file
+        with atomicwrites.atomic_write(self._relayCfgFile, overwrite=True) as f:
+            json.dump(dataObj, f)
 
     def _generateLibraryXml(self):
-        with open(self._libraryFile, "w") as f:
-            f.write("")
-        bProcessed = False
+        # book entries are written directly instead of calling kiwix-manage for each ZIM file,
+        # kiwix-serve reads the other metadata from the ZIM files
+        rootElem = lxml.etree.Element("library", version="20110515")
+        zimFileSet = set()
         for msId in self._advertisedMirrorSiteIdList:
             buf = McUtil.readFile(os.path.join(self._mirrorSiteDict[msId]["state-directory"], "library.list"))
             for line in buf.split("\n"):
                 line = line.strip()
                 if line == "" or line.startswith("#"):
                     continue
-                McUtil.cmdCall("/usr/bin/kiwix-manage", self._libraryFile, "add", line)
-                bProcessed = True
-        if not bProcessed:
-            # so that the library file is legal
-            McUtil.cmdCall("/usr/bin/kiwix-manage", self._libraryFile, "add", "dummy")
-
-    def _startProc(self):
-        return subprocess.Popen([
-            "/usr/bin/kiwix-serve",
-            "--library",
-            "--address=%s" % (self._listenIp),
-            "--port=%d" % (self._port),
-            self._libraryFile,
-        ], stderr=subprocess.STDOUT, cwd=self._tmpDir)
+                zimFile = os.path.abspath(line)
+                if zimFile in zimFileSet:
+                    continue
+                zimFileSet.add(zimFile)
+                lxml.etree.SubElement(rootElem, "book", self._getBookAttributes(zimFile))
+
+        # ZIM files which are not used anymore
+        for zimFile in list(self._bookCache.keys()):
+            if zimFile not in zimFileSet:
+                del self._bookCache[zimFile]
+
+        with atomicwrites.atomic_write(self._libraryFile, mode="wb", overwrite=True) as f:
+            f.write(lxml.etree.tostring(rootElem, pretty_print=True, xml_declaration=True, encoding="UTF-8"))
+
+    def _getBookAttributes(self, zimFile):
+        st = os.stat(zimFile)
+        if zimFile in self._bookCache and self._bookCache[zimFile][0] == st.st_mtime_ns:
+            return self._bookCache[zimFile][1]
+
+        # ZIM header: magic-number(uint32), major-version(uint16), minor-version(uint16), uuid(16 bytes), ...
+        with open(zimFile, "rb") as f:
+            buf = f.read(24)
+        if len(buf) < 24:
+            raise Exception("invalid ZIM file %s" % (zimFile))
+        magicNumber, majorVersion, minorVersion, uuidBytes = struct.unpack("<IHH16s", buf)
+        if magicNumber != self.ZIM_MAGIC_NUMBER:
+            raise Exception("invalid ZIM file %s" % (zimFile))
+
+        ret = {
+            "id": str(uuid.UUID(bytes=uuidBytes)),
+            "path": zimFile,
+            "size": str(st.st_size // 1024),            # in KB, same as kiwix-manage
+        }
+        self._bookCache[zimFile] = (st.st_mtime_ns, ret)
+        return ret
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import json
+import signal
+import socket
+import asyncio
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            buf = await reader.read(64 * 1024)
+            if buf == b"":
+                break
+            writer.write(buf)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except ConnectionError:
+        pass
+
+
+def reportIdle(backendPort):
+    # tells the advertiser that an old backend has no connection anymore, one line per report
+    os.write(sys.stdout.fileno(), b"idle %d\n" % (backendPort))
+
+
+async def clientHandler(reader, writer):
+    global cfg
+    global connCountDict
+
+    # the backend is selected when the connection is accepted, so in-flight connections stay on the old backend after switching
+    backendPort = cfg["backendPort"]
+    connCountDict[backendPort] = connCountDict.get(backendPort, 0) + 1
+    try:
+        try:
+            backendReader, backendWriter = await asyncio.open_connection("127.0.0.1", backendPort)
+        except OSError:
+            writer.close()
+            return
+
+        try:
+            await asyncio.gather(pipe(reader, backendWriter), pipe(backendReader, writer))
+        finally:
+            backendWriter.close()
+            writer.close()
+    finally:
+        connCountDict[backendPort] -= 1
+        if connCountDict[backendPort] == 0:
+            del connCountDict[backendPort]
+            if backendPort != cfg["backendPort"]:
+                reportIdle(backendPort)
+
+
+def refreshCfgFromCfgFile():
+    global cfgFile
+    global cfg
+    global connCountDict
+
+    with open(cfgFile, "r") as f:
+        buf = f.read()
+        if buf == "":
+            raise Exception("no content in config file")
+        dataObj = json.loads(buf)
+
+        if "ip" not in dataObj:
+            raise Exception("no \"ip\" in config file")
+        if "port" not in dataObj:
+            raise Exception("no \"port\" in config file")
+        if "backendPort" not in dataObj:
+            raise Exception("no \"backendPort\" in config file")
+
+        if "ip" not in cfg:
+            cfg["ip"] = dataObj["ip"]                               # cfg["ip"] is not changable
+        if "port" not in cfg:
+            cfg["port"] = dataObj["port"]                           # cfg["port"] is not changable
+        if "listenFd" not in cfg:
+            cfg["listenFd"] = dataObj.get("listenFd")               # cfg["listenFd"] is not changable, listening socket inherited from the daemon
+        oldBackendPort = cfg.get("backendPort")
+        cfg["backendPort"] = dataObj["backendPort"]
+        if oldBackendPort is not None and oldBackendPort != cfg["backendPort"] and oldBackendPort not in connCountDict:
+            reportIdle(oldBackendPort)
+
+
+def runServer():
+    global cfg
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGUSR1, refreshCfgFromCfgFile)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])     # blocked by the daemon until the handler is installed
+    if cfg["listenFd"] is not None:
+        loop.run_until_complete(asyncio.start_server(clientHandler, sock=socket.socket(fileno=cfg["listenFd"])))
+    else:
+        loop.run_until_complete(asyncio.start_server(clientHandler, cfg["ip"], cfg["port"]))
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    cfgFile = sys.argv[1]
+    cfg = dict()
+    connCountDict = dict()                  # dict<backend-port,connection-count>
+    refreshCfgFromCfgFile()
+    runServer()
@@ -2,11 +2,14 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import json
 import signal
 import logging
 import subprocess
 import atomicwrites
+import inotify_simple
 from mc_util import McUtil
+from gi.repository import GLib
 
 
 class Advertiser:
@@ -28,18 +31,21 @@ class Advertiser:
         self._errorLogFile = os.path.join(self._logDir, "error.log")
         self._accessLogFile = os.path.join(self._logDir, "access.log")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
         self._port = None
         self._proc = None
+        self._watcher = None
         self._advertisedMirrorSiteIdList = []
         try:
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._watcher = _NamespaceWatcher()
+            self._port = self._portAllocator.allocatePort("advertiser-klaus")
             self._generateVirtualRootDir()
             self._generateCfgFn()
             self._proc = subprocess.Popen(["/usr/sbin/apache2", "-f", self._cfgFn, "-DFOREGROUND"], cwd=self._virtRootDir)
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
-            logging.info("Advertiser (klaus) started, listening on port %d." % (self._port))
+            readyTime = McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+            logging.info("Advertiser (klaus) started, listening on port %d, ready in %.2f seconds." % (self._port, readyTime))
         except Exception:
             self.dispose()
             raise
@@ -50,7 +56,11 @@ class Advertiser:
             self._proc.wait()
             self._proc = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
+        if self._watcher is not None:
+            self._watcher.dispose()
+            self._watcher = None
         McUtil.forceDelete(self._virtRootDir)
 
     def get_access_info(self, mirror_site_id):
@@ -63,6 +73,7 @@ class Advertiser:
     def advertise_mirror_site(self, mirror_site_id):
         assert mirror_site_id in self._mirrorSiteDict
         self._advertisedMirrorSiteIdList.append(mirror_site_id)
+        self._watcher.addSite(mirror_site_id, self._mirrorSiteDict[mirror_site_id]["storage-param"]["file"]["data-directory"], self.__namespaceFn(mirror_site_id))
         self._generateVirtualRootDir()
         self._generateCfgFn()
         os.kill(self._proc.pid, signal.SIGUSR1)
@@ -75,12 +86,11 @@ class Advertiser:
             McUtil.ensureDir(os.path.join(self._virtRootDir, msId))
 
             # create wsgi script
-            realPath = self._mirrorSiteDict[msId]["storage-param"]["file"]["data-directory"]
             srcBuf = McUtil.readFile(self._wsgiFile)
             with open(self.__wsgiFn(msId), "w") as f:
                 buf = srcBuf
                 buf += '\n'
-                buf += 'application = make_autoreloading_app("%s", "%s",\n' % (realPath, msId)
+                buf += 'application = make_autoreloading_app("%s", "%s",\n' % (self.__namespaceFn(msId), msId)
                 buf += '                                     use_smarthttp=True,\n'
                 buf += '                                     disable_push=True)\n'
                 f.write(buf)
@@ -121,3 +131,126 @@ class Advertiser:
 
     def __wsgiFn(self, msId):
         return os.path.join(self._tmpDir, "wsgi-%s.py" % (msId))
+
+    def __namespaceFn(self, msId):
+        return os.path.join(self._tmpDir, "namespace-%s.json" % (msId))
+
+
+class _NamespaceWatcher:
+
+    """
+    Maintains the repository namespace dict of each advertised mirror site by inotify, and writes it
+    to a json file which is read by wsgi_autoreloading.py in all the apache workers.
+    Only the data directory and its direct sub-directories are watched:
+      data-directory
+        |---- repository (contains .git)            -> namespace None
+        |---- namespace-directory                   -> namespace "namespace-directory"
+                |---- repository
+                |---- ...
+    A mirror site is re-scanned periodically if it can't be watched (inotify watch limit reached).
+    """
+
+    WATCH_FLAGS = inotify_simple.flags.CREATE | inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MOVED_TO | inotify_simple.flags.DELETE_SELF | inotify_simple.flags.MOVE_SELF
+    RESCAN_INTERVAL = 60                # seconds
+
+    def __init__(self):
+        self._siteDict = dict()                 # dict<mirror-site-id,(data-directory,namespace-file)>
+        self._entryDict = dict()                # dict<mirror-site-id,dict<entry-name,list<repository-path>|None>>, None means entry is a repository
+        self._wdDict = dict()                   # dict<watch-descriptor,(mirror-site-id,entry-name)>, entry-name is None for data directory
+        self._unwatchedSiteSet = set()
+        self._inotify = inotify_simple.INotify()
+        self._ioWatch = GLib.io_add_watch(self._inotify.fileno(), GLib.IO_IN, self._onInotify)
+        self._rescanTimer = GLib.timeout_add_seconds(self.RESCAN_INTERVAL, self._onRescanTimer)
+
+    def dispose(self):
+        GLib.source_remove(self._rescanTimer)
+        GLib.source_remove(self._ioWatch)
+        self._inotify.close()
+
+    def addSite(self, msId, dataDir, namespaceFile):
+        self._siteDict[msId] = (dataDir, namespaceFile)
+        self._scanSite(msId)
+        self._writeNamespaceFile(msId)
+
+    def _scanSite(self, msId):
+        dataDir = self._siteDict[msId][0]
+        self._entryDict[msId] = dict()
+        if not self._addWatch(msId, None, dataDir):
+            return
+        for fn in os.listdir(dataDir):
+            self._scanEntry(msId, fn)
+
+    def _scanEntry(self, msId, fn):
+        # same as glob(), hidden entries are ignored
+        if fn.startswith("."):
+            return
+        fullfn = os.path.join(self._siteDict[msId][0], fn)
+        if not os.path.isdir(fullfn):
+            self._entryDict[msId].pop(fn, None)
+            return
+        if not self._addWatch(msId, fn, fullfn):
+            return
+        if os.path.exists(os.path.join(fullfn, ".git")):
+            self._entryDict[msId][fn] = None
+        else:
+            self._entryDict[msId][fn] = sorted([os.path.join(fullfn, x) for x in os.listdir(fullfn) if not x.startswith(".")])
+
+    def _addWatch(self, msId, fn, fullfn):
+        # returns False if the directory does not exist
+        try:
+            wd = self._inotify.add_watch(fullfn, self.WATCH_FLAGS)
+        except FileNotFoundError:
+            if fn is not None:
+                self._entryDict[msId].pop(fn, None)
+            return False
+        except OSError:
+            if msId not in self._unwatchedSiteSet:
+                logging.warning("Advertiser (klaus): can not watch mirror site %s, it is re-scanned every %d seconds." % (msId, self.RESCAN_INTERVAL))
+                self._unwatchedSiteSet.add(msId)
+            return True
+        self._wdDict[wd] = (msId, fn)           # adding watch for the same directory again returns the same watch descriptor
+        return True
+
+    def _writeNamespaceFile(self, msId):
+        namespaceDict = dict()
+        for fn, value in self._entryDict[msId].items():
+            if value is None:
+                namespaceDict.setdefault("", []).append(os.path.join(self._siteDict[msId][0], fn))
+            else:
+                namespaceDict[fn] = value
+        for value in namespaceDict.values():
+            value.sort()
+
+        with atomicwrites.atomic_write(self._siteDict[msId][1], overwrite=True) as f:
+            json.dump({"namespaces": namespaceDict}, f)
+
+    def _onInotify(self, source, cb_condition):
+        changedSiteSet = set()
+        for event in self._inotify.read(timeout=0):
+            if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                for msId in self._siteDict:
+                    self._scanSite(msId)
+                    changedSiteSet.add(msId)
+                continue
+            if event.mask & inotify_simple.flags.IGNORED:
+                self._wdDict.pop(event.wd, None)
+                continue
+            if event.wd not in self._wdDict:
+                continue
+            msId, fn = self._wdDict[event.wd]
+            if fn is None:
+                if event.name != "":
+                    self._scanEntry(msId, event.name)       # entry in data directory is changed
+            else:
+                self._scanEntry(msId, fn)                   # entry in namespace directory or repository is changed
+            changedSiteSet.add(msId)
+
+        for msId in changedSiteSet:
+            self._writeNamespaceFile(msId)
+        return True
+
+    def _onRescanTimer(self):
+        for msId in self._unwatchedSiteSet:
+            self._scanSite(msId)
+            self._writeNamespaceFile(msId)
+        return True
@@ -2,65 +2,110 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
-import glob
+import json
 import time
+import klaus
 import threading
 from klaus import make_app
 
 
-# Shared state between poller and application wrapper
+# Shared state between application wrapper and namespace file checker
 class _S:
     #: the real WSGI app
     inner_app = None
-    should_reload = True
+    namespace_file = None
+    namespace_mtime = None
     namespace_dict = None
+    last_check = 0
+    lock = threading.Lock()
 
 
-def _get_namespace_dict(repos_root):
-    namespace_dict = dict()
-    for fullfn in glob.glob(repos_root + "/*"):
-        if os.path.exists(os.path.join(fullfn, ".git")):
-            if None not in namespace_dict:
-                namespace_dict[None] = []
-            namespace_dict[None].append(fullfn)
-        else:
-            fn = os.path.basename(fullfn)
-            namespace_dict[fn] = glob.glob(fullfn + "/*")
+# interval for checking the namespace file, in seconds
+CHECK_INTERVAL = 1
 
 
-def _poll_for_changes(interval, dir):
+def _load_repos(self, repo_paths):
     """
-    Polls `dir` for changes every `interval` seconds and sets `should_reload`
-    accordingly.
+    Replaces klaus.Klaus.load_repos, repositories of the unchanged namespaces are reused when reloading.
+    The cache is keyed by site name, so that it works when the scripts of several sites share one interpreter.
     """
-    while True:
-        time.sleep(interval)
-        if _S.should_reload:
-            # klaus application has not seen our change yet
-            continue
-        new_contents = _get_namespace_dict(dir)
-        if new_contents != _S.namespace_dict:
-            # Directory contents changed => should_reload
-            _S.namespace_dict = new_contents
-            _S.should_reload = True
-
-
-def make_autoreloading_app(repos_root, *args, **kwargs):
-    # Create namespace_dict
-    _S.namespace_dict = _get_namespace_dict(repos_root)
+    cache = self._repo_cache.setdefault(self.site_name, dict())         # dict<namespace,(paths,valid-repos,invalid-repos)>
+    valid_repos = []
+    invalid_repos = []
+    for namespace, paths in repo_paths.items():
+        item = cache.get(namespace)
+        if item is None or item[0] != paths:
+            item = (paths,) + tuple(self._orig_load_repos({namespace: paths}))
+            cache[namespace] = item
+        valid_repos += item[1]
+        invalid_repos += item[2]
+    for namespace in list(cache.keys()):
+        if namespace not in repo_paths:
+            del cache[namespace]
+    return valid_repos, invalid_repos
+
+
+if not hasattr(klaus.Klaus, "_orig_load_repos"):
+    klaus.Klaus._orig_load_repos = klaus.Klaus.load_repos
+    klaus.Klaus._repo_cache = dict()
+    klaus.Klaus.load_repos = _load_repos
+
+
+def _get_namespace_dict(namespace_file):
+    """
+    Reads the namespace dict maintained by the klaus advertiser, repositories without namespace
+    are stored with "" as key.
+    """
+    try:
+        with open(namespace_file, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return dict()
+    return {(k if k != "" else None): v for k, v in data["namespaces"].items()}
+
+
+def _get_mtime(namespace_file):
+    try:
+        return os.stat(namespace_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _check_for_changes():
+    """
+    Returns True if the namespace file is changed, the file is updated by the klaus advertiser
+    through inotify, so checking it only costs one stat() call.
+    """
+    now = time.monotonic()
+    if now - _S.last_check < CHECK_INTERVAL:
+        return False
+    _S.last_check = now
+
+    mtime = _get_mtime(_S.namespace_file)
+    if mtime == _S.namespace_mtime:
+        return False
+    _S.namespace_mtime = mtime
+    new_contents = _get_namespace_dict(_S.namespace_file)
+    if new_contents == _S.namespace_dict:
+        return False
+    _S.namespace_dict = new_contents
+    return True
+
+
+def make_autoreloading_app(namespace_file, *args, **kwargs):
+    # Read namespace_dict
+    _S.namespace_file = namespace_file
+    _S.namespace_mtime = _get_mtime(namespace_file)
+    _S.namespace_dict = _get_namespace_dict(namespace_file)
 
     # Define web request handler
     def app(environ, start_response):
-        if _S.should_reload:
-            # Refresh inner application with new repo list
-            print("Reloading repository list...")
-            _S.inner_app = make_app(_S.namespace_dict, *args, **kwargs)
-            _S.should_reload = False
-        return _S.inner_app(environ, start_response)
-
-    # Start a background thread that polls the directory for changes
-    poller_thread = threading.Thread(target=(lambda: _poll_for_changes(10, repos_root)))
-    poller_thread.daemon = True
-    poller_thread.start()
+        with _S.lock:
+            if _S.inner_app is None or _check_for_changes():
+                # Refresh inner application with new repo list, only the repositories in the changed namespaces are loaded
+                print("Reloading repository list...")
+                _S.inner_app = make_app(_S.namespace_dict, *args, **kwargs)
+            inner_app = _S.inner_app
+        return inner_app(environ, start_response)
 
     return app
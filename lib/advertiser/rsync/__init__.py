@@ -22,17 +22,18 @@ class Advertiser:
         self._lockFile = os.path.join(self._tmpDir, "rsyncd.lock")
         self._logFile = os.path.join(param["log-directory"], "rsyncd.log")
         self._listenIp = param["listen-ip"]
+        self._portAllocator = param["port-allocator"]
         self._mirrorSiteDict = param["mirror-sites"]
 
         self._port = None
         self._proc = None
         self._advertisedMirrorSiteIdList = []
         try:
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._port = self._portAllocator.allocatePort("advertiser-rsync")
             self._generateCfgFile()
             self._proc = subprocess.Popen(["/usr/bin/rsync", "-v", "--daemon", "--no-detach", "--config=%s" % (self._cfgFile)], cwd=self._tmpDir)
-            McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
-            logging.info("Advertiser (rsync) started, listening on port %d." % (self._port))
+            readyTime = McUtil.waitSocketPortForProc("tcp", self._listenIp, self._port, self._proc)
+            logging.info("Advertiser (rsync) started, listening on port %d, ready in %.2f seconds." % (self._port, readyTime))
         except Exception:
             self.dispose()
             raise
@@ -43,6 +44,7 @@ class Advertiser:
             self._proc.wait()
             self._proc = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
 
     def get_access_info(self, mirror_site_id):
@@ -2,7 +2,10 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import time
+import json
 import jinja2
+import asyncio
 import logging
 import logging.handlers
 import aiohttp
@@ -13,8 +16,17 @@ from mc_updater import McMirrorSiteUpdater
 
 class McMainAdvertiser:
 
+    EVENT_KEEPALIVE_INTERVAL = 30               # unit: seconds
+    EVENT_QUEUE_SIZE = 64                       # subscriber is dropped if it has so many events not sent
+
     def __init__(self, param):
         self.param = param
+        self._startId = "%x" % (int(time.time()))            # makes ETag unique among daemon runs
+        self._mirrorSiteCacheDict = dict()                    # dict<mirror-id,(state-version,mirror-site-entry)>
+        self._apiMirrorsCache = None                          # (state-version,etag,response-body)
+        self._eventSubscriberSet = set()                      # set<_EventSubscriber>
+        self._eventDirtySet = set()                           # set<mirror-id>, changed mirror sites not sent to subscribers yet
+        self._eventFlushHandle = None
         self.param.mainloop.run_until_complete(self._start())
 
     def dispose(self):
@@ -26,6 +38,7 @@ class McMainAdvertiser:
             if True:
                 self._app = aiohttp.web.Application(loop=self.param.mainloop)
                 self._app.router.add_route("GET", "/api/mirrors", self._apiMirrorsHandler)
+                self._app.router.add_route("GET", "/api/mirrors/events", self._apiMirrorsEventsHandler)
                 self._app.router.add_route("GET", "/", self._indexHandler)
             if True:
                 self._app.router.add_route("POST", "/api/mirror/{id}/update-now", self._apiMirrorsHandler)
@@ -46,6 +59,14 @@ class McMainAdvertiser:
             raise
 
     async def _stop(self):
+        if len(self._eventSubscriberSet) > 0:
+            for sub in self._eventSubscriberSet:
+                sub.task.cancel()
+            self._eventSubscriberSet = set()
+            self.param.updater.removeStateChangeListener(self._stateChangeListener)
+        if self._eventFlushHandle is not None:
+            self._eventFlushHandle.cancel()
+            self._eventFlushHandle = None
         if self._runner is not None:
             await self._runner.cleanup()
             self._runner = None
@@ -71,7 +92,41 @@ class McMainAdvertiser:
         return aiohttp_jinja2.render_template('index.jinja2', request, data)
 
     async def _apiMirrorsHandler(self, request):
-        return aiohttp.web.json_response(self.__getMirrorSiteDict())
+        ver, etag, body = self.__getApiMirrorsCache()
+        if self.__etagMatch(request.headers.get("If-None-Match"), etag):
+            return aiohttp.web.Response(status=304, headers={"ETag": etag})
+        return aiohttp.web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def _apiMirrorsEventsHandler(self, request):
+        # server-sent events, the first event is a "snapshot" containing all the mirror sites,
+        # then "update" events contain only the changed mirror sites, with the same format as /api/mirrors
+        response = aiohttp.web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+
+        ver, etag, body = self.__getApiMirrorsCache()
+        sub = _EventSubscriber()
+        if len(self._eventSubscriberSet) == 0:
+            self.param.updater.addStateChangeListener(self._stateChangeListener)
+        self._eventSubscriberSet.add(sub)
+        try:
+            await response.write(b"event: snapshot\nid: %d\ndata: " % (ver) + body + b"\n\n")
+            while True:
+                try:
+                    data = await asyncio.wait_for(sub.queue.get(), self.EVENT_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    data = b": keepalive\n\n"
+                await response.write(data)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            if sub in self._eventSubscriberSet:
+                self._eventSubscriberSet.remove(sub)
+                if len(self._eventSubscriberSet) == 0:
+                    self.param.updater.removeStateChangeListener(self._stateChangeListener)
+        return response
 
     async def _apiMirrorUpdateNow(self, request):
         mirrorSiteId = request.match_info["id"]
@@ -91,35 +146,112 @@ class McMainAdvertiser:
         except _WebException as e:
             return aiohttp.web.json_response({"message": e.message}, status=400)
 
-    def __getMirrorSiteDict(self):
+    def _stateChangeListener(self, mirrorSiteId):
+        # changes in one loop iteration are sent in one event
+        self._eventDirtySet.add(mirrorSiteId)
+        if self._eventFlushHandle is None:
+            self._eventFlushHandle = self.param.mainloop.call_soon(self._eventFlush)
+
+    def _eventFlush(self):
+        self._eventFlushHandle = None
+
+        # serialize once for all the subscribers
+        ret = self.__getMirrorSiteDict(self._eventDirtySet)
+        self._eventDirtySet = set()
+        if len(self._eventSubscriberSet) == 0:
+            return
+        data = b"event: update\nid: %d\ndata: " % (self.param.updater.getStateVersion()) + json.dumps(ret).encode("utf-8") + b"\n\n"
+
+        # drop subscribers which can't keep up
+        for sub in list(self._eventSubscriberSet):
+            try:
+                sub.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self._eventSubscriberSet.remove(sub)
+                sub.task.cancel()
+        if len(self._eventSubscriberSet) == 0:
+            self.param.updater.removeStateChangeListener(self._stateChangeListener)
+
+    def __getApiMirrorsCache(self):
+        ver = self.param.updater.getStateVersion()
+        if self._apiMirrorsCache is None or self._apiMirrorsCache[0] != ver:
+            etag = "\"%s-%d\"" % (self._startId, ver)
+            self._apiMirrorsCache = (ver, etag, json.dumps(self.__getMirrorSiteDict()).encode("utf-8"))
+        return self._apiMirrorsCache
+
+    def __getMirrorSiteDict(self, mirrorSiteIdList=None):
+        # entries are rebuilt only for the mirror sites whose update state has changed
+        if mirrorSiteIdList is None:
+            mirrorSiteIdList = self.param.mirrorSiteDict.keys()
         ret = dict()
-        for msId, msObj in self.param.mirrorSiteDict.items():
-            updateState = self.param.updater.getMirrorSiteUpdateState(msId)
-            if updateState["last_update_time"] is None:
-                updateState["last_update_time"] = ""
-            else:
-                updateState["last_update_time"] = updateState["last_update_time"].strftime("%Y-%m-%d %H:%M")
-            if updateState["next_update_time"] is None:
-                updateState["next_update_time"] = ""
-            else:
-                updateState["next_update_time"] = updateState["next_update_time"].strftime("%Y-%m-%d %H:%M")
-
-            ret[msId] = {
-                "update-status": updateState["update_status"],
-                "last-update-time": updateState["last_update_time"],
-                "next-update-time": updateState["next_update_time"],
-                "update-progress": updateState.get("update_progress", -1),
-                "help": {
-                    "title": "",
-                    "filename": "",
-                },
-            }
-            if self.param.updater.isMirrorSiteInitialized(msId):
-                ret[msId]["access"] = dict()
-                for key in msObj.advertiserDict:
-                    ret[msId]["access"][key] = self.param.advertiserDict[key].get_access_info(msId)
+        for msId in mirrorSiteIdList:
+            ver = self.param.updater.getMirrorSiteStateVersion(msId)
+            if msId not in self._mirrorSiteCacheDict or self._mirrorSiteCacheDict[msId][0] != ver:
+                self._mirrorSiteCacheDict[msId] = (ver, self.__getMirrorSiteEntry(msId))
+            ret[msId] = self._mirrorSiteCacheDict[msId][1]
         return ret
 
+    def __getMirrorSiteEntry(self, msId):
+        msObj = self.param.mirrorSiteDict[msId]
+        updateState = self.param.updater.getMirrorSiteUpdateState(msId)
+        if updateState["last_update_time"] is None:
+            updateState["last_update_time"] = ""
+        else:
+            updateState["last_update_time"] = updateState["last_update_time"].strftime("%Y-%m-%d %H:%M")
+        if updateState["next_update_time"] is None:
+            updateState["next_update_time"] = ""
+        else:
+            updateState["next_update_time"] = updateState["next_update_time"].strftime("%Y-%m-%d %H:%M")
+        if updateState["update_estimated_finish_time"] is None:
+            updateState["update_estimated_finish_time"] = ""
+        else:
+            updateState["update_estimated_finish_time"] = updateState["update_estimated_finish_time"].strftime("%Y-%m-%d %H:%M")
+        if updateState["update_estimated_duration"] is None:
+            updateState["update_estimated_duration"] = -1
+        else:
+            updateState["update_estimated_duration"] = int(updateState["update_estimated_duration"].total_seconds())
+
+        ret = {
+            "update-status": updateState["update_status"],
+            "last-update-time": updateState["last_update_time"],
+            "next-update-time": updateState["next_update_time"],
+            "update-progress": updateState.get("update_progress", -1),
+            "update-queue-position": updateState["update_queue_position"] if updateState["update_queue_position"] is not None else -1,
+            "update-statistics": updateState["update_statistics"],
+            "transfer-stats": updateState.get("transfer_stats", None),
+            "update-estimated-duration": updateState["update_estimated_duration"],
+            "update-estimated-finish-time": updateState["update_estimated_finish_time"],
+            "api-message-rate": round(updateState["api_message_rate"], 1) if updateState["api_message_rate"] is not None else -1,
+            "help": {
+                "title": "",
+                "filename": "",
+            },
+        }
+        if self.param.updater.isMirrorSiteInitialized(msId):
+            ret["access"] = dict()
+            for key in msObj.advertiserDict:
+                ret["access"][key] = self.param.advertiserDict[key].get_access_info(msId)
+        return ret
+
+    @staticmethod
+    def __etagMatch(ifNoneMatch, etag):
+        if ifNoneMatch is None:
+            return False
+        for item in ifNoneMatch.split(","):
+            item = item.strip()
+            if item.startswith("W/"):
+                item = item[2:]
+            if item == "*" or item == etag:
+                return True
+        return False
+
+
+class _EventSubscriber:
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.queue = asyncio.Queue(McMainAdvertiser.EVENT_QUEUE_SIZE)
+
 
 class _WebException(Exception):
     pass
@@ -13,6 +13,7 @@ import asyncio
 import asyncio_glib
 from gi.repository import GLib
 from mc_util import McUtil
+from mc_util import PortAllocator
 from mc_util import DropPriviledge
 from mc_util import StdoutRedirector
 from mc_util import AvahiServiceRegister
@@ -54,6 +55,9 @@ class McDaemon:
                     # write pid file
                     McUtil.writePidFile(McConst.pidFile)
 
+                    # create port allocator, storages and advertisers get their listening ports from it
+                    self.param.portAllocator = PortAllocator(McConst.portAllocationFile, *self.param.mainCfg["portRange"])
+
                     # load plugin, storage, advertiser
                     self.param.pluginManager = McPluginManager(self.param)
                     self.param.pluginManager.loadEnabledPlugins()
@@ -122,7 +126,31 @@ class McDaemon:
         if "mainPort" in dataObj:
             self.param.mainPort = dataObj["mainPort"]
         if "preferedUpdatePeriodList" in dataObj:
+            for item in dataObj["preferedUpdatePeriodList"]:
+                if "start" not in item or "time" not in item:
+                    raise Exception("invalid item in \"preferedUpdatePeriodList\" in main config file")
+                if not isinstance(item["time"], (int, float)) or item["time"] <= 0:
+                    raise Exception("invalid \"time\" in \"preferedUpdatePeriodList\" in main config file")
             self.param.mainCfg["preferedUpdatePeriodList"] = dataObj["preferedUpdatePeriodList"]
+        if "maxConcurrentUpdaters" in dataObj:
+            if not isinstance(dataObj["maxConcurrentUpdaters"], int) or dataObj["maxConcurrentUpdaters"] <= 0:
+                raise Exception("invalid \"maxConcurrentUpdaters\" in main config file")
+            self.param.mainCfg["maxConcurrentUpdaters"] = dataObj["maxConcurrentUpdaters"]
+        if "maxConcurrentUpdatersPerResource" in dataObj:
+            for key, value in dataObj["maxConcurrentUpdatersPerResource"].items():
+                if not isinstance(value, int) or value <= 0:
+                    raise Exception("invalid value of \"%s\" in \"maxConcurrentUpdatersPerResource\" in main config file" % (key))
+            self.param.mainCfg["maxConcurrentUpdatersPerResource"] = dataObj["maxConcurrentUpdatersPerResource"]
+        if "cronSpreadWindow" in dataObj:
+            if not isinstance(dataObj["cronSpreadWindow"], int) or dataObj["cronSpreadWindow"] < 0:
+                raise Exception("invalid \"cronSpreadWindow\" in main config file")
+            self.param.mainCfg["cronSpreadWindow"] = dataObj["cronSpreadWindow"]
+        if "portRange" in dataObj:
+            if not isinstance(dataObj["portRange"], list) or len(dataObj["portRange"]) != 2:
+                raise Exception("invalid \"portRange\" in main config file")
+            if not (0 < dataObj["portRange"][0] < dataObj["portRange"][1] <= 65536):
+                raise Exception("invalid \"portRange\" in main config file")
+            self.param.mainCfg["portRange"] = dataObj["portRange"]
         if "country" in dataObj:
             self.param.mainCfg["country"] = dataObj["country"]
         if "location" in dataObj:
@@ -22,6 +22,7 @@ class McConst:
 
     rotateLogFileSize = 10 * 1024 * 1024
     rotateLogFileCount = 2
+    rotateLogFileCompress = False       # compress the rotated updater log files by gzip
 
     user = "mirrors"
     group = "mirrors"
@@ -30,6 +31,7 @@ class McConst:
 
     mainCfgFile = os.path.join(etcDir, "main.conf")
     pluginCfgFileGlobPattern = os.path.join(etcDir, "plugin-*.conf")
+    portAllocationFile = os.path.join(varDir, "ports.json")
     pidFile = os.path.join(runDir, "mirrors.pid")
     apiServerFile = os.path.join(runDir, "api.socket")
 
@@ -47,6 +49,10 @@ class McParam:
 
         self.mainCfg = {
             "preferedUpdatePeriodList": [],     # { "start": CRON-EXPRESSION, "time": HOURS }
+            "maxConcurrentUpdaters": None,                  # None means no limit
+            "maxConcurrentUpdatersPerResource": dict(),     # { RESOURCE-NAME: COUNT }
+            "cronSpreadWindow": 0,                          # seconds, 0 means cron jobs are not spread
+            "portRange": [10000, 65536],                    # [start, end), listening ports of storages and advertisers
             "country": "CN",
             "location": "",
             "pserver-domain-name": None,
@@ -54,6 +60,7 @@ class McParam:
 
         # objects
         self.mainloop = None
+        self.portAllocator = None
         self.pluginManager = None
         self.mirrorSiteDict = dict()
         self.storageDict = dict()
@@ -5,6 +5,8 @@ import os
 import re
 import glob
 import json
+import time
+import logging
 import lxml.etree
 from datetime import timedelta
 from mc_util import McUtil
@@ -55,8 +57,16 @@ class McPluginManager:
             storageNameList.remove("file")
             storageNameList.insert(0, "file")
 
+        # file storage is needed by the other storages and the advertisers, others are independent and loaded concurrently
+        tm = time.monotonic()
+        if "file" in storageNameList:
+            self.param.storageDict["file"] = self._timedCall("Storage (file)", self._loadOneStorageObject, "file", tDict["file"])
+        funcDict = dict()
         for st in storageNameList:
-            self.param.storageDict[st] = self._loadOneStorageObject(st, tDict[st])
+            if st != "file":
+                funcDict[st] = (lambda st=st: self._timedCall("Storage (%s)" % (st), self._loadOneStorageObject, st, tDict[st]))
+        self._loadInParallel(funcDict, self.param.storageDict)
+        logging.info("All storages loaded in %.1f seconds." % (time.monotonic() - tm))
 
     def getAdvertiserNameList(self):
         return os.listdir(McConst.advertiserDir)
@@ -69,8 +79,26 @@ class McPluginManager:
                     tDict[name] = []
                 tDict[name].append(msId)
 
+        # advertisers only depend on storages, all of them are loaded concurrently
+        tm = time.monotonic()
+        funcDict = dict()
         for name in sorted(list(tDict.keys())):
-            self.param.advertiserDict[name] = self._loadOneAdvertiserObject(name, tDict[name])
+            funcDict[name] = (lambda name=name: self._timedCall("Advertiser (%s)" % (name), self._loadOneAdvertiserObject, name, tDict[name]))
+        self._loadInParallel(funcDict, self.param.advertiserDict)
+        logging.info("All advertisers loaded in %.1f seconds." % (time.monotonic() - tm))
+
+    def _loadInParallel(self, funcDict, objDict):
+        resultDict, errorDict = McUtil.callInParallel(funcDict)
+        objDict.update(resultDict)                  # so that the loaded objects are disposed if some of them failed
+        if len(errorDict) > 0:
+            name = sorted(errorDict.keys())[0]
+            raise errorDict[name]
+
+    def _timedCall(self, title, func, *args):
+        tm = time.monotonic()
+        ret = func(*args)
+        logging.info("%s loaded in %.1f seconds." % (title, time.monotonic() - tm))
+        return ret
 
     def _loadOnePlugin(self, name, path, cfgDict):
         # get metadata.xml file
@@ -119,11 +147,13 @@ class McPluginManager:
         param = {
             "temp-directory": os.path.join(McConst.tmpDir, "storage-%s" % (name)),
             "log-directory": os.path.join(McConst.logDir, "storage-%s" % (name)),
+            "config": self._loadComponentCfg("storage-%s.conf" % (name)),
             "mirror-sites": dict(),
         }
         if mod.Storage.get_properties().get("with-integrated-advertiser", False):
             param.update({
                 "listen-ip": self.param.listenIp,
+                "port-allocator": self.param.portAllocator,
             })
         for msId in mirrorSiteIdList:
             param["mirror-sites"][msId] = {
@@ -146,8 +176,10 @@ class McPluginManager:
         # prepare advertiser initialization parameter
         param = {
             "listen-ip": self.param.listenIp,
+            "port-allocator": self.param.portAllocator,
             "temp-directory": os.path.join(McConst.tmpDir, "advertiser-%s" % (name)),
             "log-directory": os.path.join(McConst.logDir, "advertiser-%s" % (name)),
+            "config": self._loadComponentCfg("advertiser-%s.conf" % (name)),
             "mirror-sites": dict(),
         }
         for msId in mirrorSiteIdList:
@@ -167,6 +199,17 @@ class McPluginManager:
         # create object
         return mod.Advertiser(param)
 
+    def _loadComponentCfg(self, filename):
+        # config file of storage or advertiser is optional
+        fullfn = os.path.join(McConst.etcDir, filename)
+        if not os.path.exists(fullfn):
+            return dict()
+        with open(fullfn, "r") as f:
+            buf = f.read()
+            if buf == "":
+                return dict()
+            return json.loads(buf)
+
 
 class McMirrorSite:
 
@@ -212,7 +255,7 @@ class McMirrorSite:
             if st not in self.param.pluginManager.getAdvertiserNameList():
                 raise Exception("mirror site %s: invalid advertiser type %s" % (self.id, st))
             # record outer xml
-            self.advertiserDict[st] = (lxml.etree.tostring(child, encoding="unicode"))
+            self.advertiserDict[st] = (lxml.etree.tostring(child, encoding="unicode"),)
 
         # initializer
         self.initializerExe = None
@@ -227,9 +270,11 @@ class McMirrorSite:
         self.schedType = None              # "interval" or "cronexpr"
         self.schedInterval = None          # timedelta
         self.schedCronExpr = None          # string
+        self.schedCronJitter = None        # timedelta
         self.updateRetryType = None        # "interval" or "cronexpr"
         self.updateRetryInterval = None    # timedelta
         self.updateRetryCronExpr = None    # string
+        self.updaterResourceList = []      # list<resource-name>, for example "network", "disk"
         if True:
             slist = rootElem.xpath("./updater")
             if len(slist) > 0:
@@ -242,6 +287,10 @@ class McMirrorSite:
                     self.schedInterval = self._parseInterval(tag.text)
                 elif self.schedType == "cronexpr":
                     self.schedCronExpr = self._parseCronExpr(tag.text)
+                    if tag.get("jitter") is not None:
+                        if not McUtil.is_int(tag.get("jitter")) or int(tag.get("jitter")) < 0:
+                            raise Exception("mirror site %s: invalid schedule jitter %s" % (self.id, tag.get("jitter")))
+                        self.schedCronJitter = timedelta(seconds=int(tag.get("jitter")))
                 else:
                     raise Exception("mirror site %s: invalid schedule type %s" % (self.id, self.schedType))
 
@@ -257,6 +306,11 @@ class McMirrorSite:
                     else:
                         raise Exception("mirror site %s: invalid retry-after-update type %s" % (self.id, self.updateRetryType))
 
+                for tag in slist[0].xpath("./resource"):
+                    if tag.text is None or tag.text.strip() == "":
+                        raise Exception("mirror site %s: invalid updater resource" % (self.id))
+                    self.updaterResourceList.append(tag.text.strip())
+
         # maintainer
         self.maintainerExe = None
         if True:
@@ -3,13 +3,19 @@
 
 import os
 import re
+import time
 import math
 import json
+import heapq
+import bisect
 import fcntl
+import struct
+import hashlib
 import logging
 import subprocess
 import statistics
 from datetime import datetime
+from datetime import timedelta
 from croniter import croniter
 from collections import OrderedDict
 from gi.repository import GLib
@@ -34,9 +40,15 @@ class McMirrorSiteUpdater:
 
     def __init__(self, param):
         self.param = param
+        self.stateVersion = 0                                           # bumped when the update state of any mirror site changes
+        self.stateVersionDict = dict()                                  # dict<mirror-id,version>
+        self.stateChangeListenerList = []                               # list<func(mirror-id)>
         self.invoker = _IdleInvoker()
-        self.scheduler = _Scheduler()
-        self.apiServer = _ApiServer()
+        self.scheduler = _Scheduler(self.param.mainCfg["preferedUpdatePeriodList"], self.param.mainCfg["maxConcurrentUpdaters"], self.param.mainCfg["cronSpreadWindow"],
+                                    jobChangedCallback=self._notifyStateChanged)
+        self.admission = _UpdaterAdmission(self.invoker, self.param.mainCfg["maxConcurrentUpdaters"], self.param.mainCfg["maxConcurrentUpdatersPerResource"],
+                                           jobChangedCallback=self._notifyStateChanged)
+        self.apiServer = _ApiServer(self.param.mainloop)
 
         self.updaterDict = dict()                                       # dict<mirror-id,updater-object>
         for ms in self.param.mirrorSiteDict.values():
@@ -52,9 +64,25 @@ class McMirrorSiteUpdater:
             elif updater.status == self.MIRROR_SITE_UPDATE_STATUS_MAINTAINING:
                 updater.maintainStop()
         # FIXME, should use g_main_context_iteration to wait all the updaters to stop
+        self.admission.dispose()
         self.scheduler.dispose()
         self.invoker.dispose()
 
+    def getStateVersion(self):
+        return self.stateVersion
+
+    def getMirrorSiteStateVersion(self, mirrorSiteId):
+        # the value returned by getMirrorSiteUpdateState() won't change until this version changes
+        return self.stateVersionDict.get(mirrorSiteId, 0)
+
+    def addStateChangeListener(self, func):
+        # func(mirrorSiteId) is called synchronously after the update state of a mirror site changes
+        assert func not in self.stateChangeListenerList
+        self.stateChangeListenerList.append(func)
+
+    def removeStateChangeListener(self, func):
+        self.stateChangeListenerList.remove(func)
+
     def isMirrorSiteInitialized(self, mirrorSiteId):
         return self.updaterDict[mirrorSiteId].updateHistory.isInitialized()
 
@@ -62,20 +90,42 @@ class McMirrorSiteUpdater:
         updater = self.updaterDict[mirrorSiteId]
         ret = dict()
         ret["update_status"] = updater.status
-        if mirrorSiteId in self.scheduler.jobDict:
-            ret["last_update_time"] = self.scheduler.jobInfoDict[mirrorSiteId][0]
-            ret["next_update_time"] = self.scheduler.jobInfoDict[mirrorSiteId][1]
+        if self.scheduler.hasJob(mirrorSiteId):
+            ret["last_update_time"] = self.scheduler.getJobLastSchedDatetime(mirrorSiteId)
+            ret["next_update_time"] = self.scheduler.getJobNextSchedDatetime(mirrorSiteId)      # jitter and spread offset included
         else:
             ret["last_update_time"] = None
             ret["next_update_time"] = None
         if updater.status in [self.MIRROR_SITE_UPDATE_STATUS_INITING, self.MIRROR_SITE_UPDATE_STATUS_UPDATING]:
             ret["update_progress"] = updater.progress
+            ret["transfer_stats"] = updater.transferStats
+        ret["update_queue_position"] = self.admission.getQueuePosition(mirrorSiteId)
+        ret["update_statistics"] = updater.updateHistory.getStatistics()
+        ret["api_message_rate"] = self.apiServer.getMessageRate(mirrorSiteId)         # None if updater is not connected
+        if updater.status == self.MIRROR_SITE_UPDATE_STATUS_UPDATING:
+            startDatetime = updater.schedDatetime
+        else:
+            startDatetime = ret["next_update_time"]
+        if startDatetime is not None:
+            ret["update_estimated_duration"] = updater.updateHistory.getEstimatedUpdateDuration(startDatetime)
+        else:
+            ret["update_estimated_duration"] = None
+        if ret["update_estimated_duration"] is not None:
+            ret["update_estimated_finish_time"] = startDatetime + ret["update_estimated_duration"]
+        else:
+            ret["update_estimated_finish_time"] = None
         return ret
 
     def updateMirrorSiteNow(self, mirrorSiteId):
         assert self.updaterDict[mirrorSiteId].status in [self.MIRROR_SITE_UPDATE_STATUS_IDLE, self.MIRROR_SITE_UPDATE_STATUS_UPDATE_FAIL]
         self.scheduler.triggerJobNow(mirrorSiteId)
 
+    def _notifyStateChanged(self, mirrorSiteId):
+        self.stateVersion += 1
+        self.stateVersionDict[mirrorSiteId] = self.stateVersion
+        for func in self.stateChangeListenerList:
+            func(mirrorSiteId)
+
 
 class _OneMirrorSiteUpdater:
 
@@ -83,8 +133,11 @@ class _OneMirrorSiteUpdater:
         self.param = parent.param
         self.invoker = parent.invoker
         self.scheduler = parent.scheduler
+        self.admission = parent.admission
         self.apiServer = parent.apiServer
         self.mirrorSite = mirrorSite
+        self.notifyStateChanged = lambda: parent._notifyStateChanged(self.mirrorSite.id)
+        self._status = None
 
         self.updateHistory = _UpdateHistory(os.path.join(self.mirrorSite.masterDir, "UPDATE_HISTORY"),
                                             self.mirrorSite.initializerExe is not None)
@@ -100,16 +153,35 @@ class _OneMirrorSiteUpdater:
             else:
                 self._postInit(None)
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        self.notifyStateChanged()
+
     def initStart(self):
         assert self.status in [McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INIT, McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INIT_FAIL]
 
+        # initializers are limited by the same updater slots and resources as updaters
+        if not self.admission.acquire(self.mirrorSite.id, self.mirrorSite.updaterResourceList, self._initStartAdmitted):
+            logging.info("Mirror site \"%s\" initialization is waiting for a free updater slot (queue depth: %d)." % (self.mirrorSite.id, self.admission.getQueueDepth()))
+            return
+
+        self._initStartAdmitted()
+
+    def _initStartAdmitted(self):
+        assert self.status in [McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INIT, McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INIT_FAIL]
+
         try:
             self.status = McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING
             self._createVars()
             self.proc = self._createProc()
             self.pidWatch = GLib.child_watch_add(self.proc.pid, self.initExitCallback)
             self.stdoutWatch = GLib.io_add_watch(self.proc.stdout, GLib.IO_IN, self._stdoutCallback)
-            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount)
+            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount, McConst.rotateLogFileCompress)
             logging.info("Mirror site \"%s\" initialization starts." % (self.mirrorSite.id))
         except Exception:
             self._clearVars()
@@ -126,12 +198,18 @@ class _OneMirrorSiteUpdater:
         assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING
         if progress > self.progress:
             self.progress = progress
+            self.notifyStateChanged()
             logging.info("Mirror site \"%s\" initialization progress %d%%." % (self.mirrorSite.id, self.progress))
         elif progress == self.progress:
             pass
         else:
             raise Exception("invalid progress")
 
+    def initTransferStatsCallback(self, transferStats):
+        assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING
+        self.transferStats = transferStats
+        self.notifyStateChanged()
+
     def initErrorCallback(self, exc_info):
         assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING
         assert self.excInfo is None
@@ -155,7 +233,7 @@ class _OneMirrorSiteUpdater:
             GLib.spawn_check_exit_status(status)
             # child process returns ok
             bStop = self.bStop
-            self.updateHistory.initFinished(curDt)
+            self.updateHistory.initFinished(curDt, self.transferStats["bytes-downloaded"], self.transferStats["files-added"], self.transferStats["files-removed"])
             self._clearVars()
             self.status = McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_IDLE
             logging.info("Mirror site \"%s\" initialization finished." % (self.mirrorSite.id))
@@ -182,6 +260,19 @@ class _OneMirrorSiteUpdater:
             logging.info("Mirror site \"%s\" updating ignored on \"%s\", last update is not finished." % (self.mirrorSite.id, schedDatetime.strftime("%Y-%m-%d %H:%M")))
             return
 
+        if self.admission.hasJob(self.mirrorSite.id):
+            logging.info("Mirror site \"%s\" updating ignored on \"%s\", last update is waiting for a free updater slot." % (self.mirrorSite.id, schedDatetime.strftime("%Y-%m-%d %H:%M")))
+            return
+
+        if not self.admission.acquire(self.mirrorSite.id, self.mirrorSite.updaterResourceList, lambda: self._updateStartAdmitted(schedDatetime)):
+            logging.info("Mirror site \"%s\" update triggered on \"%s\", waiting for a free updater slot (queue depth: %d)." % (self.mirrorSite.id, schedDatetime.strftime("%Y-%m-%d %H:%M"), self.admission.getQueueDepth()))
+            return
+
+        self._updateStartAdmitted(schedDatetime)
+
+    def _updateStartAdmitted(self, schedDatetime):
+        assert self.status in [McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_IDLE, McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATE_FAIL]
+
         try:
             self.status = McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING
             self._createVars()
@@ -189,7 +280,7 @@ class _OneMirrorSiteUpdater:
             self.proc = self._createProc()
             self.pidWatch = GLib.child_watch_add(self.proc.pid, self.updateExitCallback)
             self.stdoutWatch = GLib.io_add_watch(self.proc.stdout, GLib.IO_IN, self._stdoutCallback)
-            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount)
+            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount, McConst.rotateLogFileCompress)
             logging.info("Mirror site \"%s\" update triggered on \"%s\"." % (self.mirrorSite.id, self.schedDatetime.strftime("%Y-%m-%d %H:%M")))
         except Exception:
             self._clearVars()
@@ -205,12 +296,18 @@ class _OneMirrorSiteUpdater:
         assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING
         if progress > self.progress:
             self.progress = progress
+            self.notifyStateChanged()
             logging.info("Mirror site \"%s\" update progress %d%%." % (self.mirrorSite.id, self.progress))
         elif progress == self.progress:
             pass
         else:
             raise Exception("invalid progress")
 
+    def updateTransferStatsCallback(self, transferStats):
+        assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING
+        self.transferStats = transferStats
+        self.notifyStateChanged()
+
     def updateErrorCallback(self, exc_info):
         assert self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING
         assert self.excInfo is None
@@ -233,14 +330,19 @@ class _OneMirrorSiteUpdater:
         try:
             GLib.spawn_check_exit_status(status)
             # child process returns ok
-            self.updateHistory.updateFinished(True, self.schedDatetime, curDt)
+            self.updateHistory.updateFinished(True, self.schedDatetime, curDt, self.transferStats["bytes-downloaded"], self.transferStats["files-added"], self.transferStats["files-removed"])
             self._clearVars()
             self.status = McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_IDLE
             logging.info("Mirror site \"%s\" update finished." % (self.mirrorSite.id))
+            for name in self.mirrorSite.advertiserDict:
+                # mirror_site_updated() is optional for advertisers
+                obj = self.param.advertiserDict[name]
+                if McUtil.is_method(obj, "mirror_site_updated"):
+                    self.invoker.addCallback(lambda obj=obj: obj.mirror_site_updated(self.mirrorSite.id))
         except GLib.Error as e:
             # child process returns failure
             bStop = self.bStop
-            self.updateHistory.updateFinished(False, self.schedDatetime, curDt)
+            self.updateHistory.updateFinished(False, self.schedDatetime, curDt, self.transferStats["bytes-downloaded"], self.transferStats["files-added"], self.transferStats["files-removed"])
             self._clearVars()
             self.status = McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATE_FAIL
             logging.error("Mirror site \"%s\" update failed (code: %d)." % (self.mirrorSite.id, e.code))
@@ -255,7 +357,7 @@ class _OneMirrorSiteUpdater:
             self.proc = self._createProc()
             self.pidWatch = GLib.child_watch_add(self.proc.pid, self.maintainExitCallback)
             self.stdoutWatch = GLib.io_add_watch(self.proc.stdout, GLib.IO_IN, self._stdoutCallback)
-            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount)
+            self.logger = RotatingFile(self.mirrorSite.mainUpdaterLogFile, McConst.rotateLogFileSize, McConst.rotateLogFileCount, McConst.rotateLogFileCompress)
             logging.info("Mirror site \"%s\" maintainer started." % (self.mirrorSite.id))
         except Exception:
             self._clearVars()
@@ -305,10 +407,12 @@ class _OneMirrorSiteUpdater:
         if self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING:
             self.progress = 0
             self.holdFor = None
+            self.transferStats = self._newTransferStats()
         elif self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING:
             self.schedDatetime = None
             self.progress = 0
             self.holdFor = None
+            self.transferStats = self._newTransferStats()
         elif self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_MAINTAINING:
             pass
         else:
@@ -316,12 +420,16 @@ class _OneMirrorSiteUpdater:
 
     def _clearVars(self):
         if self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING:
+            del self.transferStats
             del self.holdFor
             del self.progress
+            self.admission.release(self.mirrorSite.id)
         elif self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING:
+            del self.transferStats
             del self.schedDatetime
             del self.holdFor
             del self.progress
+            self.admission.release(self.mirrorSite.id)
         elif self.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_MAINTAINING:
             pass
         else:
@@ -343,6 +451,15 @@ class _OneMirrorSiteUpdater:
         del self.proc
         del self.bStop
 
+    def _newTransferStats(self):
+        # statistics of the current run, sent by the plugin in "transfer-stats" messages
+        return {
+            "bytes-downloaded": 0,
+            "files-added": 0,
+            "files-removed": 0,
+            "rate": 0,
+        }
+
     def _createProc(self):
         cmd = []
 
@@ -405,9 +522,10 @@ class _OneMirrorSiteUpdater:
             self.invoker.addCallback(lambda: self.param.advertiserDict[name].advertise_mirror_site(self.mirrorSite.id))
         if self.mirrorSite.updaterExe is not None:
             if self.mirrorSite.schedType == "interval":
-                self.scheduler.addIntervalJob(self.mirrorSite.id, finishDatetime, self.mirrorSite.schedInterval, self.updateStart)
+                self.scheduler.addIntervalJob(self.mirrorSite.id, finishDatetime, self.mirrorSite.schedInterval, self.updateStart, self._estimateUpdateDuration)
             elif self.mirrorSite.schedType == "cronexpr":
-                self.scheduler.addCronJob(self.mirrorSite.id, finishDatetime, self.mirrorSite.schedCronExpr, self.updateStart)
+                self.scheduler.addCronJob(self.mirrorSite.id, finishDatetime, self.mirrorSite.schedCronExpr, self.updateStart, self._estimateUpdateDuration,
+                                          jitter=self.mirrorSite.schedCronJitter)
             else:
                 assert False
         elif self.mirrorSite.maintainerExe is not None:
@@ -426,15 +544,29 @@ class _OneMirrorSiteUpdater:
         self.maintainStart()
         return False
 
+    def _estimateUpdateDuration(self, startDatetime):
+        ret = self.updateHistory.getEstimatedUpdateDuration(startDatetime, pessimistic=True)
+        if ret is None:
+            ret = timedelta(seconds=self.updateHistory.getAverageUpdateDuration())
+        return ret
+
 
 class _ApiServer(UnixDomainSocketApiServer):
 
-    def __init__(self):
+    MESSAGE_RATE_WINDOW = 10                         # unit: seconds
+
+    def __init__(self, loop):
         self._clientPidDict = dict()                 # <pid,mirror-id>
         self._mirrorSiteUpdaterDict = dict()         # <mirror-id,mirror-site-updater>
         self._sockDict = dict()                      # <mirror-id,sock>
         self._clientDisappearCbDict = dict()         # <mirror-id,callback-func>
-        super().__init__(McConst.apiServerFile, self._clientAppearFunc, self._clientDisappearFunc, self._clientNoitfyFunc)
+        self._messageRateDict = dict()               # <mirror-id,[window-start-time,message-count-in-window,messages-per-second]>
+        super().__init__(McConst.apiServerFile, self._clientAppearFunc, self._clientDisappearFunc, self._clientNoitfyFunc, loop=loop)
+        self._messageRateTimer = self.loop.call_later(self.MESSAGE_RATE_WINDOW, self._messageRateTimerCallback)
+
+    def dispose(self):
+        self._messageRateTimer.cancel()
+        super().dispose()
 
     def addMirrorSite(self, mirrorId, mirrorSiteUpdater, pid):
         assert pid not in self._clientPidDict
@@ -454,6 +586,12 @@ class _ApiServer(UnixDomainSocketApiServer):
     def hasClient(self, mirrorId):
         return mirrorId in self._sockDict
 
+    def getMessageRate(self, mirrorId):
+        # returns messages per second in the last complete window, it only changes when the mirror site state version is bumped
+        if mirrorId not in self._messageRateDict:
+            return None
+        return self._messageRateDict[mirrorId][2]
+
     def addClientDisappearOneshotCallback(self, mirrorId, callbackFunc):
         assert mirrorId in self._sockDict
         assert mirrorId not in self._clientDisappearCbDict
@@ -465,17 +603,39 @@ class _ApiServer(UnixDomainSocketApiServer):
             raise Exception("client not found")
         mirrorId = self._clientPidDict[pid]
         self._sockDict[mirrorId] = sock
+        self._messageRateDict[mirrorId] = [time.monotonic(), 0, 0]
+        self._mirrorSiteUpdaterDict[mirrorId].notifyStateChanged()          # message rate is no longer None
         return mirrorId
 
     def _clientDisappearFunc(self, mirrorId):
+        stat = self.getClientStatistics(mirrorId)
+        rate = stat["message-count"] / max(time.time() - stat["connect-time"], 1)
+        logging.debug("Mirror site \"%s\" api client disconnected, %d messages (%d bytes, %.1f messages/s) received, %d invalid." % (mirrorId, stat["message-count"], stat["byte-count"], rate, stat["error-count"]))
         if mirrorId in self._clientDisappearCbDict:
             self._clientDisappearCbDict[mirrorId]()
             del self._clientDisappearCbDict[mirrorId]
+        del self._messageRateDict[mirrorId]
         del self._sockDict[mirrorId]
+        self._mirrorSiteUpdaterDict[mirrorId].notifyStateChanged()          # message rate becomes None
+
+    def _messageRateTimerCallback(self):
+        # windows are closed by timer instead of by incoming messages, so that the rate of a silent client drops to 0
+        # the mirror site state version is bumped when the published rate changes, which refreshes the cached api responses
+        now = time.monotonic()
+        for mirrorId, rateInfo in self._messageRateDict.items():
+            rate = rateInfo[1] / max(now - rateInfo[0], 1)
+            rateInfo[0] = now
+            rateInfo[1] = 0
+            if round(rate, 1) != round(rateInfo[2], 1):
+                rateInfo[2] = rate
+                self._mirrorSiteUpdaterDict[mirrorId].notifyStateChanged()
+        self._messageRateTimer = self.loop.call_later(self.MESSAGE_RATE_WINDOW, self._messageRateTimerCallback)
 
     def _clientNoitfyFunc(self, mirrorId, data):
         obj = self._mirrorSiteUpdaterDict[mirrorId]
 
+        self._messageRateDict[mirrorId][1] += 1
+
         if "message" not in data:
             raise Exception("\"message\" field does not exist in notification")
         if "data" not in data:
@@ -530,6 +690,27 @@ class _ApiServer(UnixDomainSocketApiServer):
                 assert False
             return
 
+        if data["message"] == "transfer-stats":
+            for key in ["bytes-downloaded", "files-added", "files-removed"]:
+                if key not in data["data"]:
+                    raise Exception("\"data.%s\" field does not exist in notification" % (key))
+                if not isinstance(data["data"][key], int):
+                    raise Exception("\"data.%s\" field does not contain an integer value" % (key))
+                if data["data"][key] < 0:
+                    raise Exception("\"data.%s\" must be greater than or equal to 0" % (key))
+            if "rate" not in data["data"]:
+                raise Exception("\"data.rate\" field does not exist in notification")
+            if not isinstance(data["data"]["rate"], (int, float)):
+                raise Exception("\"data.rate\" field does not contain a number")
+
+            if obj.mirrorSite.initializerExe is not None and obj.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_INITING:
+                obj.initTransferStatsCallback(data["data"])
+            elif obj.mirrorSite.updaterExe is not None and obj.status == McMirrorSiteUpdater.MIRROR_SITE_UPDATE_STATUS_UPDATING:
+                obj.updateTransferStatsCallback(data["data"])
+            else:
+                assert False
+            return
+
         raise Exception("message type \"%s\" is not supported" % (data["message"]))
 
 
@@ -554,11 +735,117 @@ class _IdleInvoker:
         return False
 
 
+class _UpdaterAdmission:
+
+    """
+    Limits the number of concurrently running updaters and initializers, both globally and per
+    resource class (for example "network" or "disk", declared by <resource> in metadata.xml).
+    Jobs that can not run are queued and started in FIFO order when slots are freed,
+    a queued job is skipped if the resources it needs are still exhausted.
+    """
+
+    def __init__(self, invoker, maxCount, maxCountPerResource, jobChangedCallback=None):
+        self.invoker = invoker
+        self.jobChangedCallback = jobChangedCallback        # called when the queue position of a job changes
+        self.maxCount = maxCount                            # None means no limit
+        self.maxCountPerResource = maxCountPerResource      # dict<resource-name,count>
+        self.runningDict = dict()                           # dict<id,resource-list>
+        self.resourceUsageDict = dict()                     # dict<resource-name,count>
+        self.queue = OrderedDict()                          # OrderedDict<id,(resource-list,callback)>
+        self.queuePositionDict = dict()                     # dict<id,position>, rebuilt lazily, None means invalid
+
+    def dispose(self):
+        self.queuePositionDict = dict()
+        self.queue = OrderedDict()
+        self.resourceUsageDict = dict()
+        self.runningDict = dict()
+
+    def hasJob(self, jobId):
+        return jobId in self.runningDict or jobId in self.queue
+
+    def getQueueDepth(self):
+        return len(self.queue)
+
+    def getQueuePosition(self, jobId):
+        if jobId in self.queue:
+            if self.queuePositionDict is None:
+                self.queuePositionDict = {x: i for i, x in enumerate(self.queue)}
+            return self.queuePositionDict[jobId]
+        else:
+            return None
+
+    def acquire(self, jobId, resourceList, callback):
+        # returns True if the job can run now
+        # returns False if the job is queued, callback is invoked when it is admitted later
+        assert not self.hasJob(jobId)
+        if self._canRun(resourceList):
+            self._run(jobId, resourceList)
+            return True
+        else:
+            self.queue[jobId] = (resourceList, callback)
+            if self.queuePositionDict is not None:
+                self.queuePositionDict[jobId] = len(self.queue) - 1
+            if self.jobChangedCallback is not None:
+                self.jobChangedCallback(jobId)
+            return False
+
+    def release(self, jobId):
+        for r in self.runningDict.pop(jobId):
+            self.resourceUsageDict[r] -= 1
+
+        admittedList = []
+        queuedJobIdList = list(self.queue.keys())
+        firstAdmittedIndex = None
+        for i, queuedJobId in enumerate(queuedJobIdList):
+            if self.maxCount is not None and len(self.runningDict) >= self.maxCount:
+                break
+            resourceList, callback = self.queue[queuedJobId]
+            if self._canRun(resourceList):
+                del self.queue[queuedJobId]
+                self._run(queuedJobId, resourceList)
+                self.invoker.addCallback(callback)
+                admittedList.append(queuedJobId)
+                if firstAdmittedIndex is None:
+                    firstAdmittedIndex = i
+
+        # only the jobs queued after the first admitted job change their queue position
+        if len(admittedList) > 0:
+            self.queuePositionDict = None
+            if self.jobChangedCallback is not None:
+                for jobId in admittedList:
+                    self.jobChangedCallback(jobId)
+                for jobId in queuedJobIdList[firstAdmittedIndex + 1:]:
+                    if jobId in self.queue:
+                        self.jobChangedCallback(jobId)
+
+    def _canRun(self, resourceList):
+        if self.maxCount is not None and len(self.runningDict) >= self.maxCount:
+            return False
+        for r in resourceList:
+            if r in self.maxCountPerResource and self.resourceUsageDict.get(r, 0) >= self.maxCountPerResource[r]:
+                return False
+        return True
+
+    def _run(self, jobId, resourceList):
+        self.runningDict[jobId] = resourceList
+        for r in resourceList:
+            self.resourceUsageDict[r] = self.resourceUsageDict.get(r, 0) + 1
+
+
 class _Scheduler:
 
-    def __init__(self):
-        self.jobDict = OrderedDict()            # dict<id,(type,param,callback)>
+    def __init__(self, preferedUpdatePeriodList=[], laneCount=None, cronSpreadWindow=0, jobChangedCallback=None):
+        self.jobChangedCallback = jobChangedCallback    # called when the next sched time of a job changes
+        self.planner = _UpdatePeriodPlanner(preferedUpdatePeriodList, laneCount)
+        self.cronSpreadWindow = timedelta(seconds=cronSpreadWindow)
+        self.cronJitterDict = dict()            # dict<id,timedelta>, stable per job jitter
+        self.cronGroupDict = dict()             # dict<cron-expression,list<id>>, jobs with the same cron expression fire at the same time
+        self.cronOffsetDict = dict()            # dict<id,timedelta>, jitter + spread offset, added to the time given by cron expression
+        self.jobDict = dict()                   # dict<id,(type,param,callback,estimate-duration-callback)>
         self.jobInfoDict = dict()               # dict<id,[lastSchedDatetime,nextSchedDatetime]>
+        self.jobHeap = []                       # heap<(nextSchedDatetime,seq,id)>, lazy deletion, stale items are dropped when they reach the top
+        self.jobSeqDict = dict()                # dict<id,seq>, seq of the only valid heap item of each job
+        self.seq = 0
         self.nextDatetime = datetime.max
         self.timeoutHandler = None
 
@@ -567,42 +854,77 @@ class _Scheduler:
             GLib.source_remove(self.timeoutHandler)
             self.timeoutHandler = None
         self.nextDatetime = datetime.max
+        self.jobSeqDict = dict()
+        self.jobHeap = []
         self.jobInfoDict = dict()
-        self.jobDict = OrderedDict()
-
-    def addCronJob(self, jobId, lastSchedDatetime, cronExpr, jobCallback):
+        self.jobDict = dict()
+        self.cronOffsetDict = dict()
+        self.cronGroupDict = dict()
+        self.cronJitterDict = dict()
+        self.planner.dispose()
+
+    def addCronJob(self, jobId, lastSchedDatetime, cronExpr, jobCallback, estimateDurationCallback=None, jitter=None):
+        # jitter is a timedelta, a stable offset in [0,jitter] is derived from jobId
         assert jobId not in self.jobDict
         now = datetime.now()
-        self.jobDict[jobId] = ("cron", croniter(cronExpr, now, datetime), jobCallback)
-        self.jobInfoDict[jobId] = [lastSchedDatetime, self.__cronGetNextDatetime(now, self.jobDict[jobId][1])]
-        self._timeoutMayBecomeEarly(jobId, now)
 
-    def addIntervalJob(self, jobId, lastSchedDatetime, interval, jobCallback):
+        # calculate offset for this job and the jobs which share the same cron expression
+        if jitter is not None:
+            h = int.from_bytes(hashlib.sha1(jobId.encode("utf-8")).digest()[:8], "big")
+            self.cronJitterDict[jobId] = timedelta(seconds=h % (int(jitter.total_seconds()) + 1))
+        else:
+            self.cronJitterDict[jobId] = timedelta(0)
+
+        # start iterating from an earlier time, so that a fire whose offset has not elapsed is not missed
+        it = croniter(cronExpr, now - self.cronJitterDict[jobId] - self.cronSpreadWindow, datetime)
+        it.get_next()
+        self.jobDict[jobId] = ("cron", it, jobCallback, estimateDurationCallback)
+        self.jobInfoDict[jobId] = [lastSchedDatetime, None]
+        self.cronGroupDict.setdefault(cronExpr, []).append(jobId)
+        for otherJobId, oldOffset in self._updateCronGroupOffset(cronExpr).items():
+            if otherJobId == jobId:
+                continue
+            # only move the jobs which are still on their cron schedule, paused or triggered jobs keep their next sched time
+            croniterIter = self.jobDict[otherJobId][1]
+            if self.jobInfoDict[otherJobId][1] == croniterIter.get_current() + oldOffset:
+                self._setJobNextDatetime(otherJobId, croniterIter.get_current() + self.cronOffsetDict[otherJobId])
+
+        self._setJobNextDatetime(jobId, self.__cronGetNextDatetime(jobId, now))
+        self._refreshTimeout(now)
+
+    def addIntervalJob(self, jobId, lastSchedDatetime, interval, jobCallback, estimateDurationCallback=None):
         assert jobId not in self.jobDict
         now = datetime.now()
-        self.jobDict[jobId] = ("interval", interval, jobCallback)
-        self.jobInfoDict[jobId] = [lastSchedDatetime, self.__intervalGetNextDatetime(now, lastSchedDatetime, interval)]
-        self._timeoutMayBecomeEarly(jobId, now)
+        self.jobDict[jobId] = ("interval", interval, jobCallback, estimateDurationCallback)
+        self.jobInfoDict[jobId] = [lastSchedDatetime, None]
+        self._setJobNextDatetime(jobId, self.__intervalGetNextDatetime(jobId, now, lastSchedDatetime, interval))
+        self._refreshTimeout(now)
 
     def pauseJobUntil(self, jobId, untilDatetime):
         assert jobId in self.jobDict
         if untilDatetime > self.jobInfoDict[jobId][1]:
-            self.jobInfoDict[jobId][1] = untilDatetime
-            self._timeoutMayBecomeLate()
+            self.planner.release(jobId)
+            self._setJobNextDatetime(jobId, untilDatetime)
+            self._refreshTimeout(datetime.now())
 
     def triggerJobAt(self, jobId, triggerDatetime):
         assert jobId in self.jobDict
         if triggerDatetime < self.jobInfoDict[jobId][1]:
-            self.jobInfoDict[jobId][1] = triggerDatetime
-            self._timeoutMayBecomeEarly(jobId, datetime.now())
+            self.planner.release(jobId)
+            self._setJobNextDatetime(jobId, triggerDatetime)
+            self._refreshTimeout(datetime.now())
             return True
         else:
             return False
 
     def triggerJobNow(self, jobId):
         assert jobId in self.jobDict
-        self._execJob(jobId, datetime.now())
-        self._timeoutMayBecomeLate()
+        now = datetime.now()
+        self._execJob(jobId, now)
+        self._refreshTimeout(now)
+
+    def hasJob(self, jobId):
+        return jobId in self.jobDict
 
     def getJobLastSchedDatetime(self, jobId):
         assert jobId in self.jobDict
@@ -612,30 +934,51 @@ class _Scheduler:
         assert jobId in self.jobDict
         return self.jobInfoDict[jobId][1]
 
-    def _timeoutMayBecomeLate(self):
-        m = min([x[1] for x in self.jobInfoDict.values()])
-        if m > self.nextDatetime:
-            self.__updateTimeout(datetime.now(), m)
-
-    def _timeoutMayBecomeEarly(self, jobId, curDatetime):
-        if self.jobInfoDict[jobId][1] < self.nextDatetime:
-            self.__updateTimeout(curDatetime, self.jobInfoDict[jobId][1])
+    def _setJobNextDatetime(self, jobId, nextDatetime):
+        # the old heap item of this job becomes stale, it is not removed from the heap here
+        self.jobInfoDict[jobId][1] = nextDatetime
+        self.seq += 1
+        self.jobSeqDict[jobId] = self.seq
+        heapq.heappush(self.jobHeap, (nextDatetime, self.seq, jobId))
+        if self.jobChangedCallback is not None:
+            self.jobChangedCallback(jobId)
+
+        # stale items are normally dropped when they reach the top of the heap,
+        # rebuild the heap if frequent rescheduling makes it grow too much
+        if len(self.jobHeap) > len(self.jobSeqDict) * 2 + 64:
+            self.jobHeap = [x for x in self.jobHeap if self.jobSeqDict.get(x[2]) == x[1]]
+            heapq.heapify(self.jobHeap)
+
+    def _peekNextDatetime(self):
+        while len(self.jobHeap) > 0:
+            nextDatetime, seq, jobId = self.jobHeap[0]
+            if self.jobSeqDict.get(jobId) == seq:
+                return nextDatetime
+            heapq.heappop(self.jobHeap)
+        return datetime.max
+
+    def _refreshTimeout(self, curDatetime):
+        m = self._peekNextDatetime()
+        if m != self.nextDatetime:
+            self.__updateTimeout(curDatetime, m)
 
     def _jobCallback(self):
+        self.timeoutHandler = None
+        self.nextDatetime = datetime.max
         now = datetime.now()
 
+        # pop all the due jobs before executing any of them, so that job callbacks can safely reschedule
+        dueList = []
+        while self._peekNextDatetime() <= now:
+            nextDatetime, seq, jobId = heapq.heappop(self.jobHeap)
+            dueList.append((jobId, nextDatetime))
+
         # execute jobs
-        bExecuted = False
-        for jobId in self.jobDict:
-            if self.jobInfoDict[jobId][1] <= now:
-                bExecuted = True
-                self._execJob(jobId, self.jobInfoDict[jobId][1])
-        assert bExecuted
+        for jobId, nextDatetime in dueList:
+            self._execJob(jobId, nextDatetime)
 
         # recalculate timeout
-        m = min([x[1] for x in self.jobInfoDict.values()])
-        assert m > self.nextDatetime
-        self.__updateTimeout(now, m)
+        self._refreshTimeout(now)
 
         return False
 
@@ -647,45 +990,219 @@ class _Scheduler:
         self.jobInfoDict[jobId][0] = curDatetime
 
         # calculate next sched time
+        # cron jobs skip the occurrences before the estimated finish time, so that long updates don't overlap
         if self.jobDict[jobId][0] == "cron":
-            self.jobInfoDict[jobId][1] = self.__cronGetNextDatetime(curDatetime, self.jobDict[jobId][1])
+            self._setJobNextDatetime(jobId, self.__cronGetNextDatetime(jobId, curDatetime + self._getJobEstimatedDuration(jobId, curDatetime)))
         elif self.jobDict[jobId][0] == "interval":
-            self.jobInfoDict[jobId][1] = self.__intervalGetNextDatetime(curDatetime, self.jobInfoDict[jobId][0], self.jobDict[jobId][1])
+            self._setJobNextDatetime(jobId, self.__intervalGetNextDatetime(jobId, curDatetime, self.jobInfoDict[jobId][0], self.jobDict[jobId][1]))
         else:
             assert False
 
     def __updateTimeout(self, curDatetime, nextDatetime):
         if self.timeoutHandler is not None:
             GLib.source_remove(self.timeoutHandler)
+            self.timeoutHandler = None
         self.nextDatetime = nextDatetime
-        interval = math.ceil((nextDatetime - curDatetime).total_seconds())
-        interval = max(interval, 1)
-        self.timeoutHandler = GLib.timeout_add_seconds(interval, self._jobCallback)
+        if nextDatetime != datetime.max:
+            interval = math.ceil((nextDatetime - curDatetime).total_seconds())
+            interval = max(interval, 1)
+            self.timeoutHandler = GLib.timeout_add_seconds(interval, self._jobCallback)
+
+    def _getJobEstimatedDuration(self, jobId, startDatetime):
+        if self.jobDict[jobId][3] is not None:
+            return self.jobDict[jobId][3](startDatetime)
+        else:
+            return timedelta(0)
 
-    def __cronGetNextDatetime(self, curDatetime, croniterIter):
-        while croniterIter.get_current() <= curDatetime:
+    def _updateCronGroupOffset(self, cronExpr):
+        # in spread mode, jobs sharing the same cron expression are evenly distributed in the spread window
+        # returns dict<id,old-offset> of the jobs whose offset is changed, old-offset is None for new job
+        ret = dict()
+        jobIdList = sorted(self.cronGroupDict[cronExpr])
+        for i, jobId in enumerate(jobIdList):
+            offset = self.cronJitterDict[jobId] + self.cronSpreadWindow * i / len(jobIdList)
+            if self.cronOffsetDict.get(jobId) != offset:
+                ret[jobId] = self.cronOffsetDict.get(jobId)
+                self.cronOffsetDict[jobId] = offset
+        return ret
+
+    def __cronGetNextDatetime(self, jobId, curDatetime):
+        croniterIter = self.jobDict[jobId][1]
+        offset = self.cronOffsetDict[jobId]
+        while croniterIter.get_current() + offset <= curDatetime:
             croniterIter.get_next()
-        return croniterIter.get_current()
+        return croniterIter.get_current() + offset
 
-    def __intervalGetNextDatetime(self, curDatetime, lastSchedTime, interval):
+    def __intervalGetNextDatetime(self, jobId, curDatetime, lastSchedTime, interval):
+        # next update is not started before the estimated finish time of the last update
         if lastSchedTime is None:
-            return curDatetime
+            ret = curDatetime
         else:
-            return max(lastSchedTime + interval, curDatetime)
+            ret = max(lastSchedTime + max(interval, self._getJobEstimatedDuration(jobId, lastSchedTime)), curDatetime)
+
+        # interval jobs are shifted into the prefered update periods
+        if self.planner.hasPeriod():
+            ret = self.planner.plan(jobId, ret, self._getJobEstimatedDuration(jobId, ret))
+
+        return ret
+
+
+class _UpdatePeriodPlanner:
+
+    """
+    Shifts the start time of jobs into the prefered update periods (the "preferedUpdatePeriodList"
+    item in main config file, a period starts at a cron expression and lasts for some hours), so
+    that heavy updates can finish before the period ends.
+    Each period occurrence has laneCount lanes (laneCount is the concurrent updater limit), jobs
+    are packed at the earliest time when a lane is free, using their estimated update duration.
+    Each job holds at most one reservation, it is replaced when the job is planned again and
+    released when the job is rescheduled by other means.
+    Jobs that don't fit into any period occurrence in the planning horizon are not shifted.
+    """
+
+    HORIZON = timedelta(days=16)
+
+    def __init__(self, preferedUpdatePeriodList, laneCount):
+        self.periodList = []                    # list<(cron-expression,timedelta)>
+        for item in preferedUpdatePeriodList:
+            self.periodList.append((item["start"], timedelta(hours=item["time"])))
+        self.laneCount = laneCount              # None means no limit
+        self.occurrenceList = []                # list<(startDatetime,endDatetime)>, sorted, covers [self.cacheBegin, self.cacheEnd)
+        self.cacheBegin = None
+        self.cacheEnd = None
+        self.laneDict = dict()                  # dict<(startDatetime,endDatetime),dict<id,(reservedStart,reservedEnd)>>
+        self.reservationDict = dict()           # dict<id,occurrence>
+
+    def dispose(self):
+        self.reservationDict = dict()
+        self.laneDict = dict()
+        self.occurrenceList = []
+
+    def hasPeriod(self):
+        return len(self.periodList) > 0
+
+    def plan(self, jobId, candidateDatetime, duration):
+        assert self.hasPeriod()
+
+        self.release(jobId)
+        self._prepareOccurrenceList(candidateDatetime)
+
+        # occurrences can overlap, so scan from the first occurrence which may still contain candidateDatetime
+        maxPeriodLength = max([x[1] for x in self.periodList])
+        i = bisect.bisect_left(self.occurrenceList, (candidateDatetime - maxPeriodLength,))
+        for occurrence in self.occurrenceList[i:]:
+            startDatetime, endDatetime = occurrence
+            if endDatetime <= candidateDatetime:
+                continue
+            if startDatetime > candidateDatetime + self.HORIZON:
+                break
+            if self.laneCount is None:
+                ret = max(candidateDatetime, startDatetime)
+                if ret + duration <= endDatetime:
+                    return ret
+            else:
+                reservedDict = self.laneDict.setdefault(occurrence, dict())
+                ret = self._findFreeLane(reservedDict.values(), max(candidateDatetime, startDatetime), duration)
+                if ret + duration <= endDatetime:
+                    reservedDict[jobId] = (ret, ret + duration)
+                    self.reservationDict[jobId] = occurrence
+                    return ret
+
+        return candidateDatetime
+
+    def release(self, jobId):
+        occurrence = self.reservationDict.pop(jobId, None)
+        if occurrence is not None:
+            del self.laneDict[occurrence][jobId]
+
+    def _findFreeLane(self, reservedList, beginDatetime, duration):
+        # returns the earliest time not before beginDatetime when a lane is free during [time, time+duration)
+        # such time is either beginDatetime or the end of a reservation
+        for t in sorted(set([beginDatetime] + [x[1] for x in reservedList if x[1] > beginDatetime])):
+            overlapList = [x for x in reservedList if x[0] < t + duration and t < x[1]]
+            if len(overlapList) < self.laneCount:
+                return t
+            # the number of busy lanes changes only at the start of a reservation
+            pointList = [t] + [x[0] for x in overlapList if x[0] > t]
+            if max([len([x for x in overlapList if x[0] <= p < x[1]]) for p in pointList]) < self.laneCount:
+                return t
+        assert False
+
+    def _prepareOccurrenceList(self, candidateDatetime):
+        if self.cacheBegin is not None and self.cacheBegin <= candidateDatetime and candidateDatetime + self.HORIZON < self.cacheEnd:
+            return
+
+        maxPeriodLength = max([x[1] for x in self.periodList])
+        self.cacheBegin = min(candidateDatetime, datetime.now()) - timedelta(hours=1)
+        self.cacheEnd = candidateDatetime + self.HORIZON * 2
+
+        self.occurrenceList = []
+        for cronExpr, length in self.periodList:
+            it = croniter(cronExpr, self.cacheBegin - maxPeriodLength, datetime)
+            while True:
+                startDatetime = it.get_next()
+                if startDatetime >= self.cacheEnd:
+                    break
+                self.occurrenceList.append((startDatetime, startDatetime + length))
+        self.occurrenceList.sort()
+
+        # remove lane information of expired occurrences
+        for occurrence in list(self.laneDict.keys()):
+            if occurrence[1] <= self.cacheBegin:
+                for jobId in self.laneDict.pop(occurrence):
+                    del self.reservationDict[jobId]
 
 
 class _UpdateHistory:
 
+    """
+    Update history is stored in an append-only journal file made of fixed size records:
+      header: magic "MCUPDHIS", version (uint32), record size (uint32)
+      record: type (uint8), is-successful (uint8), 6 bytes reserved, start-time (int64), end-time (int64),
+              bytes-transferred (uint64), files-added (uint32), files-removed (uint32)
+    Time is stored as seconds since epoch. Only the tail of the journal is read when loading, so that
+    loading takes constant time, statistics are calculated on demand by scanning the whole journal.
+    The journal is compacted when it contains too many records.
+    Legacy text format file is converted to journal when loaded.
+
+    Update duration is estimated from the recent records. Successful and failed updates are modeled
+    separately, each model keeps an EWMA and the recent samples, both globally and for each
+    (weekday, hour) bucket of the start time. The bucket model is used only when it has enough samples.
+    """
+
+    HEADER_FMT = "<8sII"
+    RECORD_FMT = "<BB6xqqQII"
+    MAGIC = b"MCUPDHIS"
+    VERSION = 1
+
+    RECORD_TYPE_INIT = 1
+    RECORD_TYPE_UPDATE = 2
+
+    RECENT_COUNT = 10                           # number of records which are kept in memory
+    COMPACT_COUNT = 4096                        # compact the journal when it contains this number of records
+    RETENTION_COUNT = 2048                      # max number of records kept after compaction
+    RETENTION_PERIOD = timedelta(days=180)      # records older than this are dropped by compaction
+
+    ESTIMATE_RECORD_COUNT = 512                 # number of records used to build duration models when loading
+    ESTIMATE_ALPHA = 0.3                        # EWMA smoothing factor
+    ESTIMATE_SAMPLE_COUNT = 32                  # samples kept in each duration model for percentile calculation
+    ESTIMATE_MIN_BUCKET_SAMPLE_COUNT = 3        # use global model if the bucket model has fewer samples
+    ESTIMATE_PERCENTILE = 90                    # used by pessimistic estimation
+
     def __init__(self, updateHistoryFilename, needInitialization=True):
         self._updateFn = updateHistoryFilename
         self._needInit = needInitialization
-        self._maxLen = 10
-
-        if not self._needInit:
-            McUtil.touchFile(self._updateFn)
-
-        self._updateInfoList = []
-        self._readFromFile()
+        self._headerSize = struct.calcsize(self.HEADER_FMT)
+        self._recordSize = struct.calcsize(self.RECORD_FMT)
+
+        self._recordCount = 0
+        self._updateInfoList = []               # recent records, list order: from old to new
+        self._statistics = None                 # cached result of self.getStatistics()
+        self._estimateModelDict = dict()        # dict<(bSuccess,bucket),[ewma,list<duration>]>, bucket is None for global model, unit: seconds
+        if os.path.exists(self._updateFn):
+            self._load()
+        elif not self._needInit:
+            self._writeJournal(self._updateFn, [])
 
         self._averageUpdateDuration = None      # unit: seconds
         self._calcAverageDuration()
@@ -703,7 +1220,54 @@ class _UpdateHistory:
     def getAverageUpdateDuration(self):
         return self._averageUpdateDuration
 
-    def initFinished(self, endTime):
+    def getEstimatedUpdateDuration(self, startTime, bSuccess=True, pessimistic=False):
+        # returns None if there's no history
+        # pessimistic estimation is the larger one of EWMA and the percentile, used to avoid overlapping
+        model = self._estimateModelDict.get((bSuccess, (startTime.weekday(), startTime.hour)))
+        if model is None or len(model[1]) < self.ESTIMATE_MIN_BUCKET_SAMPLE_COUNT:
+            model = self._estimateModelDict.get((bSuccess, None))
+        if model is None:
+            return None
+
+        ret = model[0]
+        if pessimistic:
+            ret = max(ret, self.__percentile(sorted(model[1]), self.ESTIMATE_PERCENTILE))
+        return timedelta(seconds=ret)
+
+    def getStatistics(self):
+        # returns statistics of all the records in the journal, durations are in seconds
+        if self._statistics is None:
+            durationList = []
+            updateCount = 0
+            failCount = 0
+            bytesTransferred = 0
+            filesAdded = 0
+            filesRemoved = 0
+            for obj in self._readRecords(0, self._recordCount):
+                bytesTransferred += obj.bytesTransferred
+                filesAdded += obj.filesAdded
+                filesRemoved += obj.filesRemoved
+                if obj.startTime is None:
+                    continue
+                updateCount += 1
+                if obj.bSuccess:
+                    durationList.append((obj.endTime - obj.startTime).total_seconds())
+                else:
+                    failCount += 1
+            durationList.sort()
+
+            self._statistics = {
+                "update-count": updateCount,
+                "failure-rate": (failCount / updateCount if updateCount > 0 else 0),
+                "duration-p50": self.__percentile(durationList, 50),
+                "duration-p95": self.__percentile(durationList, 95),
+                "bytes-transferred": bytesTransferred,
+                "files-added": filesAdded,
+                "files-removed": filesRemoved,
+            }
+        return self._statistics
+
+    def initFinished(self, endTime, bytesTransferred=0, filesAdded=0, filesRemoved=0):
         assert self._needInit
         assert len(self._updateInfoList) == 0
 
@@ -712,44 +1276,134 @@ class _UpdateHistory:
         obj.bSuccess = True
         obj.startTime = None
         obj.endTime = endTime
-        self._updateInfoList.append(obj)
-
-        # save to file
-        self._saveToFile()
-
-    def updateFinished(self, bSuccess, startTime, endTime):
-        # remove init-item
-        if len(self._updateInfoList) > 0 and self._updateInfoList[-1].startTime is None:
-            assert len(self._updateInfoList) == 1
-            self._updateInfoList = []
-
-        # remove update-failed-item
-        # we only store the last one update-failed-item
-        if len(self._updateInfoList) > 0 and not self._updateInfoList[-1].bSuccess:
-            del self._updateInfoList[-1]
+        obj.bytesTransferred = bytesTransferred
+        obj.filesAdded = filesAdded
+        obj.filesRemoved = filesRemoved
+        self._append(obj)
 
+    def updateFinished(self, bSuccess, startTime, endTime, bytesTransferred=0, filesAdded=0, filesRemoved=0):
         # add update-item
         obj = DynObject()
         obj.bSuccess = bSuccess
         obj.startTime = startTime
         obj.endTime = endTime
-        self._updateInfoList.append(obj)
-
-        # keep list length
-        while len(self._updateInfoList) >= self._maxLen:
-            self._updateInfoList.pop(0)
+        obj.bytesTransferred = bytesTransferred
+        obj.filesAdded = filesAdded
+        obj.filesRemoved = filesRemoved
+        self._append(obj)
 
         # post processing
         self._calcAverageDuration()
-        self._saveToFile()
 
-    def _readFromFile(self):
+    def _append(self, obj):
+        if not os.path.exists(self._updateFn):
+            self._writeJournal(self._updateFn, [])
+        with open(self._updateFn, "ab") as f:
+            f.write(self._packRecord(obj))
+        self._recordCount += 1
+
+        self._updateInfoList.append(obj)
+        if len(self._updateInfoList) > self.RECENT_COUNT:
+            self._updateInfoList.pop(0)
+        self._addEstimateSample(obj)
+        self._statistics = None
+
+        if self._recordCount >= self.COMPACT_COUNT:
+            self._compact()
+
+    def _load(self):
+        with open(self._updateFn, "rb") as f:
+            buf = f.read(self._headerSize)
+            if len(buf) == self._headerSize and buf.startswith(self.MAGIC):
+                magic, version, recordSize = struct.unpack(self.HEADER_FMT, buf)
+                if version != self.VERSION or recordSize != self._recordSize:
+                    raise Exception("unsupported update history file \"%s\"" % (self._updateFn))
+                size = os.fstat(f.fileno()).st_size
+            else:
+                size = None
+
+        if size is None:
+            # convert legacy text format file, the legacy file is kept until the journal is completely written
+            self._replaceJournal(self._readLegacyFile())
+            size = os.path.getsize(self._updateFn)
+
+        self._recordCount = (size - self._headerSize) // self._recordSize
+        if self._headerSize + self._recordCount * self._recordSize != size:
+            # remove the incomplete record left by an interrupted write
+            logging.warning("Incomplete record found in file \"%s\"." % (self._updateFn))
+            os.truncate(self._updateFn, self._headerSize + self._recordCount * self._recordSize)
+
+        start = max(self._recordCount - self.ESTIMATE_RECORD_COUNT, 0)
+        tlist = self._readRecords(start, self._recordCount)
+        for obj in tlist:
+            self._addEstimateSample(obj)
+        self._updateInfoList = tlist[-self.RECENT_COUNT:]
+
+    def _compact(self):
+        minEndTime = datetime.now() - self.RETENTION_PERIOD
+        tlist = self._readRecords(max(self._recordCount - self.RETENTION_COUNT, 0), self._recordCount)
+        tlist = [x for x in tlist if x.endTime >= minEndTime or x is tlist[-1]]
+        self._replaceJournal(tlist)
+        self._recordCount = len(tlist)
+
+    def _replaceJournal(self, objList):
+        # the new journal is written to a temporary file and renamed into place after it is on disk,
+        # so that the old file is still intact if we are interrupted
+        tmpFn = self._updateFn + ".tmp"
+        self._writeJournal(tmpFn, objList, bSync=True)
+        os.rename(tmpFn, self._updateFn)
+        dirFd = os.open(os.path.dirname(os.path.abspath(self._updateFn)), os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+
+    def _readRecords(self, start, end):
+        ret = []
+        with open(self._updateFn, "rb") as f:
+            f.seek(self._headerSize + start * self._recordSize)
+            buf = f.read((end - start) * self._recordSize)
+        for i in range(0, len(buf) // self._recordSize):
+            ret.append(self._unpackRecord(buf[i * self._recordSize:(i + 1) * self._recordSize]))
+        return ret
+
+    def _writeJournal(self, filename, objList, bSync=False):
+        with open(filename, "wb") as f:
+            f.write(struct.pack(self.HEADER_FMT, self.MAGIC, self.VERSION, self._recordSize))
+            for obj in objList:
+                f.write(self._packRecord(obj))
+            if bSync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _packRecord(self, obj):
+        if obj.startTime is None:
+            recordType = self.RECORD_TYPE_INIT
+            startTime = -1
+        else:
+            recordType = self.RECORD_TYPE_UPDATE
+            startTime = int(obj.startTime.timestamp())
+        return struct.pack(self.RECORD_FMT, recordType, obj.bSuccess, startTime, int(obj.endTime.timestamp()), obj.bytesTransferred, min(obj.filesAdded, 0xFFFFFFFF), min(obj.filesRemoved, 0xFFFFFFFF))
+
+    def _unpackRecord(self, buf):
+        recordType, bSuccess, startTime, endTime, bytesTransferred, filesAdded, filesRemoved = struct.unpack(self.RECORD_FMT, buf)
+        obj = DynObject()
+        obj.bSuccess = bool(bSuccess)
+        obj.startTime = datetime.fromtimestamp(startTime) if recordType == self.RECORD_TYPE_UPDATE else None
+        obj.endTime = datetime.fromtimestamp(endTime)
+        obj.bytesTransferred = bytesTransferred
+        obj.filesAdded = filesAdded
+        obj.filesRemoved = filesRemoved
+        return obj
+
+    def _readLegacyFile(self):
+        ret = []
         lineList = McUtil.readFile(self._updateFn, defaultContent="").split("\n")
         for i in range(0, len(lineList)):
             if lineList[i].strip() == "" or lineList[i].startswith("#"):
                 continue
             try:
-                m = re.fullmatch(" *(\\S+) +(\\S+ \\S+) +(\\S+ \\S+) *", lineList[i])
+                m = re.fullmatch(" *(\\S+) +(none|\\S+ \\S+) +(\\S+ \\S+) *", lineList[i])
                 if m is None:
                     raise ValueError()
                 obj = DynObject()
@@ -767,32 +1421,41 @@ class _UpdateHistory:
                     obj.startTime = datetime.strptime(m.group(2), McUtil.stdTmFmt())
                 # column 3
                 obj.endTime = datetime.strptime(m.group(3), McUtil.stdTmFmt())
+                # no such information in legacy file
+                obj.bytesTransferred = 0
+                obj.filesAdded = 0
+                obj.filesRemoved = 0
                 # record data
-                self._updateInfoList.append(obj)
+                ret.append(obj)
             except ValueError:
                 logging.warning("Line %d is invalid in file \"%s\"." % (i + 1, self._updateFn))
                 logging.warning(lineList[i])
-
-    def _saveToFile(self):
-        with open(self._updateFn, "w") as f:
-            f.write("# is-successful             start-time             end-time\n")
-            for item in self._updateInfoList:
-                if item.bSuccess:
-                    f.write("  true                    ")
-                else:
-                    f.write("  false                   ")
-                if item.startTime is None:
-                    f.write("  none                   ")
-                else:
-                    f.write("  " + item.startTime.strftime(McUtil.stdTmFmt()) + "    ")
-                if True:
-                    f.write(item.endTime.strftime(McUtil.stdTmFmt()) + "\n")
+        return ret
 
     def _calcAverageDuration(self):
         tlist = [x for x in self._updateInfoList if x.startTime is not None and x.bSuccess]     # remove init-item and update-failed-item
         if len(tlist) > 0:
-            tlist = [(x.endTime - x.startTime).total_seconds() // 60 for x in tlist]
-            self._averageUpdateDuration = statistics.mean(tlist)
-            self._averageUpdateDuration = min(1, int(self._averageUpdateDuration))
+            tlist = [(x.endTime - x.startTime).total_seconds() for x in tlist]
+            self._averageUpdateDuration = max(1, int(statistics.mean(tlist)))
         else:
-            self._averageUpdateDuration = 1
+            self._averageUpdateDuration = 60
+
+    def _addEstimateSample(self, obj):
+        if obj.startTime is None:
+            return
+        duration = max((obj.endTime - obj.startTime).total_seconds(), 0)
+        for bucket in [None, (obj.startTime.weekday(), obj.startTime.hour)]:
+            model = self._estimateModelDict.get((obj.bSuccess, bucket))
+            if model is None:
+                self._estimateModelDict[(obj.bSuccess, bucket)] = [duration, [duration]]
+            else:
+                model[0] = self.ESTIMATE_ALPHA * duration + (1 - self.ESTIMATE_ALPHA) * model[0]
+                model[1].append(duration)
+                if len(model[1]) > self.ESTIMATE_SAMPLE_COUNT:
+                    model[1].pop(0)
+
+    @staticmethod
+    def __percentile(sortedList, percent):
+        if len(sortedList) == 0:
+            return None
+        return sortedList[min(len(sortedList) * percent // 100, len(sortedList) - 1)]
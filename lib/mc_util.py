@@ -7,18 +7,24 @@ import imp
 import time
 import dbus
 import json
+import gzip
 import stat
+import errno
 import prctl
 import ctypes
 import struct
 import shutil
 import random
-import psutil
 import socket
+import select
+import asyncio
 import hashlib
 import logging
 import traceback
+import threading
 import subprocess
+import collections
+import concurrent.futures
 from gi.repository import GLib
 from OpenSSL import crypto
 from dbus.mainloop.glib import DBusGMainLoop
@@ -313,46 +319,121 @@ class McUtil:
                 assert False
 
     @staticmethod
-    def getFreeSocketPort(portType):
-        if portType == "tcp":
-            stlist = [socket.SOCK_STREAM]
-        elif portType == "udp":
-            stlist = [socket.SOCK_DGRAM]
-        elif portType == "tcp+udp":
-            stlist = [socket.SOCK_STREAM, socket.SOCK_DGRAM]
-        else:
-            assert False
-
-        for port in range(10000, 65536):
-            bFound = True
-            for sType in stlist:
-                s = socket.socket(socket.AF_INET, sType)
+    def callInParallel(funcDict, maxWorkers=None):
+        """Calls the functions in funcDict concurrently in threads, funcDict is dict<key,func>.
+           Returns (dict<key,result>, dict<key,exception>), results of the successful calls are
+           returned even if some calls failed, so that the caller can dispose them."""
+
+        resultDict = dict()
+        errorDict = dict()
+        if len(funcDict) == 0:
+            return (resultDict, errorDict)
+        if maxWorkers is None:
+            maxWorkers = min(32, len(funcDict))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            futureDict = {executor.submit(func): key for key, func in funcDict.items()}
+            for future in concurrent.futures.as_completed(futureDict):
                 try:
-                    s.bind((('', port)))
-                except socket.error:
-                    bFound = False
-                finally:
-                    s.close()
-            if bFound:
-                return port
-
-        raise Exception("no valid port")
+                    resultDict[futureDict[future]] = future.result()
+                except Exception as e:
+                    errorDict[futureDict[future]] = e
+        return (resultDict, errorDict)
 
     @staticmethod
     def waitSocketPortForProc(portType, ip, port, proc, timeout=10):
+        # returns the time-to-ready in seconds
+        # probes the port directly instead of scanning all the sockets on the host, polling interval grows from 10ms to 100ms
         assert portType in ["tcp", "udp"]
-        for i in range(0, timeout*10):
+        startTime = time.monotonic()
+        interval = 0.01
+        while True:
             if proc.poll() is not None:
                 raise Exception("process terminated")
-            time.sleep(0.1)
-            for c in psutil.net_connections(kind=portType):
-                # if c.pid == proc.pid and c.status == "LISTEN":        # FIXME: for apache, c.pid is wrong, result of netstat is right
-                if c.status == "LISTEN":
-                    if c.family == socket.AF_INET and c.laddr[0] == ip and c.laddr[1] == port:
-                        return
-                    if ip == "0.0.0.0" and c.family == socket.AF_INET6 and c.laddr[0] == "::" and c.laddr[1] == port:
-                        return
-        raise Exception("timeout")
+            if McUtil.isSocketPortReady(portType, ip, port):
+                return time.monotonic() - startTime
+            if time.monotonic() - startTime >= timeout:
+                raise Exception("timeout")
+            time.sleep(interval)
+            interval = min(interval * 2, 0.1)
+
+    @staticmethod
+    async def waitSocketPortForProcAsync(portType, ip, port, proc, timeout=10):
+        # same as waitSocketPortForProc(), but waits on the asyncio event loop
+        assert portType in ["tcp", "udp"]
+        startTime = time.monotonic()
+        interval = 0.01
+        while True:
+            if proc.poll() is not None:
+                raise Exception("process terminated")
+            if portType == "tcp":
+                bReady = await McUtil._probeTcpPortAsync(ip, port)
+            else:
+                bReady = McUtil._probeUdpPort(port)
+            if bReady:
+                return time.monotonic() - startTime
+            if time.monotonic() - startTime >= timeout:
+                raise Exception("timeout")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 0.1)
+
+    @staticmethod
+    def isSocketPortReady(portType, ip, port):
+        assert portType in ["tcp", "udp"]
+        if portType == "tcp":
+            return McUtil._probeTcpPort(ip, port)
+        else:
+            return McUtil._probeUdpPort(port)
+
+    @staticmethod
+    def _getProbeAddress(ip, port):
+        # connect to loopback address if the server listens on all addresses
+        if ip in ["", "0.0.0.0"]:
+            return (socket.AF_INET, ("127.0.0.1", port))
+        elif ip == "::":
+            return (socket.AF_INET6, ("::1", port))
+        elif ":" in ip:
+            return (socket.AF_INET6, (ip, port))
+        else:
+            return (socket.AF_INET, (ip, port))
+
+    @staticmethod
+    def _probeTcpPort(ip, port):
+        # non-blocking connect, connecting to a local address completes or fails immediately in most cases
+        family, addr = McUtil._getProbeAddress(ip, port)
+        with socket.socket(family, socket.SOCK_STREAM) as s:
+            s.setblocking(False)
+            err = s.connect_ex(addr)
+            if err == errno.EINPROGRESS:
+                if len(select.select([], [s], [], 0.1)[1]) == 0:
+                    return False
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            return err == 0
+
+    @staticmethod
+    async def _probeTcpPortAsync(ip, port):
+        family, addr = McUtil._getProbeAddress(ip, port)
+        with socket.socket(family, socket.SOCK_STREAM) as s:
+            s.setblocking(False)
+            try:
+                await asyncio.wait_for(asyncio.get_running_loop().sock_connect(s, addr), 0.1)
+                return True
+            except (OSError, asyncio.TimeoutError):
+                return False
+
+    @staticmethod
+    def _probeUdpPort(port):
+        # there's no way to probe an udp port without side effect, so check the socket tables in /proc
+        # only the port is compared, it is allocated by ourself
+        for fn in ["/proc/net/udp", "/proc/net/udp6"]:
+            if not os.path.exists(fn):
+                continue
+            with open(fn, "r") as f:
+                next(f)                                                         # skip header line
+                for line in f:
+                    localAddr = line.split(None, 2)[1]                          # example: "0100007F:1F90"
+                    if int(localAddr.rsplit(":", 1)[1], 16) == port:
+                        return True
+        return False
 
     @staticmethod
     def touchFile(filename):
@@ -397,10 +478,18 @@ class DynObject:
 
 class UnixDomainSocketApiServer:
 
-    def __init__(self, serverFile, clientAppearFunc, clientDisappearFunc, notifyFunc):
+    """
+    Line based JSON message server on a unix domain socket, running in an asyncio event loop.
+    Each message is a JSON object followed by a newline. A message larger than maxMessageSize breaks
+    the connection. Messages are processed in order, reading is paused while the receive buffer is
+    full, so a fast client can't make the server buffer unlimited data.
+    """
+
+    def __init__(self, serverFile, clientAppearFunc, clientDisappearFunc, notifyFunc, loop=None, maxMessageSize=64 * 1024):
         # Parameter clientAppearFunc is called after client appears.
         # Parameter clientDisappearFunc is called after we find client disappears and before we destroy the client object.
         # Parameter clientDisappearFunc can be None.
+        # Parameter loop is the asyncio event loop, use the current event loop if it is None.
 
         assert serverFile is not None
         assert clientAppearFunc is not None and notifyFunc is not None
@@ -408,83 +497,90 @@ class UnixDomainSocketApiServer:
         self.clientAppearFunc = clientAppearFunc
         self.clientDisappearFunc = clientDisappearFunc
         self.notifyFunc = notifyFunc
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.maxMessageSize = maxMessageSize
 
-        self.serverSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.serverSock.bind(serverFile)
-        self.serverSock.listen(5)
-        self.serverSourceId = GLib.io_add_watch(self.serverSock, GLib.IO_IN, self.onServerAccept)
-
-        self.clientInfoDict = dict()
+        self.clientInfoDict = dict()            # dict<task,client-info>
+        self.server = self.loop.run_until_complete(asyncio.start_unix_server(self._onClient, serverFile, limit=self.maxMessageSize))
 
     def dispose(self):
-        for sock, obj in self.clientInfoDict.items():
-            GLib.source_remove(obj.inWatch)
-            sock.close()
-        GLib.source_remove(self.serverSourceId)
-        self.serverSock.close()
+        taskList = list(self.clientInfoDict.keys())
+        for task in taskList:
+            task.cancel()
+        self.server.close()
+        if not self.loop.is_running():
+            self.loop.run_until_complete(asyncio.gather(*taskList, return_exceptions=True))
+        self.clientInfoDict = dict()
 
-    def onServerAccept(self, source, cb_condition):
+    def getClientStatistics(self, clientData):
+        for obj in self.clientInfoDict.values():
+            if obj.clientData == clientData:
+                return {
+                    "connect-time": obj.connectTime,
+                    "message-count": obj.messageCount,
+                    "byte-count": obj.byteCount,
+                    "max-message-size": obj.maxMessageSize,
+                    "error-count": obj.errorCount,
+                }
+        return None
+
+    async def _onClient(self, reader, writer):
         # event callback, no exception is allowed
 
-        new_sock, addr = source.accept()
-
         try:
-            data = self.clientAppearFunc(new_sock)
+            data = self.clientAppearFunc(writer.get_extra_info("socket"))
         except Exception:
             # absorb exception raised by upper layer function
             traceback.print_exc()
-            new_sock.close()
-            return True
+            writer.close()
+            return
 
         obj = DynObject()
-        obj.inWatch = GLib.io_add_watch(new_sock, GLib.IO_IN | GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL, self.onRecv)
-        obj.recvBuf = b''
         obj.clientData = data
-        self.clientInfoDict[new_sock] = obj
-        return True
-
-    def onRecv(self, source, cb_condition):
-        bCloseSocket = False
+        obj.connectTime = time.time()
+        obj.messageCount = 0
+        obj.byteCount = 0
+        obj.maxMessageSize = 0
+        obj.errorCount = 0
+        task = asyncio.current_task()
+        self.clientInfoDict[task] = obj
+
+        bDisappear = True
         try:
-            obj = self.clientInfoDict[source]
-
-            # receive and parse
-            obj.recvBuf += source.recv(4096)
             while True:
-                i = obj.recvBuf.find(b'\n')
-                if i < 0:
+                line = await reader.readline()
+                if line == b'':
                     break
-                jsonObj = json.loads(obj.recvBuf[:i].decode("utf-8"))
-                obj.recvBuf = obj.recvBuf[i + 1:]
+                if not line.endswith(b'\n'):
+                    raise Exception("remote close")
+
+                obj.messageCount += 1
+                obj.byteCount += len(line)
+                obj.maxMessageSize = max(obj.maxMessageSize, len(line))
                 try:
-                    self.notifyFunc(obj.clientData, jsonObj)
+                    self.notifyFunc(obj.clientData, json.loads(line.decode("utf-8")))
                 except Exception:
-                    # absorb exception raised by upper layer function, FIXME
-                    print("upper layer exception")
+                    # absorb exception raised by upper layer function or caused by invalid message
+                    obj.errorCount += 1
                     traceback.print_exc()
-                    raise
 
-            # remote closed
-            if (cb_condition & GLib.IO_HUP):
-                bCloseSocket = True
-                if len(obj.recvBuf) > 0:
-                    raise Exception("remote close")
+                # don't starve other event sources when the client sends a burst of messages
+                if obj.messageCount % 64 == 0:
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            bDisappear = False
         except Exception:
-            print("excp IO_IN, %d" % (cb_condition & GLib.IO_IN))               # FIXME
-            print("excp IO_PRI, %d" % (cb_condition & GLib.IO_PRI))
-            print("excp IO_ERR, %d" % (cb_condition & GLib.IO_ERR))
-            print("excp IO_HUP, %d" % (cb_condition & GLib.IO_HUP))
-            print("excp IO_NVAL, %d" % (cb_condition & GLib.IO_NVAL))
+            # connection error, incomplete message, or message is larger than self.maxMessageSize
             traceback.print_exc()
         finally:
-            if bCloseSocket:
-                if self.clientDisappearFunc is not None:
-                    self.clientDisappearFunc(self.clientInfoDict[source].clientData)
-                del self.clientInfoDict[source]
-                source.close()
-                return False
-            else:
-                return True
+            if bDisappear and self.clientDisappearFunc is not None:
+                try:
+                    self.clientDisappearFunc(obj.clientData)
+                except Exception:
+                    traceback.print_exc()
+            if task in self.clientInfoDict:
+                del self.clientInfoDict[task]
+            writer.close()
 
 
 class DropPriviledge:
@@ -693,6 +789,126 @@ class AvahiServiceRegister:
         return False
 
 
+class PortAllocator:
+    """
+    Hands out the listening ports of storages and advertisers from a port range.
+    A port allocated with a key (for example "advertiser-ftp") is recorded in dataFile, so the
+    component gets the same port, and the same URL, after the daemon restarts.
+    Ports without a key are transient, they go back to the free list when released.
+    Allocating is O(1): released ports are re-used first, then the range is consumed by a cursor,
+    only the candidate port is probed by binding.
+    Allocated ports are reserved until released, so concurrent callers (see McUtil.callInParallel)
+    never get the same port even if it is not bound yet.
+    """
+
+    def __init__(self, dataFile, portStart=10000, portEnd=65536):
+        self._dataFile = dataFile
+        self._portStart = portStart
+        self._portEnd = portEnd
+
+        self._lock = threading.Lock()
+        self._keyDict = dict()                                  # dict<key,port>
+        self._usedPortSet = set()                               # ports allocated in this run
+        self._freeQueue = collections.deque()                   # released transient ports
+        self._cursor = portStart
+
+        if os.path.exists(self._dataFile):
+            with open(self._dataFile, "r") as f:
+                buf = f.read()
+                if buf != "":
+                    self._keyDict = json.loads(buf)
+        self._keyPortSet = set(self._keyDict.values())
+
+    def allocatePort(self, key, portType="tcp"):
+        with self._lock:
+            if key is not None and key in self._keyDict:
+                port = self._keyDict[key]
+                if port not in self._usedPortSet and self._isPortFree(portType, port):
+                    self._usedPortSet.add(port)
+                    return port
+                logging.warning("Port %d recorded for %s is not available, allocating a new one." % (port, key))
+
+            port = self._allocateFreePort(portType)
+            self._usedPortSet.add(port)
+            if key is not None:
+                self._keyPortSet.discard(self._keyDict.get(key))
+                self._keyDict[key] = port
+                self._keyPortSet.add(port)
+                self._save()
+            return port
+
+    def releasePort(self, port):
+        # releasing a port twice is a no-op, the port must not be queued twice and handed out to two owners
+        with self._lock:
+            if port not in self._usedPortSet:
+                logging.warning("Port %d is released but it is not allocated." % (port))
+                return
+            self._usedPortSet.remove(port)
+            if port not in self._keyPortSet:
+                self._freeQueue.append(port)
+
+    def allocateListenSocket(self, key, ip, portType="tcp"):
+        # returns a bound socket which can be inherited by child processes, listening if it is a tcp socket
+        port = self.allocatePort(key, portType)
+        try:
+            family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+            if portType == "tcp":
+                s = socket.socket(family, socket.SOCK_STREAM)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind((ip, port))
+                s.listen(socket.SOMAXCONN)
+            elif portType == "udp":
+                s = socket.socket(family, socket.SOCK_DGRAM)
+                s.bind((ip, port))
+            else:
+                assert False
+            s.set_inheritable(True)
+            return s
+        except Exception:
+            self.releasePort(port)
+            raise
+
+    def _allocateFreePort(self, portType):
+        while len(self._freeQueue) > 0:
+            port = self._freeQueue.popleft()
+            if self._isPortFree(portType, port):
+                return port
+        while self._cursor < self._portEnd:
+            port = self._cursor
+            self._cursor += 1
+            if port in self._keyPortSet or port in self._usedPortSet:
+                continue
+            if self._isPortFree(portType, port):
+                return port
+        raise Exception("no valid port")
+
+    def _isPortFree(self, portType, port):
+        if portType == "tcp":
+            stlist = [socket.SOCK_STREAM]
+        elif portType == "udp":
+            stlist = [socket.SOCK_DGRAM]
+        elif portType == "tcp+udp":
+            stlist = [socket.SOCK_STREAM, socket.SOCK_DGRAM]
+        else:
+            assert False
+
+        for sType in stlist:
+            with socket.socket(socket.AF_INET, sType) as s:
+                if sType == socket.SOCK_STREAM:
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)       # ignore the TIME_WAIT connections of the last run
+                try:
+                    s.bind(("", port))
+                except socket.error:
+                    return False
+        return True
+
+    def _save(self):
+        tmpFn = self._dataFile + ".tmp"
+        with open(tmpFn, "w") as f:
+            json.dump(self._keyDict, f, indent=4, sort_keys=True)
+        os.rename(tmpFn, self._dataFile)
+
+
 class RotatingFile:
     """
     By default, the file grows indefinitely. You can specify particular
@@ -710,54 +926,104 @@ class RotatingFile:
     and renamed to "app.log.1", and if files "app.log.1", "app.log.2" etc.
     exist, then they are renamed to "app.log.2", "app.log.3" etc.
     respectively.
+    If compress is True, the rotated files are compressed by gzip in a
+    background thread, and have extensions ".1.gz", ".2.gz" etc. The
+    compression jobs of all the RotatingFile objects are run one by one
+    by a shared worker thread, which also shifts the ".N.gz" files, so
+    write() and close() never wait for compression.
+    Each chunk of data is written by one write() call, it is only split
+    (at the last line end that fits) when rollover is needed.
     """
 
-    def __init__(self, filename, maxBytes, backupCount):
+    _compressExecutor = None
+    _compressSeq = 0
+
+    def __init__(self, filename, maxBytes, backupCount, compress=False):
         assert maxBytes > 0 and backupCount > 0
         self.baseFilename = filename
         self.maxBytes = maxBytes
         self.backupCount = backupCount
+        self.compress = compress
         self.f = open(self.baseFilename, "ab", buffering=0)
+        self._size = os.fstat(self.f.fileno()).st_size
 
     def write(self, s):
         assert self.f is not None
-        while s != b'':
-            # process one line at a time
-            try:
-                i = s.index(b'\n')
-                sCur = s[:i+1]
-                s = s[i+1:]
-            except ValueError:
-                sCur = s
-                s = b''
-
-            # do roll over
-            if self.f.tell() > 0 and self.f.tell() + len(sCur) >= self.maxBytes:
+        while self._size + len(s) >= self.maxBytes:
+            if self._size >= self.maxBytes:
+                # current file is already full (the last write has a line exceeding maxBytes)
                 self._doRollover()
-
-            # write line
-            self.f.write(sCur)
+                continue
+            # split at the last line end that fits into the current file
+            i = s.rfind(b'\n', 0, max(0, self.maxBytes - self._size - 1))
+            if i < 0 and self._size == 0:
+                # the current line of data exceeds maxBytes, write it as a whole
+                i = s.find(b'\n')
+                if i < 0 or i == len(s) - 1:
+                    break
+            if i >= 0:
+                self._write(s[:i + 1])
+                s = s[i + 1:]
+            self._doRollover()
+        if s != b'':
+            self._write(s)
 
     def close(self):
         assert self.f is not None
         self.f.close()
         self.f = None
 
+    @classmethod
+    def waitCompress(cls):
+        # blocks until all the queued compression jobs are done, don't call it in main loop
+        if cls._compressExecutor is not None:
+            cls._compressExecutor.submit(lambda: None).result()
+
+    def _write(self, s):
+        self.f.write(s)
+        self._size += len(s)
+
     def _doRollover(self):
         self.f.close()
         self.f = None
 
-        for i in range(self.backupCount - 1, 0, -1):
-            sfn = "%s.%d" % (self.baseFilename, i)
-            dfn = "%s.%d" % (self.baseFilename, i + 1)
+        if self.compress:
+            # the file being compressed has a unique name, so that rollover can go on while the previous compression is still running
+            RotatingFile._compressSeq += 1
+            dfn = "%s.%d.%d.pending" % (self.baseFilename, os.getpid(), RotatingFile._compressSeq)
+            os.rename(self.baseFilename, dfn)
+            if RotatingFile._compressExecutor is None:
+                RotatingFile._compressExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            RotatingFile._compressExecutor.submit(self._compressFile, dfn, self.baseFilename, self.backupCount)
+        else:
+            self._shiftFiles(self.baseFilename, self.backupCount, "")
+            os.rename(self.baseFilename, self.baseFilename + ".1")
+
+        self.f = open(self.baseFilename, "ab", buffering=0)
+        self._size = 0
+
+    @staticmethod
+    def _shiftFiles(baseFilename, backupCount, ext):
+        for i in range(backupCount - 1, 0, -1):
+            sfn = "%s.%d%s" % (baseFilename, i, ext)
+            dfn = "%s.%d%s" % (baseFilename, i + 1, ext)
             if os.path.exists(sfn):
                 if os.path.exists(dfn):
                     os.remove(dfn)
                 os.rename(sfn, dfn)
-
-        dfn = self.baseFilename + ".1"
+        dfn = "%s.1%s" % (baseFilename, ext)
         if os.path.exists(dfn):
             os.remove(dfn)
-        os.rename(self.baseFilename, dfn)
 
-        self.f = open(self.baseFilename, "a")
+    @staticmethod
+    def _compressFile(filename, baseFilename, backupCount):
+        # runs in the compress worker thread, backup files are shifted after the new one is completely compressed
+        try:
+            with open(filename, "rb") as src:
+                with gzip.open(filename + ".gz.tmp", "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            RotatingFile._shiftFiles(baseFilename, backupCount, ".gz")
+            os.rename(filename + ".gz.tmp", baseFilename + ".1.gz")
+            os.remove(filename)
+        except Exception:
+            logging.error("Failed to compress rotated file %s: %s" % (filename, traceback.format_exc()))
@@ -3,12 +3,16 @@
 
 import os
 import re
+import json
+import uuid
 import logging
 import mariadb
+import secrets
 import sqlparse
 import lxml.etree
 import subprocess
 from mc_util import McUtil
+from mc_param import McConst
 
 
 class Storage:
@@ -42,19 +46,42 @@ class Storage:
             # get advertise flag
             self._bAdvertiseDict[msId] = (len(xmlElem.xpath(".//advertise")) > 0)
 
+        # optional settings in /etc/mirrors/storage-mariadb.conf
+        self._bShared = param["config"].get("shared-instance", False)
+        self._sharedDataDir = param["config"].get("shared-instance-data-directory", os.path.join(McConst.varDir, "storage-mariadb"))
+
+        self._sharedServer = None
         self._serverDict = dict()                                   # {mirror-site-id:mariadb-server-object}
+        self._writeUserDict = dict()                                # {mirror-site-id:(user,password)}
         try:
             # create server objects
             # The best solution would be using a one-instance-mariadb-server, and dynamically
             # add table files stored in seperate directories as different databases.
             # Although basically mariadb supports this kind of operation, but there're
             # corner cases (for example when the server crashes).
-            for msId in self._mirrorSiteDict:
-                self._serverDict[msId] = _MariadbServer(param["listen-ip"], param["temp-directory"], param["log-directory"],
-                                                        msId,
-                                                        self._mirrorSiteDict[msId]["state-directory"],
-                                                        self._mirrorSiteDict[msId]["data-directory"],
-                                                        self._tableInfoDict[msId])
+            # This is the default mode, shared-instance mode is optional, see class _SharedMariadbServer.
+            if self._bShared:
+                self._sharedServer = _SharedMariadbServer(param["listen-ip"], param["port-allocator"], param["temp-directory"], param["log-directory"], self._sharedDataDir)
+                for msId in self._mirrorSiteDict:
+                    self._writeUserDict[msId] = self._sharedServer.attachDatabase(msId,
+                                                                                  self._mirrorSiteDict[msId]["state-directory"],
+                                                                                  self._mirrorSiteDict[msId]["data-directory"],
+                                                                                  self._tableInfoDict[msId])
+                    self._serverDict[msId] = self._sharedServer
+            else:
+                # servers are started concurrently
+                funcDict = dict()
+                for msId in self._mirrorSiteDict:
+                    funcDict[msId] = (lambda msId=msId: _MariadbServer(param["listen-ip"], param["port-allocator"], param["temp-directory"], param["log-directory"],
+                                                                       msId,
+                                                                       self._mirrorSiteDict[msId]["state-directory"],
+                                                                       self._mirrorSiteDict[msId]["data-directory"],
+                                                                       self._tableInfoDict[msId]))
+                self._serverDict, errorDict = McUtil.callInParallel(funcDict)
+                if len(errorDict) > 0:
+                    raise errorDict[sorted(errorDict.keys())[0]]
+                for msId, msObj in self._serverDict.items():
+                    self._writeUserDict[msId] = (msObj.dbWriteUser, msObj.dbWritePasword)
             # show log
             if any(self._bAdvertiseDict.values()):
                 logging.info("Advertiser (mariadb) started.")       # here we can not give out port information
@@ -63,8 +90,12 @@ class Storage:
             raise
 
     def dispose(self):
-        for msObj in self._serverDict.values():
-            msObj.dispose()
+        if self._sharedServer is not None:
+            self._sharedServer.dispose()
+            self._sharedServer = None
+        else:
+            for msObj in self._serverDict.values():
+                msObj.dispose()
         self._serverDict = dict()
 
     def get_param(self, mirror_site_id):
@@ -72,6 +103,8 @@ class Storage:
         return {
             "unix-socket-file": self._serverDict[mirror_site_id].dbSocketFile,
             "database": mirror_site_id,
+            "user": self._writeUserDict[mirror_site_id][0],
+            "password": self._writeUserDict[mirror_site_id][1],
         }
 
     def get_access_info(self, mirror_site_id):
@@ -82,12 +115,12 @@ class Storage:
         }
 
     def advertise_mirror_site(self, mirror_site_id):
-        self._serverDict[mirror_site_id].exportDatabase(mirror_site_id)
+        self._serverDict[mirror_site_id].exportDatabaseDir(mirror_site_id)
 
 
 class _MariadbServer:
 
-    def __init__(self, listenIp, tmpDir, logDir, databaseName, stateDir, dataDir, tableInfo):
+    def __init__(self, listenIp, portAllocator, tmpDir, logDir, databaseName, stateDir, dataDir, tableInfo):
         self._cfgFile = os.path.join(tmpDir, "mariadb-%s.cnf" % (databaseName))
         self._pidFile = os.path.join(tmpDir, "mariadb-%s.pid" % (databaseName))
         tableInfoRecordFile = os.path.join(stateDir, "MARIADB_TABLE_RECORD")
@@ -98,6 +131,7 @@ class _MariadbServer:
         self._dbWritePasswd = "write"
         self._dbReadUser = "anonymous"
 
+        self._portAllocator = portAllocator
         self._port = None
         self._proc = None
         try:
@@ -110,7 +144,7 @@ class _MariadbServer:
                 bJustInitialized = False
 
             # allocate listening port
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._port = self._portAllocator.allocatePort("storage-mariadb/%s" % (databaseName))
 
             # generate mariadb config file
             with open(self._cfgFile, "w") as f:
@@ -131,7 +165,8 @@ class _MariadbServer:
 
             # start mariadb
             self._proc = subprocess.Popen(["/usr/sbin/mysqld", "--defaults-file=%s" % (self._cfgFile)], cwd=tmpDir)
-            McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            readyTime = McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            logging.debug("Storage (mariadb): database server for %s ready in %.2f seconds." % (databaseName, readyTime))
 
             # post-initialize if needed
             if bJustInitialized:
@@ -149,6 +184,7 @@ class _MariadbServer:
             self._proc.wait()
             self._proc = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
         if os.path.exists(self._pidFile):
             os.unlink(self._pidFile)
@@ -345,23 +381,8 @@ class _MariadbServer:
         # ) ENGINE=InnoDB DEFAULT CHARSET=utf8
         # ====================================
 
-        with open(tableInfoRecordFile, "w") as f:
-            for tableName, value in tableInfo.items():
-                f.write("---- " + tableName + " ----\n")
-                f.write(value[1] + "\n")
-                f.write("\n")
-
         with mariadb.connect(unix_socket=socketFile, database=databaseName, user=self._dbWriteUser, password=self._dbWritePasswd) as conn:
-            cur = conn.cursor()
-            cur.execute("SHOW TABLES;")
-            tableNameList = [x[0] for x in cur.fetchall()]
-            with open(tableSchemaRecordFile, "w") as f:
-                for tableName in tableNameList:
-                    cur.execute("SHOW CREATE TABLE %s;" % (tableName))
-                    out = cur.fetchall()[0][1]
-                    f.write("---- " + tableName + " ----\n")
-                    f.write(out + "\n")
-                    f.write("\n")
+            _recordTableSchema(conn.cursor(), tableInfo, tableInfoRecordFile, tableSchemaRecordFile)
 
     def _check(self, databaseName, tableInfo, tableInfoRecordFile, tableSchemaRecordFile, socketFile):
         with mariadb.connect(unix_socket=socketFile, database=databaseName, user=self._dbWriteUser, password=self._dbWritePasswd) as conn:
@@ -379,26 +400,7 @@ class _MariadbServer:
                     raise Exception("invalid priviledge for %s user" % (self._dbWriteUser))
 
             # check table info
-            if True:
-                buf = ""
-                for tableName, value in tableInfo.items():
-                    buf += "---- " + tableName + " ----\n"
-                    buf += value[1] + "\n"
-                    buf += "\n"
-                if buf != McUtil.readFile(tableInfoRecordFile):
-                    raise Exception("table info changed")
-            if True:
-                cur.execute("SHOW TABLES;")
-                tableNameList = [x[0] for x in cur.fetchall()]
-                buf = ""
-                for tableName in tableNameList:
-                    cur.execute("SHOW CREATE TABLE %s;" % (tableName))
-                    out = cur.fetchall()[0][1]
-                    buf += "---- " + tableName + " ----\n"
-                    buf += out + "\n"
-                    buf += "\n"
-                if buf != McUtil.readFile(tableSchemaRecordFile):
-                    raise Exception("table schema in database changed")
+            _checkTableSchema(cur, tableInfo, tableInfoRecordFile, tableSchemaRecordFile)
 
         with mariadb.connect(unix_socket=socketFile, database=databaseName, user=self._dbReadUser) as conn:
             # check priviledge for anonymous user
@@ -411,3 +413,287 @@ class _MariadbServer:
                 raise Exception("invalid priviledge for %s user" % (self._dbWriteUser))
             if not lineList[1] == "GRANT SELECT, REFERENCES, INDEX, LOCK TABLES, EXECUTE, SHOW VIEW, EVENT, TRIGGER ON `%s`.* TO `%s`@`%%`" % (databaseName, self._dbReadUser):
                 raise Exception("invalid priviledge for %s user" % (self._dbWriteUser))
+
+
+class _SharedMariadbServer:
+
+    """
+    One mariadb server hosting the databases of all the mirror sites, enabled by "shared-instance" in
+    storage-mariadb.conf.
+    The system tables, InnoDB system tablespace and redo log are in the server's own data directory,
+    the database directory of a mirror site is in the data directory of the mirror site, and is attached
+    to the server by a symbolic link. Tables are stored with innodb-file-per-table.
+    Attaching is crash-safe: the instance id of the server is written into the data directory of the
+    mirror site only after the database is completely created, a database without the matching instance
+    id (never attached, interrupted when attaching, or attached to a server which is gone) is dropped
+    and created again.
+    Each database has its own write user, the users are re-created with new passwords every time the
+    server starts.
+    """
+
+    def __init__(self, listenIp, portAllocator, tmpDir, logDir, dataDir):
+        self._dataDir = dataDir
+        self._cfgFile = os.path.join(tmpDir, "mariadb.cnf")
+        self._pidFile = os.path.join(tmpDir, "mariadb.pid")
+        self._instanceIdFile = os.path.join(dataDir, "INSTANCE_ID")
+        self._adminPasswdFile = os.path.join(dataDir, "ADMIN_PASSWORD")
+
+        self._dbSocketFile = os.path.join(tmpDir, "mariadb.socket")
+        self._dbAdminUser = "admin"
+        self._dbReadUser = "anonymous"
+
+        self._portAllocator = portAllocator
+        self._port = None
+        self._proc = None
+        try:
+            # initialize if needed
+            if not self._isInitialized():
+                self._initialize(os.path.join(logDir, "mariadb-install-db.log"))
+            self._instanceId = McUtil.readFile(self._instanceIdFile)
+            self._dbAdminPasswd = McUtil.readFile(self._adminPasswdFile)
+
+            # allocate listening port
+            self._port = self._portAllocator.allocatePort("storage-mariadb")
+
+            # generate mariadb config file
+            with open(self._cfgFile, "w") as f:
+                buf = ""
+                buf += "[mariadb]\n"
+                if True:
+                    buf += "pid-file = %s\n" % (self._pidFile)
+                if True:
+                    buf += "socket = %s\n" % (self._dbSocketFile)
+                    buf += "bind-address = %s\n" % (listenIp)
+                    buf += "port = %d\n" % (self._port)
+                if True:
+                    buf += "datadir = %s\n" % (dataDir)
+                    buf += "transaction-isolation = SERIALIZABLE\n"
+                    buf += "innodb-file-per-table = 1\n"
+                if True:
+                    buf += "log-error = %s\n" % (os.path.join(logDir, "mariadb.err"))
+                f.write(buf)
+
+            # start mariadb
+            self._proc = subprocess.Popen(["/usr/sbin/mysqld", "--defaults-file=%s" % (self._cfgFile)], cwd=tmpDir)
+            readyTime = McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            logging.debug("Storage (mariadb): shared database server ready in %.2f seconds." % (readyTime))
+        except Exception:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+        if self._port is not None:
+            self._portAllocator.releasePort(self._port)
+            self._port = None
+        if os.path.exists(self._pidFile):
+            os.unlink(self._pidFile)
+        if os.path.exists(self._cfgFile):
+            os.unlink(self._cfgFile)
+
+    @property
+    def dbSocketFile(self):
+        return self._dbSocketFile
+
+    @property
+    def dbPort(self):
+        return self._port
+
+    @property
+    def dbReadUser(self):
+        return self._dbReadUser
+
+    def exportDatabaseDir(self, databaseName):
+        # FIXME, same as _MariadbServer.exportDatabaseDir()
+        pass
+
+    def attachDatabase(self, databaseName, stateDir, dataDir, tableInfo):
+        # returns (write-user,write-password)
+        dbDir = os.path.join(dataDir, databaseName)
+        linkFile = os.path.join(self._dataDir, databaseName)
+        instanceIdFile = os.path.join(dataDir, "MARIADB_INSTANCE_ID")
+        tableInfoRecordFile = os.path.join(stateDir, "MARIADB_TABLE_RECORD")
+        tableSchemaRecordFile = os.path.join(stateDir, "MARIADB_TABLE_SCHEMA_RECORD")
+
+        writeUser = "write-%s" % (databaseName)
+        writePasswd = secrets.token_hex(16)
+
+        with mariadb.connect(unix_socket=self._dbSocketFile, user=self._dbAdminUser, password=self._dbAdminPasswd) as conn:
+            cur = conn.cursor()
+
+            # create database if needed
+            if not os.path.exists(instanceIdFile) or McUtil.readFile(instanceIdFile) != self._instanceId:
+                McUtil.forceDelete(instanceIdFile)
+
+                # drop the old database, so that there's no stale table in the data dictionary of the server
+                McUtil.ensureDir(dbDir)
+                self._ensureLink(linkFile, dbDir)
+                cur.execute("DROP DATABASE IF EXISTS `%s`;" % (databaseName))
+
+                # database directory is a symbolic link, mariadb regards it as an existing database
+                McUtil.mkDirAndClear(dbDir)
+                self._ensureLink(linkFile, dbDir)
+                cur.execute("USE `%s`;" % (databaseName))
+                for tableName, value in tableInfo.items():
+                    cur.execute(value[1])
+                _recordTableSchema(cur, tableInfo, tableInfoRecordFile, tableSchemaRecordFile)
+
+                # attaching is completed
+                with open(instanceIdFile, "w") as f:
+                    f.write(self._instanceId)
+            else:
+                self._ensureLink(linkFile, dbDir)
+
+            # create users
+            cur.execute("CREATE OR REPLACE USER `%s`@`localhost` IDENTIFIED BY '%s';" % (writeUser, writePasswd))
+            cur.execute("GRANT ALL PRIVILEGES ON `%s`.* TO `%s`@`localhost`;" % (databaseName, writeUser))
+            cur.execute("GRANT SELECT, REFERENCES, INDEX, LOCK TABLES, EXECUTE, SHOW VIEW, EVENT, TRIGGER ON `%s`.* TO `%s`@`%%`;" % (databaseName, self._dbReadUser))
+
+            # check table info
+            cur.execute("USE `%s`;" % (databaseName))
+            _checkTableSchema(cur, tableInfo, tableInfoRecordFile, tableSchemaRecordFile)
+
+        return (writeUser, writePasswd)
+
+    def _isInitialized(self):
+        if not os.path.exists(os.path.join(self._dataDir, "mysql", "user.frm")):
+            # from /usr/share/mariadb/scripts/mysql_install_db
+            return False
+        elif os.path.exists(os.path.join(self._dataDir, "initialize.failed")):
+            # from self._initialize()
+            return False
+        else:
+            return True
+
+    def _initialize(self, logFile):
+        McUtil.ensureDir(os.path.dirname(self._dataDir))
+        McUtil.mkDirAndClear(self._dataDir)
+        McUtil.touchFile(os.path.join(self._dataDir, "initialize.failed"))
+
+        adminPasswd = secrets.token_hex(16)
+        commands = []
+
+        # the following commands are from script /usr/share/mariadb/scripts/mariadb-install-db
+        if True:
+            commands += [
+                "CREATE DATABASE IF NOT EXISTS mysql;",
+                "USE mysql;",
+                "SET @auth_root_socket=NULL;",
+            ]
+            tables = [
+                "/usr/share/mariadb/mysql_system_tables.sql",
+                "/usr/share/mariadb/mysql_performance_tables.sql",
+                "/usr/share/mariadb/mysql_system_tables_data.sql",
+                "/usr/share/mariadb/fill_help_tables.sql",
+                "/usr/share/mariadb/maria_add_gis_sp_bootstrap.sql",
+            ]
+            for fn in tables:
+                tlist = McUtil.readFile(fn).split("\n")
+                for line in tlist:
+                    if "@current_hostname" in line:
+                        continue
+                    commands.append(line)
+
+        # same as _MariadbServer._initialize(), no network access and no priviledge for root user
+        commands += [
+            "UPDATE global_priv SET Priv = '{\"access\":0,\"plugin\":\"unix_socket\"}' WHERE Host = 'localhost' AND User = 'root';",
+            "DELETE FROM global_priv WHERE Host = '127.0.0.1' AND User = 'root';",
+            "DELETE FROM user WHERE Host = '127.0.0.1' AND User = 'root';",
+            "DELETE FROM global_priv WHERE Host = '::1' AND User = 'root';",
+            "DELETE FROM user WHERE Host = '::1' AND User = 'root';",
+            "DELETE FROM proxies_priv WHERE Host = 'localhost' AND User = 'root';",
+        ]
+
+        # create admin account, which creates databases and users when attaching databases
+        # access value is from /usr/share/mariadb/mysql_system_tables_data.sql, all priviledges
+        if True:
+            priv = json.loads(McUtil.mysqlPrivJson(adminPasswd))
+            priv["access"] = 18446744073709551615
+            commands.append(McUtil.sqlInsertStatement("global_priv", {
+                "Host": "localhost",
+                "User": self._dbAdminUser,
+                "Priv": json.dumps(priv),
+            }))
+
+        # create anonymous account, it is granted read-only priviledge for each database when attaching
+        commands += [
+            McUtil.sqlInsertStatement("global_priv", {
+                "Host": "%",
+                "User": self._dbReadUser,
+                "Priv": '{"access":0}',
+            }),
+        ]
+
+        # execute
+        if True:
+            out = McUtil.cmdCallWithInput("/usr/sbin/mysqld",                                         # command
+                                          "\n".join(commands),                                        # input
+                                          "--no-defaults", "--bootstrap",                             # arguments
+                                          "--datadir=%s" % (self._dataDir), "--log-warnings=0")       # arguments
+            with open(logFile, "w") as f:
+                f.write("## mariadb-install-db #######################\n")
+                f.write(out)
+
+        with open(self._adminPasswdFile, "w") as f:
+            f.write(adminPasswd)
+        os.chmod(self._adminPasswdFile, 0o600)
+        with open(self._instanceIdFile, "w") as f:
+            f.write(str(uuid.uuid4()))
+
+        os.unlink(os.path.join(self._dataDir, "initialize.failed"))
+
+    @staticmethod
+    def _ensureLink(linkFile, target):
+        if os.path.islink(linkFile) and os.readlink(linkFile) == target:
+            return
+        tmpLinkFile = linkFile + ".tmp"
+        McUtil.forceDelete(tmpLinkFile)
+        os.symlink(target, tmpLinkFile)
+        McUtil.forceDelete(linkFile)
+        os.rename(tmpLinkFile, linkFile)
+
+
+def _recordTableSchema(cur, tableInfo, tableInfoRecordFile, tableSchemaRecordFile):
+    # record table schema
+    # see the comment in _MariadbServer._initializePostStart()
+    with open(tableInfoRecordFile, "w") as f:
+        for tableName, value in tableInfo.items():
+            f.write("---- " + tableName + " ----\n")
+            f.write(value[1] + "\n")
+            f.write("\n")
+
+    cur.execute("SHOW TABLES;")
+    tableNameList = [x[0] for x in cur.fetchall()]
+    with open(tableSchemaRecordFile, "w") as f:
+        for tableName in tableNameList:
+            cur.execute("SHOW CREATE TABLE %s;" % (tableName))
+            out = cur.fetchall()[0][1]
+            f.write("---- " + tableName + " ----\n")
+            f.write(out + "\n")
+            f.write("\n")
+
+
+def _checkTableSchema(cur, tableInfo, tableInfoRecordFile, tableSchemaRecordFile):
+    if True:
+        buf = ""
+        for tableName, value in tableInfo.items():
+            buf += "---- " + tableName + " ----\n"
+            buf += value[1] + "\n"
+            buf += "\n"
+        if buf != McUtil.readFile(tableInfoRecordFile):
+            raise Exception("table info changed")
+    if True:
+        cur.execute("SHOW TABLES;")
+        tableNameList = [x[0] for x in cur.fetchall()]
+        buf = ""
+        for tableName in tableNameList:
+            cur.execute("SHOW CREATE TABLE %s;" % (tableName))
+            out = cur.fetchall()[0][1]
+            buf += "---- " + tableName + " ----\n"
+            buf += out + "\n"
+            buf += "\n"
+        if buf != McUtil.readFile(tableSchemaRecordFile):
+            raise Exception("table schema in database changed")
@@ -24,9 +24,14 @@ class Storage:
             # create server objects
             # The best solution would be using a one-instance-mongodb-server, but we can not do it
             # See the comment in "class storage.mariadb.Storage"
+            # servers are started concurrently
+            funcDict = dict()
             for msId in self._mirrorSiteDict:
-                self._serverDict[msId] = _MongodbServer(param["listen-ip"], param["temp-directory"], param["log-directory"],
-                                                        msId, self._mirrorSiteDict[msId]["data-directory"])
+                funcDict[msId] = (lambda msId=msId: _MongodbServer(param["listen-ip"], param["port-allocator"], param["temp-directory"], param["log-directory"],
+                                                                   msId, self._mirrorSiteDict[msId]["data-directory"]))
+            self._serverDict, errorDict = McUtil.callInParallel(funcDict)
+            if len(errorDict) > 0:
+                raise errorDict[sorted(errorDict.keys())[0]]
             # show log
             if any(self._bAdvertiseDict.values()):
                 logging.info("Advertiser (mongodb) started.")       # here we can not give out port information
@@ -60,16 +65,17 @@ class Storage:
 
 class _MongodbServer:
 
-    def __init__(self, listenIp, tmpDir, logDir, databaseName, dataDir, tableInfo):
+    def __init__(self, listenIp, portAllocator, tmpDir, logDir, databaseName, dataDir, tableInfo):
         self._cfgFile = os.path.join(tmpDir, "mongodb-%s.conf" % (databaseName))
         self._logFile = os.path.join(logDir, "mongodb-%s.log" % (databaseName))
         self._tmpDir = tmpDir
+        self._portAllocator = portAllocator
 
         self._port = None
         self._proc = None
         try:
             # allocate listening port
-            self._port = McUtil.getFreeSocketPort("tcp")
+            self._port = self._portAllocator.allocatePort("storage-mongodb/%s" % (databaseName))
 
             # generate mariadb config file
             with open(self._cfgFile, "w") as f:
@@ -94,7 +100,8 @@ class _MongodbServer:
                 f.write("\n\n")
                 f.write("## mongodb #######################\n")
             self._proc = subprocess.Popen(["/usr/bin/mongod", "--config", self._cfgFile], cwd=self._tmpDir)
-            McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            readyTime = McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            logging.debug("Storage (mongodb): database server for %s ready in %.2f seconds." % (databaseName, readyTime))
         except Exception:
             self.dispose()
             raise
@@ -105,6 +112,7 @@ class _MongodbServer:
             self._proc.wait()
             self._proc = None
         if self._port is not None:
+            self._portAllocator.releasePort(self._port)
             self._port = None
         if os.path.exists(self._cfgFile):
             os.unlink(self._cfgFile)
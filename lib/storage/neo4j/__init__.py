@@ -29,7 +29,7 @@ class Storage:
             # The best solution would be using a one-instance-neo4j-server, but we can not do it
             # See the comment in "class storage.mariadb.Storage"
             for msId in self._mirrorSiteDict:
-                self._serverDict[msId] = _Neo4jServer(param["listen-ip"], param["temp-directory"], param["log-directory"],
+                self._serverDict[msId] = _Neo4jServer(param["listen-ip"], param["port-allocator"], param["temp-directory"], param["log-directory"],
                                                       msId, self._mirrorSiteDict[msId]["data-directory"])
             # show log
             if any(self._bAdvertiseDict.values()):
@@ -66,17 +66,19 @@ class Storage:
 
 class _Neo4jServer:
 
-    def __init__(self, listenIp, tmpDir, logDir, databaseName, dataDir, tableInfo):
+    def __init__(self, listenIp, portAllocator, tmpDir, logDir, databaseName, dataDir, tableInfo):
         self._cfgDir = os.path.join(tmpDir, "advertiser-neo4j-%s.conf" % (databaseName))
         self._logDir = os.path.join(logDir, "advertiser-neo4j-%s.log" % (databaseName))
         self._tmpDir = tmpDir
+        self._portAllocator = portAllocator
 
-        self._port = None
+        self._boltPort = None
+        self._httpPort = None
         self._proc = None
         try:
             # allocate listening port
-            self._boltPort = McUtil.getFreeSocketPort("tcp")
-            self._httpPort = 20000
+            self._boltPort = self._portAllocator.allocatePort("storage-neo4j/%s" % (databaseName))
+            self._httpPort = self._portAllocator.allocatePort("storage-neo4j/%s/http" % (databaseName))
 
             # generate mariadb config file
             os.mkdir(self._cfgDir)
@@ -101,7 +103,8 @@ class _Neo4jServer:
             self._proc = subprocess.Popen(["/opt/neo4j-community-3.5.8/bin/neo4j", "console"],
                                           env={"NEO4J_CONF": self._cfgDir},
                                           cwd=self._tmpDir)
-            McUtil.waitSocketPortForProc("tcp", listenIp, self._port, self._proc)
+            readyTime = McUtil.waitSocketPortForProc("tcp", listenIp, self._boltPort, self._proc)
+            logging.debug("Storage (neo4j): database server for %s ready in %.2f seconds." % (databaseName, readyTime))
         except Exception:
             self.dispose()
             raise
@@ -111,15 +114,15 @@ class _Neo4jServer:
             self._proc.terminate()
             self._proc.wait()
             self._proc = None
-        if self._port is not None:
-            self._port = None
+        if self._boltPort is not None:
+            self._portAllocator.releasePort(self._boltPort)
+            self._boltPort = None
+        if self._httpPort is not None:
+            self._portAllocator.releasePort(self._httpPort)
+            self._httpPort = None
         if os.path.exists(self._cfgDir):
             shutil.rmtree(self._cfgDir)
 
-    @property
-    def dbSocketFile(self):
-        return os.path.join(self._tmpDir, "mongodb-%d.sock" % (self._port))
-
     @property
     def dbBoltPort(self):
         return self._boltPort
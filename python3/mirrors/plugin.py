@@ -32,8 +32,10 @@ mirrors.plugin
 """
 
 import sys
+import time
 import json
 import socket
+import threading
 
 __author__ = "fpemud@sina.com (Fpemud)"
 __version__ = "0.0.1"
@@ -50,31 +52,132 @@ def __getattr__(name):
 
 class ApiClient:
 
-    def __init__(self):
+    def __init__(self, max_progress_rate=5):
+        # progress notifications are coalesced: unchanged progress is not sent, and at most
+        # max_progress_rate progress notifications are sent per second, the latest progress
+        # is sent when the rate allows, by the flush thread, or when the client is closed
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect("/run/mirrors/api.socket")
+        self.progress_interval = 1.0 / max_progress_rate if max_progress_rate else 0
+        self.last_progress = None
+        self.last_progress_time = None
+        self.pending_progress = None
+        self.transfer_stats_data = {
+            "bytes-downloaded": 0,
+            "files-added": 0,
+            "files-removed": 0,
+        }
+        self.last_transfer_stats_time = time.monotonic()
+        self.last_transfer_stats_bytes = 0
+        self.transfer_stats_pending = False
+        self.flush_deadline = None
+        self.closed = False
+        self.cond = threading.Condition()            # serializes sending, the flush thread waits on it
+        self.flush_thread = threading.Thread(target=self._flush_thread_func, daemon=True)
+        self.flush_thread.start()
 
     def close(self):
-        self.sock.close()
-        del self.sock
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+            self._flush_progress()
+            self._flush_transfer_stats()
+            self.sock.close()
+            del self.sock
+        self.flush_thread.join()
 
     def progress_changed(self, progress):
-        self.sock.send(json.dumps({
+        with self.cond:
+            if progress == self.last_progress:
+                self.pending_progress = None
+                return
+
+            now = time.monotonic()
+            if progress == 100 or self.last_progress_time is None or now - self.last_progress_time >= self.progress_interval:
+                self._send_progress(progress, now)
+            else:
+                self.pending_progress = progress
+                self._start_flush_timer(self.progress_interval - (now - self.last_progress_time))
+
+    def transfer_stats(self, bytes_downloaded=0, files_added=0, files_removed=0):
+        # parameters are increments, can be called for every downloaded file
+        # totals of this run are sent, and they are coalesced like progress notifications
+        with self.cond:
+            self.transfer_stats_data["bytes-downloaded"] += bytes_downloaded
+            self.transfer_stats_data["files-added"] += files_added
+            self.transfer_stats_data["files-removed"] += files_removed
+            self.transfer_stats_pending = True
+
+            now = time.monotonic()
+            if now - self.last_transfer_stats_time >= self.progress_interval:
+                self._send_transfer_stats(now)
+            else:
+                self._start_flush_timer(self.progress_interval - (now - self.last_transfer_stats_time))
+
+    def error_occured(self, exc_info):
+        with self.cond:
+            self._flush_progress()
+            self._flush_transfer_stats()
+            self._send({
+                "message": "error",
+                "data": {
+                    "exc_info": "abc",
+                },
+            })
+
+    def _start_flush_timer(self, delay):
+        # the pending progress and transfer stats would stay unsent if no more notification comes
+        if self.flush_deadline is None:
+            self.flush_deadline = time.monotonic() + delay
+            self.cond.notify()
+
+    def _flush_thread_func(self):
+        with self.cond:
+            while not self.closed:
+                if self.flush_deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.flush_deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                self.flush_deadline = None
+                self._flush_progress()
+                self._flush_transfer_stats()
+
+    def _flush_progress(self):
+        if self.pending_progress is not None:
+            self._send_progress(self.pending_progress, time.monotonic())
+
+    def _send_progress(self, progress, now):
+        self._send({
             "message": "progress",
             "data": {
                 "progress": progress,
             },
-        }).encode("utf-8"))
-        self.sock.send(b'\n')
+        })
+        self.last_progress = progress
+        self.last_progress_time = now
+        self.pending_progress = None
 
-    def error_occured(self, exc_info):
-        self.sock.send(json.dumps({
-            "message": "error",
-            "data": {
-                "exc_info": "abc",
-            },
-        }).encode("utf-8"))
-        self.sock.send(b'\n')
+    def _flush_transfer_stats(self):
+        if self.transfer_stats_pending:
+            self._send_transfer_stats(time.monotonic())
+
+    def _send_transfer_stats(self, now):
+        # rate is bytes per second since the last transfer-stats message
+        elapsed = now - self.last_transfer_stats_time
+        rate = (self.transfer_stats_data["bytes-downloaded"] - self.last_transfer_stats_bytes) / elapsed if elapsed > 0 else 0
+        self._send({
+            "message": "transfer-stats",
+            "data": dict(self.transfer_stats_data, rate=rate),
+        })
+        self.last_transfer_stats_time = now
+        self.last_transfer_stats_bytes = self.transfer_stats_data["bytes-downloaded"]
+        self.transfer_stats_pending = False
+
+    def _send(self, data):
+        self.sock.sendall(json.dumps(data).encode("utf-8") + b'\n')
 
     def __enter__(self):
         return self
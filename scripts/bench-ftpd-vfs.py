@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# micro-benchmark for virtual path resolution of the ftp advertiser
+# compares ftpd.DirMap with the linear scan that was used before, on 1000 mapped sites by default,
+# then measures LIST and MLSD of a large directory against ftpd.py and plain pyftpdlib, for example:
+#   bench-ftpd-vfs.py 1000 50000
+
+import os
+import sys
+import json
+import time
+import ftplib
+import random
+import shutil
+import socket
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "advertiser", "ftp"))
+from ftpd import DirMap
+
+
+def linearPath2rpath(dirmap, path):
+    for prefix, realPath in dirmap.items():
+        if path == "/" + prefix:
+            return realPath
+        if path.startswith("/" + prefix + "/"):
+            return path.replace("/" + prefix, realPath, 1)
+    return None
+
+
+def linearRpath2path(dirmap, rpath):
+    for prefix, realPath in dirmap.items():
+        if rpath == realPath:
+            return "/" + prefix
+        if rpath.startswith(realPath + "/"):
+            return rpath.replace(realPath, "/" + prefix, 1)
+    return None
+
+
+def linearCheckOverlay(dirmap):
+    tl = list(dirmap.values())
+    for i in range(0, len(tl)):
+        for j in range(0, len(tl)):
+            if i != j and (tl[i] == tl[j] or tl[i].startswith(tl[j] + "/") or tl[j].startswith(tl[i] + "/")):
+                raise Exception("values in \"dirmap\" are overlay")
+
+
+def report(title, count, seconds):
+    print("%-40s %8d ops  %10.3f ms total  %8.2f us/op" % (title, count, seconds * 1000, seconds * 1000000 / count))
+
+
+def getFreePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def benchList(title, cmd, port, path):
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for i in range(0, 100):
+            try:
+                ftp = ftplib.FTP()
+                ftp.connect("127.0.0.1", port)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        else:
+            raise Exception("server is not started")
+        ftp.login()
+        for command in ["LIST", "LIST", "MLSD", "MLSD"]:
+            lineList = []
+            t = time.perf_counter()
+            ftp.retrlines("%s %s" % (command, path), lineList.append)
+            report("%s (%s)" % (command, title), len(lineList), time.perf_counter() - t)
+        ftp.quit()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+siteCount = int(sys.argv[1]) if len(sys.argv) >= 2 else 1000
+fileCount = int(sys.argv[2]) if len(sys.argv) >= 3 else 20000
+lookupCount = 100000
+
+random.seed(0)
+dirmap = {"site-%d" % (i): "/var/cache/mirrors/site-%d/storage-file" % (i) for i in range(0, siteCount)}
+pathList = []
+for i in range(0, lookupCount):
+    site = "site-%d" % (random.randrange(0, siteCount))
+    pathList.append("/%s/pool/main/p/package-%d/package_%d.deb" % (site, i, i))
+rpathList = [linearPath2rpath(dirmap, x) for x in pathList[:1000]]
+
+t = time.perf_counter()
+linearCheckOverlay(dirmap)
+report("build (linear overlay check)", 1, time.perf_counter() - t)
+t = time.perf_counter()
+dm = DirMap(dirmap)
+report("build (DirMap)", 1, time.perf_counter() - t)
+
+t = time.perf_counter()
+for path in pathList[:1000]:
+    linearPath2rpath(dirmap, path)
+report("path2rpath (linear)", 1000, time.perf_counter() - t)
+t = time.perf_counter()
+for path in pathList:
+    assert dm.path2rpath(path) is not None
+report("path2rpath (DirMap)", lookupCount, time.perf_counter() - t)
+
+t = time.perf_counter()
+for rpath in rpathList:
+    linearRpath2path(dirmap, rpath)
+report("rpath2path (linear)", len(rpathList), time.perf_counter() - t)
+t = time.perf_counter()
+for i in range(0, lookupCount // len(rpathList)):
+    for rpath in rpathList:
+        assert dm.rpath2path(rpath) is not None
+report("rpath2path (DirMap)", lookupCount, time.perf_counter() - t)
+
+# LIST and MLSD, the second command of each kind is served from the stat cache of ftpd.py
+tmpDir = tempfile.mkdtemp(prefix="bench-ftpd-vfs-")
+try:
+    dataDir = os.path.join(tmpDir, "site", "dir")
+    os.makedirs(dataDir)
+    for i in range(0, fileCount):
+        with open(os.path.join(dataDir, "package_%d.deb" % (i)), "wb") as f:
+            f.write(b"x" * (i % 1000))
+
+    port = getFreePort()
+    cfgFile = os.path.join(tmpDir, "ftpd.cfg")
+    with open(cfgFile, "w") as f:
+        json.dump({
+            "logFile": os.path.join(tmpDir, "ftpd.log"),
+            "ip": "127.0.0.1",
+            "port": port,
+            "dirmap": {"site": os.path.join(tmpDir, "site")},
+        }, f)
+    ftpdFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "advertiser", "ftp", "ftpd.py")
+    benchList("ftpd.py", [sys.executable, ftpdFile, cfgFile], port, "/site/dir")
+
+    port = getFreePort()
+    benchList("pyftpdlib", [sys.executable, "-m", "pyftpdlib", "-i", "127.0.0.1", "-p", str(port), "-d", os.path.join(tmpDir, "site")], port, "/dir")
+finally:
+    shutil.rmtree(tmpDir)
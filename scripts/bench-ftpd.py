@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# FTP load generator for comparing the single-process and multi-process modes of the ftp advertiser
+# each client process downloads the given URLs round robin, one anonymous FTP session per download,
+# reports downloads per second and throughput, for example:
+#   bench-ftpd.py 32 5000 ftp://127.0.0.1:PORT/SITE/some/small/file
+#   bench-ftpd.py 8 40 ftp://127.0.0.1:PORT/SITE/some/image.iso
+# run it once with "workers" set to 1 and once with "workers" set to N in /etc/mirrors/advertiser-ftp.conf
+
+import sys
+import time
+import ftplib
+import urllib.parse
+import multiprocessing
+
+
+def client(urlList, start, step, count):
+    # returns (bytes, errors, list<latency>)
+    size = [0]
+    errors = 0
+    latencyList = []
+
+    def _recv(buf):
+        size[0] += len(buf)
+
+    for i in range(start, count, step):
+        url = urllib.parse.urlparse(urlList[i % len(urlList)])
+        t = time.perf_counter()
+        try:
+            with ftplib.FTP() as ftp:
+                ftp.connect(url.hostname, url.port or 21)
+                ftp.login()
+                ftp.retrbinary("RETR " + urllib.parse.unquote(url.path), _recv, blocksize=1024 * 1024)
+        except (OSError, ftplib.Error):
+            errors += 1
+            continue
+        latencyList.append(time.perf_counter() - t)
+    return (size[0], errors, latencyList)
+
+
+def main(concurrency, requestCount, urlList):
+    with multiprocessing.Pool(concurrency) as pool:
+        t = time.perf_counter()
+        resultList = pool.starmap(client, [(urlList, i, concurrency, requestCount) for i in range(0, concurrency)])
+        t = time.perf_counter() - t
+
+    size = sum([x[0] for x in resultList])
+    errors = sum([x[1] for x in resultList])
+    latency = sorted([y for x in resultList for y in x[2]])
+    print("downloads:    %d (%d errors)" % (requestCount, errors))
+    print("time:         %.3f s" % (t))
+    print("downloads/s:  %.1f" % (requestCount / t))
+    print("throughput:   %.1f MiB/s" % (size / t / 1024 / 1024))
+    if len(latency) > 0:
+        print("latency p50:  %.2f ms" % (latency[len(latency) // 2] * 1000))
+        print("latency p99:  %.2f ms" % (latency[min(len(latency) * 99 // 100, len(latency) - 1)] * 1000))
+
+
+if len(sys.argv) < 4:
+    print("syntax: bench-ftpd.py <concurrency> <download-count> <url> [url ...]")
+    sys.exit(1)
+
+main(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3:])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# HTTP load generator for comparing the httpdir advertiser implementations
+# requests the given URLs round robin over keep-alive connections, reports
+# requests per second and throughput, for example:
+#   small-file workload: bench-httpdir.py 64 20000 http://127.0.0.1:PORT/SITE/some/small/file
+#   large-ISO workload:  bench-httpdir.py 4 20 http://127.0.0.1:PORT/SITE/some/image.iso
+
+import sys
+import time
+import asyncio
+import aiohttp
+
+
+async def worker(session, urlList, counter, result):
+    while True:
+        i = counter[0]
+        if i >= counter[1]:
+            return
+        counter[0] += 1
+        t = time.perf_counter()
+        async with session.get(urlList[i % len(urlList)]) as resp:
+            size = 0
+            async for chunk in resp.content.iter_chunked(1024 * 1024):
+                size += len(chunk)
+            if resp.status not in [200, 206]:
+                result["error"] += 1
+        result["bytes"] += size
+        result["latency"].append(time.perf_counter() - t)
+
+
+async def main(concurrency, requestCount, urlList):
+    counter = [0, requestCount]
+    result = {"bytes": 0, "error": 0, "latency": []}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        t = time.perf_counter()
+        await asyncio.gather(*[worker(session, urlList, counter, result) for i in range(0, concurrency)])
+        t = time.perf_counter() - t
+
+    latency = sorted(result["latency"])
+    print("requests:     %d (%d errors)" % (requestCount, result["error"]))
+    print("time:         %.3f s" % (t))
+    print("requests/s:   %.1f" % (requestCount / t))
+    print("throughput:   %.1f MiB/s" % (result["bytes"] / t / 1024 / 1024))
+    print("latency p50:  %.2f ms" % (latency[len(latency) // 2] * 1000))
+    print("latency p99:  %.2f ms" % (latency[min(len(latency) * 99 // 100, len(latency) - 1)] * 1000))
+
+
+if len(sys.argv) < 4:
+    print("syntax: bench-httpdir.py <concurrency> <request-count> <url> [url ...]")
+    sys.exit(1)
+
+asyncio.run(main(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3:]))
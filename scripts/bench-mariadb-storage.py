@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# startup time and memory comparison of the per-site mode and the shared-instance mode of the mariadb storage
+# creates <site-count> mirror sites with a small schema in a scratch directory, starts the storage in both modes
+# (first start includes initialization, second start re-uses the data), then reports the total RSS of the mysqld
+# processes, for example:
+#   bench-mariadb-storage.py 20
+# needs mariadb installed and must run as the same user as the mirrors daemon
+
+import os
+import sys
+import time
+import psutil
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from mc_util import PortAllocator
+from storage.mariadb import Storage
+
+
+SCHEMA = """
+CREATE TABLE Movie (
+    id INTEGER PRIMARY KEY,
+    title VARCHAR(255)
+);
+CREATE TABLE Director (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255)
+);
+"""
+
+
+def makeParam(rootDir, siteCount, bShared):
+    param = {
+        "listen-ip": "127.0.0.1",
+        "port-allocator": PortAllocator(os.path.join(rootDir, "ports.json")),
+        "temp-directory": os.path.join(rootDir, "tmp"),
+        "log-directory": os.path.join(rootDir, "log"),
+        "config": {
+            "shared-instance": bShared,
+            "shared-instance-data-directory": os.path.join(rootDir, "shared"),
+        },
+        "mirror-sites": dict(),
+    }
+    os.makedirs(param["temp-directory"], exist_ok=True)
+    os.makedirs(param["log-directory"], exist_ok=True)
+    with open(os.path.join(rootDir, "schema.sql"), "w") as f:
+        f.write(SCHEMA)
+    for i in range(0, siteCount):
+        msId = "site%d" % (i)
+        msParam = {
+            "config-xml": "<storage type=\"mariadb\"><database-schema>schema.sql</database-schema></storage>",
+            "plugin-directory": rootDir,
+            "state-directory": os.path.join(rootDir, msId, "state"),
+            "data-directory": os.path.join(rootDir, msId, "storage-mariadb"),
+        }
+        os.makedirs(msParam["state-directory"], exist_ok=True)
+        os.makedirs(msParam["data-directory"], exist_ok=True)
+        param["mirror-sites"][msId] = msParam
+    return param
+
+
+def getMysqldRss():
+    ret = 0
+    for proc in psutil.Process().children(recursive=True):
+        if proc.name() in ["mysqld", "mariadbd"]:
+            ret += proc.memory_info().rss
+    return ret
+
+
+def run(title, param):
+    t = time.perf_counter()
+    storage = Storage(param)
+    t = time.perf_counter() - t
+    time.sleep(1)
+    rss = getMysqldRss()
+    storage.dispose()
+    print("%-30s startup %8.3f s  mysqld RSS %8.1f MiB" % (title, t, rss / 1024 / 1024))
+
+
+if len(sys.argv) < 2:
+    print("syntax: bench-mariadb-storage.py <site-count>")
+    sys.exit(1)
+
+siteCount = int(sys.argv[1])
+for bShared in [False, True]:
+    rootDir = tempfile.mkdtemp(prefix="bench-mariadb-")
+    try:
+        mode = "shared-instance" if bShared else "per-site"
+        param = makeParam(rootDir, siteCount, bShared)
+        run("%s, first start" % (mode), param)
+        run("%s, second start" % (mode), param)
+    finally:
+        shutil.rmtree(rootDir)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# throughput benchmark for RotatingFile, which stores the stdout of updaters
+# feeds rsync -v like output (one file path per line) in pipe-sized chunks, with and without compression, for example:
+#   bench-rotating-file.py 200
+#   bench-rotating-file.py 200 65536 1048576
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from mc_util import RotatingFile
+
+
+def makeData(totalBytes):
+    lineList = []
+    size = 0
+    i = 0
+    while size < totalBytes:
+        line = ("pub/linux/distfiles/%04d/package-%d.%d.tar.xz\n" % (i % 10000, i, i % 7)).encode("ascii")
+        lineList.append(line)
+        size += len(line)
+        i += 1
+    return (b"".join(lineList), len(lineList))
+
+
+def run(title, data, lineCount, chunkSize, maxBytes, bCompress):
+    tmpDir = tempfile.mkdtemp(prefix="bench-rotating-file-")
+    try:
+        t = time.perf_counter()
+        f = RotatingFile(os.path.join(tmpDir, "updater.log"), maxBytes, 5, bCompress)
+        for i in range(0, len(data), chunkSize):
+            f.write(data[i:i + chunkSize])
+        f.close()
+        t = time.perf_counter() - t
+        RotatingFile.waitCompress()
+        print("%-12s %8.1f MiB/s  %10.0f lines/s" % (title, len(data) / t / 1024 / 1024, lineCount / t))
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if len(sys.argv) < 2:
+    print("syntax: bench-rotating-file.py <data-size-in-MiB> [chunk-size] [max-bytes]")
+    sys.exit(1)
+
+data, lineCount = makeData(int(sys.argv[1]) * 1024 * 1024)
+chunkSize = int(sys.argv[2]) if len(sys.argv) >= 3 else 4096
+maxBytes = int(sys.argv[3]) if len(sys.argv) >= 4 else 10 * 1024 * 1024
+run("plain", data, lineCount, chunkSize, maxBytes, False)
+run("compress", data, lineCount, chunkSize, maxBytes, True)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# synthetic benchmark for mc_updater._Scheduler
+# schedules interval and cron jobs, then measures the cost of adding, pausing,
+# re-triggering and firing jobs (one tick = one _jobCallback invocation)
+
+import os
+import sys
+import time
+import random
+from datetime import datetime
+from datetime import timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from mc_updater import _Scheduler
+
+
+def report(title, count, seconds):
+    print("%-40s %8d ops  %10.3f ms total  %8.2f us/op" % (title, count, seconds * 1000, seconds * 1000000 / count))
+
+
+jobCount = int(sys.argv[1]) if len(sys.argv) >= 2 else 10000
+tickCount = 1000
+dueJobsPerTick = 10
+
+random.seed(0)
+scheduler = _Scheduler()
+now = datetime.now()
+callback = (lambda schedDatetime: None)
+jobIdList = ["site-%d" % (i) for i in range(0, jobCount)]
+
+# add jobs, half of them are interval jobs, the other half are cron jobs
+t = time.perf_counter()
+for i, jobId in enumerate(jobIdList):
+    if i % 2 == 0:
+        interval = timedelta(hours=random.randint(1, 48))
+        scheduler.addIntervalJob(jobId, now - interval * random.random(), interval, callback)
+    else:
+        scheduler.addCronJob(jobId, None, "%d %d * * *" % (random.randint(0, 59), random.randint(0, 23)), callback)
+report("add job", jobCount, time.perf_counter() - t)
+
+# pause jobs
+t = time.perf_counter()
+for i in range(0, jobCount):
+    jobId = random.choice(jobIdList)
+    scheduler.pauseJobUntil(jobId, scheduler.getJobNextSchedDatetime(jobId) + timedelta(minutes=10))
+report("pause job", jobCount, time.perf_counter() - t)
+
+# re-trigger jobs
+t = time.perf_counter()
+for i in range(0, jobCount):
+    jobId = random.choice(jobIdList)
+    scheduler.triggerJobAt(jobId, scheduler.getJobNextSchedDatetime(jobId) - timedelta(minutes=5))
+report("trigger job", jobCount, time.perf_counter() - t)
+
+# fire jobs, make some jobs due before each tick
+t = 0
+for i in range(0, tickCount):
+    for jobId in random.sample(jobIdList, dueJobsPerTick):
+        scheduler.triggerJobAt(jobId, datetime.now() - timedelta(seconds=1))
+    t1 = time.perf_counter()
+    scheduler._jobCallback()
+    t += time.perf_counter() - t1
+report("tick (%d due jobs)" % (dueJobsPerTick), tickCount, t)
+
+print("heap size: %d, job count: %d" % (len(scheduler.jobHeap), len(scheduler.jobDict)))
+scheduler.dispose()
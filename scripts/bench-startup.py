@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# startup time benchmark for serial and parallel component startup (see McPluginManager.loadStorageObjects)
+# each component starts a server process on a port from PortAllocator and waits for it by McUtil.waitSocketPortForProc,
+# which is what database storages and advertisers do, for example:
+#   bench-startup.py 40 "sh -c 'sleep 1; exec python3 -m http.server --bind 127.0.0.1 {PORT}'"
+#   bench-startup.py 40 "/usr/sbin/mysqld --no-defaults --skip-grant-tables --datadir={DIR} --socket={DIR}/s --port={PORT}"
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from mc_util import McUtil
+from mc_util import PortAllocator
+
+
+class Component:
+
+    def __init__(self, portAllocator, cmdTemplate, tmpDir):
+        self._portAllocator = portAllocator
+        self._port = self._portAllocator.allocatePort(None)
+        cmd = cmdTemplate.replace("{PORT}", str(self._port)).replace("{DIR}", tmpDir)
+        self._proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=tmpDir)
+        self.readyTime = McUtil.waitSocketPortForProc("tcp", "127.0.0.1", self._port, self._proc)
+
+    def dispose(self):
+        self._proc.terminate()
+        self._proc.wait()
+        self._portAllocator.releasePort(self._port)
+
+
+def run(title, count, cmdTemplate, bParallel):
+    tmpDirList = [tempfile.mkdtemp(prefix="bench-startup-") for i in range(0, count)]
+    portAllocator = PortAllocator(os.path.join(tmpDirList[0], "ports.json"))
+    try:
+        t = time.perf_counter()
+        if bParallel:
+            objDict, errorDict = McUtil.callInParallel({i: (lambda i=i: Component(portAllocator, cmdTemplate, tmpDirList[i])) for i in range(0, count)})
+            if len(errorDict) > 0:
+                print("%d components failed" % (len(errorDict)))
+        else:
+            objDict = {i: Component(portAllocator, cmdTemplate, tmpDirList[i]) for i in range(0, count)}
+        t = time.perf_counter() - t
+        readyTime = max([obj.readyTime for obj in objDict.values()], default=0)
+        print("%-10s %4d components  %8.3f s  (max time-to-ready %.3f s)" % (title, count, t, readyTime))
+        for obj in objDict.values():
+            obj.dispose()
+    finally:
+        for tmpDir in tmpDirList:
+            shutil.rmtree(tmpDir)
+
+
+if len(sys.argv) < 2:
+    print("syntax: bench-startup.py <component-count> [server-command]")
+    sys.exit(1)
+
+count = int(sys.argv[1])
+cmdTemplate = sys.argv[2] if len(sys.argv) >= 3 else "%s -m http.server --bind 127.0.0.1 {PORT}" % (sys.executable)
+run("serial", count, cmdTemplate, False)
+run("parallel", count, cmdTemplate, True)
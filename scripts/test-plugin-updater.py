@@ -5,12 +5,16 @@ import os
 import sys
 import json
 import shutil
+import asyncio
+import tempfile
 import subprocess
 import lxml.etree
+import asyncio_glib
 from datetime import datetime
 from gi.repository import GLib
 sys.path.append("/usr/lib64/mirrors")
 from mc_util import McUtil
+from mc_util import PortAllocator
 from mc_util import UnixDomainSocketApiServer
 from mc_param import McConst
 from mc_updater import _UpdateHistory
@@ -74,11 +78,13 @@ class MirrorSite:
 
         # prepare storage initialization parameter
         param = {
+            "config": dict(),
             "mirror-sites": dict(),
         }
         if mod.Storage.get_properties().get("with-integrated-advertiser", False):
             param.update({
                 "listen-ip": "0.0.0.0",
+                "port-allocator": portAllocator,
                 "temp-directory": McConst.tmpDir,
                 "log-directory": McConst.logDir,
             })
@@ -133,7 +139,7 @@ class InitOrUpdateProc:
             self.proc = None
 
     def _exitCallback(self, status, data):
-        mainloop.quit()
+        mainloop.stop()
         self.proc = None
 
 
@@ -141,7 +147,7 @@ class ApiServer(UnixDomainSocketApiServer):
 
     def __init__(self, mirrorSiteId):
         self.mirrorSiteId = mirrorSiteId
-        super().__init__(McConst.apiServerFile, self._clientInitFunc, None, self._clientNoitfyFunc)
+        super().__init__(McConst.apiServerFile, self._clientInitFunc, None, self._clientNoitfyFunc, loop=mainloop)
 
     def _clientInitFunc(self, sock):
         return self.mirrorSiteId
@@ -151,13 +157,15 @@ class ApiServer(UnixDomainSocketApiServer):
             progress = data["data"]["progress"]
             print("progress %s" % (progress))
             if progress == 100:
-                mainloop.quit()
+                mainloop.stop()
+        elif data["message"] == "transfer-stats":
+            print("transfer_stats %d bytes, %d files added, %d files removed, %d bytes/s" % (data["data"]["bytes-downloaded"], data["data"]["files-added"], data["data"]["files-removed"], data["data"]["rate"]))
         elif data["message"] == "error":
             print("error %s" % (data["data"]["exc_info"]))
-            mainloop.quit()
+            mainloop.stop()
         elif data["message"] == "error-and-hold-for":
             print("error_and_hold_for %d %s" % (data["data"]["seconds"], data["data"]["exc_info"]))
-            mainloop.quit()
+            mainloop.stop()
         else:
             assert False
 
@@ -178,7 +186,10 @@ else:
 # global objects
 apiServer = None
 proc = None
-mainloop = GLib.MainLoop()
+asyncio.set_event_loop_policy(asyncio_glib.GLibEventLoopPolicy())
+mainloop = asyncio.get_event_loop()
+portAllocatorDir = tempfile.mkdtemp(prefix="test-plugin-updater-")
+portAllocator = PortAllocator(os.path.join(portAllocatorDir, "ports.json"))
 msObj = MirrorSite(pluginId, pluginDir, mirrorSiteId)
 
 # directories
@@ -192,15 +203,16 @@ apiServer = ApiServer(mirrorSiteId)
 if not updateHistory.isInitialized():
     print("init start begin")
     proc = InitOrUpdateProc(pluginId, msObj, debugFlag, True)
-    mainloop.run()
+    mainloop.run_forever()
     print("init start end (we don't save to UPDATE_HISTORY file)")
 else:
     print("update start begin")
     proc = InitOrUpdateProc(pluginId, msObj, debugFlag, False)
-    mainloop.run()
+    mainloop.run_forever()
     print("update start end (we don't save to UPDATE_HISTORY file)")
 
 # dispose
 proc.dispose()
 apiServer.dispose()
 shutil.rmtree(McConst.runDir)
+shutil.rmtree(portAllocatorDir)